@@ -4,8 +4,10 @@ Grid actions.
 Should be used in replay and undo features.
 """
 
+from array import array
 from dataclasses import dataclass, field
 from layer_util import Layer
+from layer_store import LayerStore
 from grid import Grid
 
 @dataclass
@@ -23,25 +25,169 @@ class PaintStep:
         sq.add(self.affected_layer)
 
 
+@dataclass
+class SpecialStep:
+    """
+    The effect of a special action on one grid square.
+    removed_layer is the layer the special removed,
+    or None if the store's special is undone by running it again.
+    """
+
+    affected_grid_square: tuple[int, int]
+    removed_layer: Layer | None = None
+
+    def undo_apply(self, grid: Grid):
+        sq = grid[self.affected_grid_square[0]][self.affected_grid_square[1]]
+        if self.removed_layer is None:
+            sq.special()
+        else:
+            sq.add(self.removed_layer)
+
+    def redo_apply(self, grid: Grid):
+        sq = grid[self.affected_grid_square[0]][self.affected_grid_square[1]]
+        if self.removed_layer is None:
+            sq.special()
+        else:
+            sq.erase(self.removed_layer)
+
+
+@dataclass
+class BlankSpecialStep:
+    """
+    The effect of a special action on the squares of every tile that wasn't allocated when it ran,
+    which the grid changed all at once through Grid.blank. Running it again undoes it.
+    """
+
+    allocated_tiles: tuple[tuple[int, int], ...]
+
+    def undo_apply(self, grid: Grid):
+        grid.special_outside(self.allocated_tiles)
+
+    def redo_apply(self, grid: Grid):
+        grid.special_outside(self.allocated_tiles)
+
+
+@dataclass
+class RestoreStep:
+    """
+    A change to one grid square recorded as its whole state before and after,
+    in the form returned by the square's LayerStore.snapshot.
+    Used by bulk operations whose effect isn't a single add or erase.
+    """
+
+    affected_grid_square: tuple[int, int]
+    before: object
+    after: object
+
+    def undo_apply(self, grid: Grid):
+        grid[self.affected_grid_square[0]][self.affected_grid_square[1]].restore(self.before)
+
+    def redo_apply(self, grid: Grid):
+        grid[self.affected_grid_square[0]][self.affected_grid_square[1]].restore(self.after)
+
+
+@dataclass
+class BulkPaintStep:
+    """
+    One layer added to many grid squares, as built by Grid.apply_many.
+    Squares are stored flat as x0, y0, x1, y1, ... so large regions stay compact.
+    Only squares which actually changed are stored, so undo mirrors PaintStep.
+    """
+
+    affected_grid_squares: array
+    affected_layer: Layer
+
+    def __len__(self) -> int:
+        return len(self.affected_grid_squares) // 2
+
+    def undo_apply(self, grid: Grid):
+        squares = self.affected_grid_squares
+        layer = self.affected_layer
+        with grid.batched():
+            for i in range(0, len(squares), 2):
+                grid.store_at(squares[i], squares[i + 1]).erase(layer)
+
+    def redo_apply(self, grid: Grid):
+        squares = self.affected_grid_squares
+        layer = self.affected_layer
+        with grid.batched():
+            for i in range(0, len(squares), 2):
+                grid.store_at(squares[i], squares[i + 1]).add(layer)
+
+
+@dataclass
+class PasteStep:
+    """
+    Many grid squares given whole layer stores at once, e.g. by pasting a region.
+    Squares are stored flat as x0, y0, x1, y1, ... and `before` / `after` hold a store per square.
+    Those stores share their layers copy-on-write, so undo and redo never copy them.
+    """
+
+    affected_grid_squares: array
+    before: list[LayerStore]
+    after: list[LayerStore]
+
+    @classmethod
+    def from_changes(cls, changes: list[tuple[int, int, LayerStore, LayerStore]]) -> PasteStep:
+        """ Builds the step from (x, y, before, after) tuples, as returned by Grid.paste_region. """
+        squares = array("I")
+        for x, y, _, _ in changes:
+            squares.append(x)
+            squares.append(y)
+        return cls(squares, [change[2] for change in changes], [change[3] for change in changes])
+
+    def __len__(self) -> int:
+        return len(self.before)
+
+    def undo_apply(self, grid: Grid):
+        squares = self.affected_grid_squares
+        for i, store in enumerate(self.before):
+            grid[squares[2 * i]][squares[2 * i + 1]].share_from(store)
+
+    def redo_apply(self, grid: Grid):
+        squares = self.affected_grid_squares
+        for i, store in enumerate(self.after):
+            grid[squares[2 * i]][squares[2 * i + 1]].share_from(store)
+
+
 @dataclass
 class PaintAction:
 
-    steps: list[PaintStep] = field(default_factory=list)
+    steps: list[PaintStep|RestoreStep|BulkPaintStep|PasteStep] = field(default_factory=list)
     is_special: bool = False
+    # Filled in the first time a special action is applied,
+    # so undo/redo only touch the squares it changed, and undo is exact.
+    special_steps: list[SpecialStep|BlankSpecialStep] | None = None
 
     def undo_apply(self, grid: Grid):
         if self.is_special:
-            grid.special()
+            if self.special_steps is None: # Never applied, so nothing recorded to undo precisely
+                grid.special()
+                return
+            for step in self.special_steps:
+                step.undo_apply(grid)
             return
         for step in self.steps:
             step.undo_apply(grid)
 
     def redo_apply(self, grid: Grid):
         if self.is_special:
-            grid.special()
+            if self.special_steps is None:
+                changed, allocated = grid.special()
+                self.special_steps = [SpecialStep((x, y), removed) for x, y, removed in changed]
+                if allocated is not None:
+                    self.special_steps.append(BlankSpecialStep(allocated))
+                return
+            for step in self.special_steps:
+                step.redo_apply(grid)
             return
         for step in self.steps:
             step.redo_apply(grid)
 
-    def add_step(self, step: PaintStep):
+    @classmethod
+    def from_restores(cls, changes: list[tuple[int, int, object, object]]) -> PaintAction:
+        """ Builds an action from (x, y, before, after) tuples, as returned by Grid.replace_layer. """
+        return cls([RestoreStep((x, y), before, after) for x, y, before, after in changes])
+
+    def add_step(self, step: PaintStep|RestoreStep|BulkPaintStep|PasteStep):
         self.steps.append(step)
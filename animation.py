@@ -0,0 +1,133 @@
+"""
+Animated export of a canvas.
+
+Layers such as rainbow and sparkle change with the timestamp. This renders a saved canvas
+at a range of timestamps and streams the frames into an animated GIF, an animated PNG or a raw
+RGB frame stream, writing each frame before the next is rendered.
+
+Animated layers declare how often they repeat (layer_util.periodic), so the canvas repeats every
+least common multiple of the periods in use, give or take a square rounded differently at a float boundary.
+Formats which loop only get one period of frames: a rainbow canvas stepped by 0.5 is 40 frames,
+however long the range asked for.
+
+Usage:
+    python animation.py canvas.spgf -o canvas.gif --stop 20 --step 0.5 --scale 4
+    python animation.py canvas.spgf -o - --stop 60 --step 0.25 | ffmpeg -f rawvideo -pix_fmt rgb24 -s 64x64 -r 20 -i - out.mp4
+"""
+from __future__ import annotations
+import argparse
+import math
+from fractions import Fraction
+from typing import Iterator
+from grid import Grid
+from image_io import open_animation
+from layer_util import get_layers
+
+BG = (255, 255, 255)
+
+def _lcm(a: Fraction, b: Fraction) -> Fraction:
+    """ The least common multiple of two positive fractions. """
+    denominator = math.lcm(a.denominator, b.denominator)
+    return Fraction(math.lcm(a.numerator * (denominator // a.denominator), b.numerator * (denominator // b.denominator)), denominator)
+
+def grid_period(grid: Grid) -> Fraction|None:
+    """
+    Returns how many time units the grid's colours take to repeat: 0 if no animated layer is in use,
+    and None if one in use doesn't declare a period.
+
+    Complexity: O(L)
+    L: The number of layers
+    """
+    period = Fraction(0)
+    for layer in get_layers():
+        if layer is None:
+            break
+        if not layer.animated or not grid.count_cells(layer):
+            continue
+        if layer.period is None:
+            return None
+        period = _lcm(period, layer.period) if period else layer.period
+    return period
+
+def frame_count(start: float, stop: float, step: float, period: Fraction|None=None) -> int:
+    """
+    Returns how many frames of `step` time units cover [start, stop), or just one period of them
+    if `period` is given and a whole number of steps long.
+
+    Complexity: O(1)
+    """
+    count = max(math.ceil((stop - start) / step), 1)
+    if period is None:
+        return count
+    if period == 0:
+        return 1
+    steps = period / Fraction(step).limit_denominator(1 << 20)
+    if steps.denominator == 1 and steps < count:
+        return int(steps)
+    return count
+
+def animation_frames(
+    grid: Grid, start: float, count: int, step: float,
+    bg: tuple[int, int, int]=BG, scale: int=1, region: tuple[int, int, int, int]|None=None,
+) -> Iterator[bytes]:
+    """
+    Yields `count` frames at timestamps start, start + step, ... as packed RGB rows from the top,
+    each square drawn as a `scale` x `scale` block. Each frame is rendered as it is asked for.
+
+    Complexity: O(count * Grid.to_array)
+    """
+    for i in range(count):
+        pixels = grid.to_array(start + i * step, bg, region)
+        if scale != 1:
+            pixels = pixels.repeat(scale, axis=0).repeat(scale, axis=1)
+        yield pixels.tobytes()
+
+def export_animation(
+    grid: Grid, output: str, start: float, stop: float, step: float,
+    bg: tuple[int, int, int]=BG, scale: int=1, fps: int=20,
+    region: tuple[int, int, int, int]|None=None, loop: bool|None=None,
+) -> int:
+    """
+    Renders the grid from `start` up to `stop` every `step` time units, and writes the frames to `output`,
+    chosen by image_io.open_animation, at `fps` frames per second.
+    With `loop` (by default, if the format loops) only one period of a repeating animation is written.
+
+    Returns the number of frames written.
+
+    Complexity: O(f * Grid.to_array)
+    f: The number of frames written
+    """
+    x0, y0, width, height = region if region is not None else (0, 0, grid.x, grid.y)
+    width = max(min(x0 + width, grid.x) - max(x0, 0), 0)
+    height = max(min(y0 + height, grid.y) - max(y0, 0), 0)
+    with open_animation(output, width * scale, height * scale, round(1000 / fps)) as writer:
+        if loop is None:
+            loop = writer.loops
+        count = frame_count(start, stop, step, grid_period(grid) if loop else None)
+        for frame in animation_frames(grid, start, count, step, bg, scale, region):
+            writer.write(frame)
+    return count
+
+def main() -> None:
+    p = argparse.ArgumentParser(description="Export the animation of a saved canvas.")
+    p.add_argument("canvas", help="Canvas saved with Grid.save.")
+    p.add_argument("-o", "--output", default="canvas.gif",
+                   help="Output: .gif, .png/.apng, or anything else (- for standard output) for raw RGB frames.")
+    p.add_argument("--start", type=float, default=0, help="First timestamp.")
+    p.add_argument("--stop", type=float, default=20, help="Timestamp to stop before.")
+    p.add_argument("--step", type=float, default=0.5, help="Time units between frames.")
+    p.add_argument("--scale", type=int, default=1, help="Pixels per grid square.")
+    p.add_argument("--bg", type=int, nargs=3, default=BG, metavar=("R", "G", "B"), help="Background colour.")
+    p.add_argument("--fps", type=int, default=20, help="Frame rate.")
+    p.add_argument("--no-loop", action="store_true", help="Write every frame even if the animation repeats.")
+    args = p.parse_args()
+
+    count = export_animation(
+        Grid.load(args.canvas), args.output, args.start, args.stop, args.step,
+        tuple(args.bg), args.scale, args.fps, loop=False if args.no_loop else None,
+    )
+    if args.output != "-":
+        print(f"Wrote {count} frames.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,294 @@
+"""
+Headless performance benchmarks for the stores, grid, trackers and layers.
+
+Each case is timed over several repeats, and its median seconds per operation is written to a JSON file.
+Given a baseline from an earlier run, every case that got slower by more than the threshold
+is reported as a regression, and the exit code is 1.
+
+Usage:
+    python -m benchmarks.suite --save-baseline            # Record benchmarks/baseline.json on this machine
+    python -m benchmarks.suite -o results.json            # Compare against it later
+    python -m benchmarks.suite --quick --threshold 0.5    # Smaller sizes, fewer repeats
+    python -m benchmarks.suite --filter get_color         # Only cases whose name contains get_color
+
+Timings only compare meaningfully on the same machine, so the baseline isn't shared.
+"""
+from __future__ import annotations
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+from typing import Callable
+
+from action import PaintAction
+from grid import Grid
+from layer_store import AdditiveLayerStore, SequenceLayerStore, SetLayerStore
+from layer_util import get_layers
+from replay import ReplayTracker
+from replay_log import PAINT, REDO, SPECIAL, UNDO, ReplayLogReader, ReplayLogWriter
+from undo import UndoTracker
+
+BASELINE = os.path.join(os.path.dirname(__file__), "baseline.json")
+THRESHOLD = 0.25 # Slowdown, as a fraction of the baseline, counted as a regression
+MIN_SECONDS = 0.05 # Each repeat runs a case at least this long
+LOG_ACTIONS = 10000
+
+def layers() -> list:
+    """ The registered layers, in index order. """
+    return [layer for layer in get_layers() if layer is not None]
+
+def _timed(run: Callable[[], object], reset: Callable[[], object]|None=None) -> Callable[[int], float]:
+    """
+    Returns a case running `run` n times and returning the seconds taken.
+    `reset` runs before each call, outside the timing.
+    """
+    def case(n: int) -> float:
+        total = 0.0
+        for _ in range(n):
+            if reset is not None:
+                reset()
+            start = time.perf_counter()
+            run()
+            total += time.perf_counter() - start
+        return total
+    return case
+
+def measure(case: Callable[[int], float], repeats: int) -> dict:
+    """
+    Times a case, growing the number of calls per repeat until one repeat takes MIN_SECONDS.
+    Returns the median and best seconds per call.
+    """
+    n = 1
+    while True:
+        seconds = case(n)
+        if seconds >= MIN_SECONDS or n >= 1 << 20:
+            break
+        n *= 2 if seconds <= 0 else max(2, min(10, int(MIN_SECONDS / seconds) + 1))
+    samples = [seconds / n] + [case(n) / n for _ in range(repeats - 1)]
+    return {"seconds": statistics.median(samples), "min": min(samples), "calls": n}
+
+# Cases. Each yields (name, setup) pairs. Calling setup builds whatever the case needs and returns the case,
+# so cases left out by --filter build nothing.
+
+def grid_init_cases(quick: bool):
+    sizes = [(16, 16), (64, 64)] if quick else [(32, 32), (128, 128), (1024, 1024)]
+    for style in Grid.DRAW_STYLE_OPTIONS:
+        for x, y in sizes:
+            yield f"grid_init/{style}/{x}x{y}", lambda style=style, x=x, y=y: _timed(lambda: Grid(style, x, y))
+
+def get_color_cases(quick: bool):
+    usable = [layer for layer in layers() if not layer.animated][:SequenceLayerStore.NUMBER_OF_LAYERS]
+    stores = [
+        (SetLayerStore, [1]),
+        (AdditiveLayerStore, [1, 8, 64] if quick else [1, 8, 64, 512]),
+        (SequenceLayerStore, [1, 4, len(usable)]),
+    ]
+    def setup(store_type, depth):
+        store = store_type()
+        for i in range(depth):
+            store.add(usable[i % len(usable)])
+        return _timed(lambda: store.get_color((255, 255, 255), 1.5, 7, 11))
+
+    for store_type, depths in stores:
+        for depth in depths:
+            yield f"get_color/{store_type.__name__}/depth{depth}", lambda store_type=store_type, depth=depth: setup(store_type, depth)
+
+def layer_apply_cases(quick: bool):
+    for layer in layers():
+        yield f"layer_apply/{layer.name}", lambda layer=layer: _timed(lambda: layer.apply((120, 80, 200), 1.5, 7, 11))
+
+def on_paint_cases(quick: bool):
+    try:
+        from main import MyWindow
+    except ImportError as e: # The window needs arcade
+        print(f"Skipping on_paint: {e}", file=sys.stderr)
+        return
+
+    class Painter:
+        """ Enough of a window for MyWindow.on_paint, as in the window tests. """
+        on_init = MyWindow.on_init
+        on_paint = MyWindow.on_paint
+
+    size = 64 if quick else 256
+    red = next(layer for layer in layers() if layer.name == "red")
+
+    def setup(style, brush):
+        painter = Painter()
+        painter.grid = Grid(style, size, size)
+        painter.grid.brush_size = brush
+        painter.on_init()
+        rng = random.Random(brush)
+        return _timed(lambda: painter.on_paint(red, rng.randrange(size), rng.randrange(size)))
+
+    for style in Grid.DRAW_STYLE_OPTIONS:
+        for brush in range(Grid.MIN_BRUSH, Grid.MAX_BRUSH + 1):
+            yield f"on_paint/{style}/brush{brush}", lambda style=style, brush=brush: setup(style, brush)
+
+def _painted_grid(style: str, size: int, strokes: int, seed: int=0) -> Grid:
+    """ A grid with `strokes` random brush strokes of random layers. """
+    rng = random.Random(seed)
+    grid = Grid(style, size, size)
+    for _ in range(strokes):
+        grid.stroke([(rng.randrange(size), rng.randrange(size))], rng.randint(0, Grid.MAX_BRUSH), rng.choice(layers()))
+    return grid
+
+def special_cases(quick: bool):
+    size = 32 if quick else 128
+
+    def setup(style):
+        grid = _painted_grid(style, size, size * size // 8)
+        state = grid.snapshot()
+        return _timed(grid.special, lambda: grid.restore(state))
+
+    for style in Grid.DRAW_STYLE_OPTIONS:
+        yield f"special/{style}/{size}x{size}", lambda style=style: setup(style)
+
+def undo_redo_cases(quick: bool):
+    size, actions = (32, 200) if quick else (64, 1000)
+
+    def setup(style):
+        rng = random.Random(1)
+        grid = Grid(style, size, size)
+        tracker = UndoTracker()
+        for _ in range(actions):
+            tracker.add_action(grid.stroke([(rng.randrange(size), rng.randrange(size))], 2, rng.choice(layers())))
+
+        def undo_redo():
+            while tracker.undo(grid) is not None:
+                pass
+            while tracker.redo(grid) is not None:
+                pass
+        return _timed(undo_redo)
+
+    for style in Grid.DRAW_STYLE_OPTIONS:
+        yield f"undo_redo/{style}/{actions}_actions", lambda style=style: setup(style)
+
+def generate_log(path: str, draw_style: str, size: int, actions: int, seed: int=0) -> None:
+    """
+    Writes a replay log of `actions` random paints, undos, redos and specials, recorded from a real session.
+
+    Complexity: O(actions * stroke)
+    """
+    rng = random.Random(seed)
+    grid = Grid(draw_style, size, size)
+    tracker = UndoTracker()
+    log = ReplayLogWriter(path, draw_style, size, size)
+    for _ in range(actions):
+        roll = rng.random()
+        if roll < 0.1 and (action := tracker.undo(grid)) is not None:
+            log.write(UNDO, action)
+        elif roll < 0.15 and (action := tracker.redo(grid)) is not None:
+            log.write(REDO, action)
+        elif roll < 0.16:
+            action = PaintAction(is_special=True)
+            action.redo_apply(grid) # As MyWindow.on_special does
+            tracker.add_action(action)
+            log.write(SPECIAL, action)
+        else:
+            action = grid.stroke([(rng.randrange(size), rng.randrange(size))], rng.randint(0, Grid.MAX_BRUSH), rng.choice(layers()))
+            tracker.add_action(action)
+            log.write(PAINT, action)
+    log.close()
+
+def replay_cases(quick: bool):
+    size, actions = (32, 1000) if quick else (64, LOG_ACTIONS)
+
+    def setup(folder, style):
+        path = os.path.join(folder, f"{style}.sprl")
+        generate_log(path, style, size, actions)
+
+        def replay():
+            log = ReplayLogReader(path)
+            grid = log.make_grid()
+            tracker = ReplayTracker()
+            tracker.add_source(log)
+            while not tracker.play_next_action(grid):
+                pass
+        return _timed(replay)
+
+    # The logs are removed once every case here has been run, or the run stops
+    with tempfile.TemporaryDirectory() as folder:
+        for style in Grid.DRAW_STYLE_OPTIONS:
+            yield f"replay/{style}/{actions}_actions", lambda style=style: setup(folder, style)
+
+CASES = (
+    grid_init_cases, get_color_cases, layer_apply_cases, on_paint_cases,
+    special_cases, undo_redo_cases, replay_cases,
+)
+
+def run(quick: bool=False, repeats: int=5, name_filter: str="") -> dict:
+    """
+    Runs every case whose name contains `name_filter`, and returns the results by case name.
+    Cases left out aren't set up.
+    """
+    results = {}
+    for cases in CASES:
+        for name, setup in cases(quick):
+            if name_filter not in name:
+                continue
+            results[name] = measure(setup(), repeats)
+            print(f"{name:45} {results[name]['seconds'] * 1e6:12.2f} us", file=sys.stderr)
+    return results
+
+def compare(results: dict, baseline: dict, threshold: float=THRESHOLD) -> list[tuple[str, float]]:
+    """
+    Returns (case name, new time / baseline time) for each case in both that got slower than `threshold` allows,
+    worst first.
+    """
+    regressions = []
+    for name, result in results.items():
+        before = baseline.get(name)
+        if before is None or before["seconds"] <= 0:
+            continue
+        ratio = result["seconds"] / before["seconds"]
+        if ratio > 1 + threshold:
+            regressions.append((name, ratio))
+    return sorted(regressions, key=lambda regression: -regression[1])
+
+def main() -> None:
+    p = argparse.ArgumentParser(description="Benchmark the stores, grid, trackers and layers.")
+    p.add_argument("-o", "--output", default="bench_output.json", help="Where to write the results.")
+    p.add_argument("--baseline", default=BASELINE, help="Results to compare against.")
+    p.add_argument("--save-baseline", action="store_true", help="Write the results to the baseline too.")
+    p.add_argument("--threshold", type=float, default=THRESHOLD,
+                   help="Slowdown counted as a regression, as a fraction (0.25 is 25%% slower).")
+    p.add_argument("--quick", action="store_true", help="Smaller sizes and fewer repeats.")
+    p.add_argument("--repeats", type=int, help="Timed repeats per case (default 5, or 3 with --quick).")
+    p.add_argument("--filter", default="", help="Only run cases whose name contains this.")
+    args = p.parse_args()
+
+    results = run(args.quick, args.repeats or (3 if args.quick else 5), args.filter)
+    report = {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "quick": args.quick,
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        return
+
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}; run with --save-baseline to record one.")
+        return
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline.get("quick") != args.quick:
+        print("The baseline was recorded with a different --quick setting; sizes differ.")
+    regressions = compare(results, baseline["results"], args.threshold)
+    for name, ratio in regressions:
+        print(f"REGRESSION {name}: {ratio:.2f}x the baseline")
+    print(f"{len(regressions)} of {len(results)} cases regressed by more than {args.threshold:.0%}.")
+    if regressions:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
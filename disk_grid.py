@@ -0,0 +1,396 @@
+"""
+A tiled grid whose squares live in memory-mapped files, for canvases larger than RAM.
+
+Nothing about a square is kept in Python objects: its layer stack is in an arena file,
+and a fixed size record in an index file says where. The OS pages both in as tiles are painted and drawn.
+Grid code keeps working because tiles hand out MappedStores, lightweight LayerStore views of one record.
+
+The grid's hash and its layer index are on disk too, so opening a canvas only reads the tile bitmap.
+Instead of Grid.layer_cells, the index file counts the squares using each layer, in the grid and in each tile:
+count_cells reads a count, and cells_with reads the masks of the records in the tiles using the layer.
+
+Index file layout (little endian):
+- Header: MAGIC, FORMAT_VERSION, x, y, draw style index into Grid.DRAW_STYLE_OPTIONS, tile size, arena bytes used,
+  grid hash (Grid.state_hash)
+- Layer counts: a uint64 per layer index up to LAYER_SLOTS, the squares using that layer
+- Tile bitmap: one byte per tile, 1 if allocated, tiles numbered tx * tiles down + ty
+- Tile layer counts: LAYER_SLOTS uint16s per tile, the squares of that tile using each layer
+- Records: RECORD per square, Grid.TILE_SIZE^2 per tile in tile order, in Tile.stores order within a tile.
+  A record holds where the square's stack is in the arena, LayerStore.mask, LayerStore.hash,
+  the stack's length and the room it has, and shared_grid.SQUARE_SPECIAL if a set store's special is on.
+
+The arena file (the index path plus ARENA_SUFFIX) holds stacks as in shared_grid.flatten.
+A stack that outgrows its room moves to the end of the arena with twice the room, which grows the file.
+Both files start sparse, so untouched tiles take no disk space either.
+"""
+from __future__ import annotations
+import mmap
+import struct
+import sys
+from array import array
+from grid import Grid
+from layer_store import LayerStore
+from layer_util import LAYERS, Layer, get_layers
+from layers import invert
+from shared_grid import SQUARE_SPECIAL, flatten, unflatten
+import zobrist
+
+MAGIC = b"SPDG"
+FORMAT_VERSION = 2
+ARENA_SUFFIX = ".arena"
+ARENA_CAPACITY = 1 << 20 # Bytes the arena file starts with
+LAYER_SLOTS = 32 # Layer indices counted, at least as many as layer_util.LAYERS has room for
+assert LAYER_SLOTS >= len(LAYERS)
+
+HEADER = struct.Struct("<4sIIIIIQQ")
+ARENA_USED_OFFSET = 24 # Of the arena bytes used in the header
+GRID_HASH_OFFSET = 32
+COUNT = struct.Struct("<Q")
+TILE_COUNT = struct.Struct("<H")
+RECORD = struct.Struct("<QQQHHB3x") # offset, mask, hash, length, room, flags; 32 bytes, so masks line up as uint64s
+STACK = struct.Struct("<Q16xHHB") # offset, length, room, flags
+MASK = struct.Struct("<8xQ")
+HASH = struct.Struct("<16xQ")
+
+def _align(n: int) -> int:
+    """ Rounds n up to a multiple of 8. """
+    return (n + 7) & ~7
+
+
+class MappedStore(LayerStore):
+    """
+    A view of one square of a DiskGrid, made on demand and holding nothing but where the square's record is.
+    Reads come straight from the mapped files. Changes restore the stack into the grid's scratch store,
+    apply the change there, and write the result back, so every store type keeps its exact behaviour.
+    """
+
+    def __init__(self, grid: DiskGrid, record: int, x: int, y: int) -> None:
+        self.grid = grid
+        self.record = record
+        self.key = zobrist.cell_key(x, y)
+        self.position = (x, y)
+        self.observer = grid
+
+    @property
+    def hash(self) -> int:
+        return HASH.unpack_from(self.grid.index, self.record)[0]
+
+    @property
+    def mask(self) -> int:
+        return MASK.unpack_from(self.grid.index, self.record)[0]
+
+    def get_color(self, start, timestamp, x, y) -> tuple[int, int, int]:
+        """
+        Applies the layers of the stack in order, as every store type would.
+
+        Complexity: O(n . apply)
+        n: The number of layers in the stack
+        """
+        stack, flags = self.grid.read_stack(self.record)
+        layers = get_layers()
+        color = start
+        for index in stack:
+            color = layers[index].apply(color, timestamp, x, y)
+        if flags & SQUARE_SPECIAL:
+            color = invert.apply(color, timestamp, x, y)
+        return color
+
+    def snapshot(self):
+        """
+        Complexity: O(n)
+        n: The number of layers in the stack
+        """
+        return unflatten(self.grid.draw_style, *self.grid.read_stack(self.record))
+
+    def restore(self, state) -> None:
+        """
+        Complexity: O(n)
+        n: The number of layers in the state
+        """
+        self._edit(type(self.grid.scratch).restore, state)
+
+    def add(self, layer: Layer) -> bool:
+        return self._edit(type(self.grid.scratch).add, layer)
+
+    def erase(self, layer: Layer) -> bool:
+        return self._edit(type(self.grid.scratch).erase, layer)
+
+    def special(self) -> bool|Layer:
+        return self._edit(type(self.grid.scratch).special)
+
+    def replace_layer(self, old: Layer, new: Layer|None) -> bool:
+        return self._edit(type(self.grid.scratch).replace_layer, old, new)
+
+    def clone(self) -> LayerStore:
+        """
+        Returns an in-memory store with the same layers.
+
+        Complexity: O(restore)
+        """
+        copy = self.grid.layer_store_type()
+        copy.restore(self.snapshot())
+        return copy
+
+    def _edit(self, method, *args):
+        """
+        Runs a store method on the scratch store holding this square's state, and writes back what changed.
+
+        Complexity: O(n + method)
+        n: The number of layers in the stack
+        """
+        scratch = self.grid.scratch
+        scratch.restore(self.snapshot())
+        old_hash, old_mask = scratch.hash, scratch.mask
+        result = method(scratch, *args)
+        if scratch.hash != old_hash or scratch.mask != old_mask:
+            self.grid.write_stack(self.record, *flatten(scratch.snapshot()), scratch.hash, scratch.mask)
+            self._changed(old_hash, old_mask)
+        return result
+
+
+class MappedTile:
+    """
+    An allocated tile of a DiskGrid. It is its own `stores`, making a MappedStore for square i when indexed,
+    so allocating a tile costs nothing and squares not looked at have no objects.
+    """
+
+    def __init__(self, grid: DiskGrid, tx: int, ty: int) -> None:
+        self.grid = grid
+        self.x0 = tx * Grid.TILE_SIZE
+        self.y0 = ty * Grid.TILE_SIZE
+        self.width = min(Grid.TILE_SIZE, grid.x - self.x0)
+        self.height = min(Grid.TILE_SIZE, grid.y - self.y0)
+        grid.edits += 1
+        self.version = grid.edits # As Tile.version
+        self.number = tx * grid.tiles_y + ty
+        self.first = grid.records_start + self.number * Grid.TILE_SIZE ** 2 * RECORD.size
+        self.stores = self
+
+    def __len__(self) -> int:
+        return self.width * self.height
+
+    def __getitem__(self, i: int) -> MappedStore:
+        return MappedStore(self.grid, self.first + i * RECORD.size, self.x0 + i // self.height, self.y0 + i % self.height)
+
+
+class DiskGrid(Grid):
+    """
+    A tiled grid stored in an index file at `path` and an arena file next to it.
+    Create a new canvas with DiskGrid(draw_style, x, y, path), and reopen it later with DiskGrid.open(path).
+    Call `flush` to make sure changes are on disk and `close` when done.
+    """
+
+    SPECIAL_VIA_BLANK = False # Unallocated tiles read back empty when reopened, so special allocates them
+
+    def __init__(self, draw_style, x, y, path: str, create: bool=True, arena_capacity: int=ARENA_CAPACITY) -> None:
+        """
+        Creates the canvas files at `path`, overwriting any there, or maps the existing ones if not `create`.
+
+        Complexity: O(1) to create, O(open) otherwise
+        """
+        super().__init__(draw_style, x, y, tiled=True)
+        self.path = path
+        self.tiles_y = -(-y // self.TILE_SIZE)
+        tile_count = -(-x // self.TILE_SIZE) * self.tiles_y
+        self.counts_start = _align(HEADER.size)
+        self.bitmap_start = self.counts_start + LAYER_SLOTS * COUNT.size
+        self.tile_counts_start = _align(self.bitmap_start + tile_count)
+        self.records_start = _align(self.tile_counts_start + tile_count * LAYER_SLOTS * TILE_COUNT.size)
+        self.scratch = self.layer_store_type() # Where MappedStores make their changes, never attached to a grid
+        if create:
+            with open(path, "wb") as f:
+                f.truncate(self.records_start + tile_count * self.TILE_SIZE ** 2 * RECORD.size)
+            with open(path + ARENA_SUFFIX, "wb") as f:
+                f.truncate(arena_capacity)
+        # mmap keeps its own handle to each file, so they can be closed straight away
+        with open(path, "r+b") as f:
+            self.index = mmap.mmap(f.fileno(), 0)
+        with open(path + ARENA_SUFFIX, "r+b") as f:
+            self.arena = mmap.mmap(f.fileno(), 0)
+        if create:
+            HEADER.pack_into(
+                self.index, 0, MAGIC, FORMAT_VERSION, x, y, self.DRAW_STYLE_OPTIONS.index(draw_style), self.TILE_SIZE, 0, 0,
+            )
+            self.arena_used = 0
+        else:
+            self.arena_used, self.hash = HEADER.unpack_from(self.index, 0)[6:]
+            self._scan()
+
+    @classmethod
+    def open(cls, path: str) -> DiskGrid:
+        """
+        Maps the canvas saved at `path`.
+        :raises ValueError: if it isn't a canvas this version can read
+
+        Complexity: O(T)
+        T: The number of tiles in the grid
+        """
+        with open(path, "rb") as f:
+            header = f.read(HEADER.size)
+        if len(header) < HEADER.size:
+            raise ValueError(f"{path} is not a disk canvas")
+        magic, version, x, y, style, tile_size, _, _ = HEADER.unpack(header)
+        if magic != MAGIC or version != FORMAT_VERSION or tile_size != cls.TILE_SIZE:
+            raise ValueError(f"{path} is not a disk canvas this version can read")
+        return cls(cls.DRAW_STYLE_OPTIONS[style], x, y, path, create=False)
+
+    def _scan(self) -> None:
+        """
+        Makes a MappedTile for every allocated tile in the tile bitmap. Squares aren't read.
+
+        Complexity: O(T)
+        T: The number of tiles in the grid
+        """
+        bitmap = self.index[self.bitmap_start:self.tile_counts_start]
+        number = bitmap.find(1)
+        while number != -1:
+            key = divmod(number, self.tiles_y)
+            self.tiles[key] = MappedTile(self, *key)
+            number = bitmap.find(1, number + 1)
+
+    def _new_tile(self, key: tuple[int, int]) -> MappedTile:
+        """
+        Complexity: O(1)
+        """
+        tile = self.tiles[key] = MappedTile(self, *key)
+        self.index[self.bitmap_start + tile.number] = 1
+        self.dirty_tiles.add(key)
+        return tile
+
+    def _free_tile(self, key: tuple[int, int]) -> None:
+        """
+        Complexity: O(1)
+        """
+        self.index[self.bitmap_start + self.tiles[key].number] = 0
+        super()._free_tile(key)
+
+    def store_changed(self, store: LayerStore, old_hash: int, old_mask: int) -> None:
+        """
+        Also writes the new grid hash to the header.
+
+        Complexity: O(Grid.store_changed)
+        """
+        super().store_changed(store, old_hash, old_mask)
+        COUNT.pack_into(self.index, GRID_HASH_OFFSET, self.hash)
+
+    def _index_layers(self, position: tuple[int, int], old_mask: int, new_mask: int) -> None:
+        """
+        Updates the grid's and the square's tile's counts of the layers added or removed.
+
+        Complexity: O(L)
+        L: The number of layers which were added to or removed from the square
+        """
+        tile = (position[0] // self.TILE_SIZE) * self.tiles_y + position[1] // self.TILE_SIZE
+        tile_counts = self.tile_counts_start + tile * LAYER_SLOTS * TILE_COUNT.size
+        changed = old_mask ^ new_mask
+        index = 0
+        while changed:
+            if changed & 1:
+                step = 1 if new_mask >> index & 1 else -1
+                offset = self.counts_start + index * COUNT.size
+                COUNT.pack_into(self.index, offset, COUNT.unpack_from(self.index, offset)[0] + step)
+                offset = tile_counts + index * TILE_COUNT.size
+                TILE_COUNT.pack_into(self.index, offset, TILE_COUNT.unpack_from(self.index, offset)[0] + step)
+            changed >>= 1
+            index += 1
+
+    def _index_many(self, positions: list[tuple[int, int]], old_mask: int, new_mask: int) -> None:
+        """
+        Complexity: O(L . p)
+        L: The number of layers added or removed
+        p: The number of positions
+        """
+        for position in positions:
+            self._index_layers(position, old_mask, new_mask)
+
+    def _end_batch(self, batch: dict) -> None:
+        """
+        Also writes the new grid hash to the header.
+
+        Complexity: O(Grid._end_batch)
+        """
+        super()._end_batch(batch)
+        COUNT.pack_into(self.index, GRID_HASH_OFFSET, self.hash)
+
+    def cells_with(self, layer: Layer) -> set[tuple[int, int]]:
+        """
+        Returns the squares whose store contains `layer`, read from the record masks of the tiles using it.
+        Unlike Grid.cells_with, the set is made on each call and not kept up to date.
+
+        Complexity: O(T + k)
+        T: The number of allocated tiles
+        k: The number of squares in the tiles using the layer
+        """
+        cells = set()
+        bit = 1 << layer.index
+        for tile in self.tiles.values():
+            offset = self.tile_counts_start + (tile.number * LAYER_SLOTS + layer.index) * TILE_COUNT.size
+            if not TILE_COUNT.unpack_from(self.index, offset)[0]:
+                continue
+            records = array("Q", self.index[tile.first:tile.first + len(tile) * RECORD.size]) # 4 uint64s each
+            if sys.byteorder == "big":
+                records.byteswap()
+            for i, mask in enumerate(records[1::4]):
+                if mask & bit:
+                    cells.add((tile.x0 + i // tile.height, tile.y0 + i % tile.height))
+        return cells
+
+    def count_cells(self, layer: Layer) -> int:
+        """
+        Complexity: O(1)
+        """
+        return COUNT.unpack_from(self.index, self.counts_start + layer.index * COUNT.size)[0]
+
+    def read_stack(self, record: int) -> tuple[bytes, int]:
+        """
+        Returns the layer stack and square flags of the square whose record starts at `record`.
+
+        Complexity: O(n)
+        n: The number of layers in the stack
+        """
+        offset, length, _, flags = STACK.unpack_from(self.index, record)
+        return self.arena[offset:offset + length], flags
+
+    def write_stack(self, record: int, stack: bytes, flags: int, store_hash: int, mask: int) -> None:
+        """
+        Writes a square's new stack and record, moving the stack to the end of the arena if it outgrew its room.
+
+        Complexity: O(n), amortised over the arena growing
+        n: The number of layers in the stack
+        """
+        offset, _, room, _ = STACK.unpack_from(self.index, record)
+        if len(stack) > room:
+            room = max(len(stack), 2 * room, 4)
+            offset = self._allocate(room)
+        self.arena[offset:offset + len(stack)] = stack
+        RECORD.pack_into(self.index, record, offset, mask, store_hash, len(stack), room, flags)
+
+    def _allocate(self, size: int) -> int:
+        """
+        Returns where `size` new bytes at the end of the arena start, doubling the arena file if it is full.
+
+        Complexity: O(1) amortised
+        """
+        if self.arena_used + size > len(self.arena):
+            self.arena.resize(max(2 * len(self.arena), self.arena_used + size))
+        offset = self.arena_used
+        self.arena_used += size
+        struct.pack_into("<Q", self.index, ARENA_USED_OFFSET, self.arena_used)
+        return offset
+
+    def flush(self) -> None:
+        """ Writes every change back to the files. """
+        self.arena.flush()
+        self.index.flush()
+
+    def close(self) -> None:
+        """ Flushes and unmaps the files. The grid can't be used afterwards. """
+        self.flush()
+        self.arena.close()
+        self.index.close()
+
+    def __enter__(self) -> DiskGrid:
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
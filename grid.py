@@ -1,7 +1,67 @@
 from __future__ import annotations
+from array import array
+from contextlib import contextmanager
 from data_structures.referential_array import ArrayR
 from layer_util import *
 from layer_store import *
+import zobrist
+from profiler import profiler
+
+class Tile:
+    """
+    A block of up to TILE_SIZE x TILE_SIZE squares of a tiled grid, allocated the first time one of its squares is used.
+    Stores are kept column by column in one ArrayR.
+    """
+
+    def __init__(self, grid: Grid, tx: int, ty: int) -> None:
+        """
+        Creates an empty store for every square of the tile at tile coordinates (tx, ty).
+
+        Complexity: O(t^2)
+        t: Grid.TILE_SIZE
+        """
+        self.x0 = tx * Grid.TILE_SIZE
+        self.y0 = ty * Grid.TILE_SIZE
+        self.width = min(Grid.TILE_SIZE, grid.x - self.x0)
+        self.height = min(Grid.TILE_SIZE, grid.y - self.y0)
+        grid.edits += 1
+        self.version = grid.edits # Moved on whenever a square of the tile changes, see Grid.snapshot
+        self.stores = ArrayR(self.width * self.height)
+        blank = grid.blank.snapshot() if grid.blank.hash else None # Its squares start as they looked unallocated
+        for i in range(self.width):
+            for j in range(self.height):
+                self.stores[i * self.height + j] = grid._new_store(self.x0 + i, self.y0 + j, blank)
+
+
+class TiledColumn:
+    """
+    Column x of a tiled grid, so that grid[x][y] works the same as on an untiled grid.
+    Reading a square allocates its tile; use Grid.peek to read without allocating.
+    """
+
+    def __init__(self, grid: Grid, x: int) -> None:
+        self.grid = grid
+        self.x = x
+
+    def __len__(self) -> int:
+        return self.grid.y
+
+    def __getitem__(self, y: int) -> LayerStore:
+        return self.grid.store_at(self.x, y)
+
+
+class TiledColumns:
+    """ Stands in for the outer ArrayR of an untiled grid, handing out TiledColumns. """
+
+    def __init__(self, grid: Grid) -> None:
+        self.grid = grid
+
+    def __len__(self) -> int:
+        return self.grid.x
+
+    def __getitem__(self, x: int) -> TiledColumn:
+        return TiledColumn(self.grid, x)
+
 
 class Grid:
     DRAW_STYLE_SET = "SET"
@@ -13,11 +73,20 @@ class Grid:
         DRAW_STYLE_SEQUENCE
     )
 
+    OP_ADD = "ADD"
+    OP_ERASE = "ERASE"
+
+    # Grids with at least this many squares are tiled unless told otherwise
+    LARGE_CANVAS_SQUARES = 256 * 256
+    TILE_SIZE = 32
+    # Whether special reaches the unallocated tiles of a tiled grid by changing self.blank, instead of allocating them
+    SPECIAL_VIA_BLANK = True
+
     DEFAULT_BRUSH_SIZE = 2
     MAX_BRUSH = 5
     MIN_BRUSH = 0
 
-    def __init__(self, draw_style, x, y) -> None:
+    def __init__(self, draw_style, x, y, tiled: bool|None=None) -> None:
         """
         Initialise the grid object.
         - draw_style:
@@ -25,10 +94,12 @@ class Grid:
             Should be one of DRAW_STYLE_OPTIONS
             This draw style determines the LayerStore used on each grid square.
         - x, y: The dimensions of the grid.
+        - tiled: Whether to store squares in TILE_SIZE x TILE_SIZE tiles, allocated when first used.
+            By default, grids of LARGE_CANVAS_SQUARES or more are tiled.
 
         Should also intialise the brush size to the DEFAULT provided as a class variable.
 
-        Complexity: O(n + nm)
+        Complexity: O(n + nm), O(1) when tiled
         n: The horizontal length of the grid, self.x
         m: The vertical length of the grid, self.y   
         """
@@ -40,13 +111,150 @@ class Grid:
         elif self.draw_style == self.DRAW_STYLE_OPTIONS[2]:
             layer_store_type = SequenceLayerStore
 
-        self.grid = ArrayR(x) # O(n), initialise a referential array with the size of x
-        for i in range(len(self.grid)): # O(n), For each index in self.grid, instantiate a referential array with size of y
-            self.grid[i] = ArrayR(y) # O(m)
-            for j in range(len(self.grid[i])): # O(m), For each index in the newly instantiated referential array, instantiate a layer store based on the draw style we chose
-                self.grid[i][j] = layer_store_type()
+        self.layer_store_type = layer_store_type
+        self.x = x
+        self.y = y
+        self.hash = 0 # XOR of every square's zobrist.cell_hash, kept up to date by store_changed
+        self.edits = 0 # Tiles allocated plus square changes, which tile versions are stamped from
+        self.layer_cells: dict[int, set[tuple[int, int]]] = {} # Layer index -> squares using that layer
+        self.unloaded: dict[tuple[int, int], Tile] = {} # Tiles of a loaded canvas not read from its file yet, see Grid.load
+        self.watchers: list[set[tuple[int, int]]] = [] # Sets collecting changed squares, from watch()
+        self.batch: dict|None = None # Inside batched(): store -> (old hash, old mask) of each square changed
+        self.blank = layer_store_type() # What every square not used yet holds. Only replaced by _set_blank.
+        # Whether special changes an empty square, in which case it has to reach every tile
+        self.special_changes_blank = bool(layer_store_type().special())
+        self.blank_hashes: dict[tuple[tuple[int, int], int], int] = {} # (tile key, store hash) -> _blank_tile_hash
+        if tiled is None:
+            tiled = x * y >= self.LARGE_CANVAS_SQUARES
+        if tiled:
+            self.tiles: dict[tuple[int, int], Tile]|None = {} # (tx, ty) -> tile, for allocated tiles only
+            self.dirty_tiles: set[tuple[int, int]] = set() # Tiles changed since take_dirty_tiles was last called
+            self.grid = TiledColumns(self)
+        else:
+            self.tiles = None
+            self.grid = ArrayR(x) # O(n), initialise a referential array with the size of x
+            for i in range(len(self.grid)): # O(n), For each index in self.grid, instantiate a referential array with size of y
+                self.grid[i] = ArrayR(y) # O(m)
+                for j in range(len(self.grid[i])): # O(m), For each index in the newly instantiated referential array, instantiate a layer store based on the draw style we chose
+                    self.grid[i][j] = self._new_store(i, j)
         self.brush_size = self.DEFAULT_BRUSH_SIZE
 
+    def _new_store(self, x: int, y: int, state=None) -> LayerStore:
+        """
+        Creates the store for square (x, y), empty or holding snapshot `state`, reporting its later changes to this grid.
+
+        complexity: O(1), O(restore) with a state
+        """
+        store = self.layer_store_type()
+        if state is not None:
+            store.restore(state) # Before it has an observer, as the grid already counts it
+        store.key = zobrist.cell_key(x, y)
+        store.position = (x, y)
+        store.observer = self
+        return store
+
+    def store_at(self, x: int, y: int) -> LayerStore:
+        """
+        Returns the store of square (x, y), allocating its tile first if the grid is tiled.
+
+        complexity: O(1), O(t^2) when a tile is allocated
+        t: TILE_SIZE
+        """
+        if self.tiles is None:
+            return self.grid[x][y]
+        key = (x // self.TILE_SIZE, y // self.TILE_SIZE)
+        tile = self.tiles.get(key)
+        if tile is None:
+            tile = self._new_tile(key)
+        return tile.stores[(x - tile.x0) * tile.height + (y - tile.y0)]
+
+    def _new_tile(self, key: tuple[int, int]) -> Tile:
+        """
+        Allocates the tile with tile coordinates `key` of a tiled grid.
+
+        complexity: O(t^2)
+        t: TILE_SIZE
+        """
+        tile = self.tiles[key] = Tile(self, *key)
+        self.dirty_tiles.add(key)
+        return tile
+
+    def _free_tile(self, key: tuple[int, int]) -> None:
+        """
+        Frees an allocated tile of a tiled grid, whose squares have been emptied.
+
+        complexity: O(1)
+        """
+        del self.tiles[key]
+        self.dirty_tiles.add(key)
+
+    def peek(self, x: int, y: int) -> LayerStore:
+        """
+        Returns the store of square (x, y) for reading only. Squares of tiles not allocated yet
+        all share self.blank, so nothing is allocated.
+
+        complexity: O(1)
+        """
+        if self.tiles is None:
+            return self.grid[x][y]
+        tile = self.tiles.get((x // self.TILE_SIZE, y // self.TILE_SIZE))
+        if tile is None:
+            return self.blank
+        return tile.stores[(x - tile.x0) * tile.height + (y - tile.y0)]
+
+    def squares(self, allocate: bool=False):
+        """
+        Yields (x, y, store) for every square, or for a tiled grid, every square of an allocated tile.
+        With `allocate`, every tile of a tiled grid is allocated first.
+
+        complexity: O(nm) untiled, O(k) tiled
+        k: the number of squares in allocated tiles
+        """
+        if self.tiles is None:
+            for x in range(self.x):
+                column = self.grid[x]
+                for y in range(self.y):
+                    yield x, y, column[y]
+            return
+        if allocate:
+            for tx in range(-(-self.x // self.TILE_SIZE)):
+                for ty in range(-(-self.y // self.TILE_SIZE)):
+                    self.store_at(tx * self.TILE_SIZE, ty * self.TILE_SIZE)
+        for tile in list(self.tiles.values()):
+            for i in range(tile.width):
+                for j in range(tile.height):
+                    yield tile.x0 + i, tile.y0 + j, tile.stores[i * tile.height + j]
+
+    def watch(self) -> set[tuple[int, int]]:
+        """
+        Returns a set which from now on collects every square that changes, until passed to `unwatch`.
+        The caller empties it as it deals with the changes.
+
+        complexity: O(1)
+        """
+        changes = set()
+        self.watchers.append(changes)
+        return changes
+
+    def unwatch(self, changes: set[tuple[int, int]]) -> None:
+        """
+        Stops collecting changes into a set returned by `watch`.
+
+        complexity: O(w)
+        w: the number of watchers
+        """
+        self.watchers = [watcher for watcher in self.watchers if watcher is not changes]
+
+    def take_dirty_tiles(self) -> set[tuple[int, int]]:
+        """
+        Returns the tiles of a tiled grid which were allocated, freed or changed since the last call, and forgets them.
+
+        complexity: O(1)
+        """
+        dirty = self.dirty_tiles
+        self.dirty_tiles = set()
+        return dirty
+
     def increase_brush_size(self):
         """
         Increases the size of the brush by 1,
@@ -69,19 +277,612 @@ class Grid:
         if self.brush_size > self.MIN_BRUSH:
             self.brush_size -= 1
 
-    def special(self):
+    @profiler.timed("Grid.special")
+    def special(self) -> tuple[list[tuple[int, int, Layer|None]], tuple[tuple[int, int], ...]|None]:
         """
         Activate the special affect on all grid squares.
 
-        complexity: O(nm * special)
+        Returns the squares that changed as (x, y, removed layer) tuples,
+        where the removed layer is None for stores whose special undoes itself when run again,
+        and the keys of the allocated tiles if special reached the others through self.blank, or None.
+        This is enough to undo or redo the special on just those squares, with `special_outside` for the rest.
+
+        complexity: O(nm * special), O(k * special + T) tiled
         n: the length of the X axis / outer Array
         m: the length of the Y axis / inner Array
+        k: the number of squares in allocated tiles
+        T: the number of tiles
         Special because the time complexity of the special function differs depending on the type of layer store
         """
-        for x in range(len(self.grid)): # Apply the special effect for every layerstore in the grid
-            for y in range(len(self.grid)):
-                self.grid[x][y].special()
-    
+        changed = []
+        via_blank = self.tiles is not None and self.special_changes_blank and self.SPECIAL_VIA_BLANK
+        # Apply the special effect for every layerstore in the grid. Empty squares are only visited if special changes them.
+        for x, y, store in self.squares(allocate=self.special_changes_blank and not via_blank):
+            result = store.special()
+            if result is True:
+                changed.append((x, y, None))
+            elif result:
+                changed.append((x, y, result))
+        if not via_blank:
+            return changed, None
+        allocated = tuple(self.tiles)
+        self._special_blank()
+        return changed, allocated
+
+    def special_outside(self, allocated) -> None:
+        """
+        Runs special on every square outside the tiles with keys in `allocated`, as returned by `special`:
+        the squares a special reached through self.blank, including those of tiles allocated since.
+        Only used for stores whose special undoes itself, so this both undoes and redoes it.
+
+        complexity: O(k * special + T), or O(nm * special) if the grid isn't tiled the same way
+        k: the number of squares in tiles allocated since the special
+        T: the number of tiles
+        """
+        allocated = set(allocated)
+        size = self.TILE_SIZE
+        if self.tiles is None or not self.SPECIAL_VIA_BLANK:
+            for x, y, store in self.squares(allocate=True):
+                if (x // size, y // size) not in allocated:
+                    store.special()
+            return
+        for key, tile in list(self.tiles.items()):
+            if key not in allocated:
+                for i in range(len(tile.stores)):
+                    tile.stores[i].special()
+        self._special_blank()
+
+    def _special_blank(self) -> None:
+        """
+        Runs special on what the squares of unallocated tiles hold.
+
+        complexity: O(_set_blank)
+        """
+        blank = self.blank.clone()
+        blank.special()
+        self._set_blank(blank.snapshot())
+
+    def _set_blank(self, state) -> None:
+        """
+        Makes the squares of unallocated tiles hold snapshot `state`, which has no layers, like special on an empty store.
+        The grid hash takes in every one of those squares and watchers are told about them,
+        but only the hash of each tile, once per state, has to be worked out square by square.
+
+        complexity: O(T), plus O(t^2) per tile the first time its squares hold each state,
+        and O(u) if there are watchers
+        T: the number of tiles
+        t: TILE_SIZE
+        u: the number of squares in unallocated tiles
+        """
+        blank = self.layer_store_type()
+        blank.restore(state)
+        old_hash = self.blank.hash
+        self.blank = blank
+        if blank.hash == old_hash:
+            return
+        size = self.TILE_SIZE
+        keys = [
+            (tx, ty) for tx in range(-(-self.x // size)) for ty in range(-(-self.y // size))
+            if (tx, ty) not in self.tiles
+        ]
+        for key in keys:
+            self.hash ^= self._blank_tile_hash(key, old_hash) ^ self._blank_tile_hash(key, blank.hash)
+        for changes in self.watchers:
+            for tx, ty in keys:
+                changes.update((x, y) for x in range(tx * size, min(tx * size + size, self.x)) for y in range(ty * size, min(ty * size + size, self.y)))
+
+    def _blank_tile_hash(self, key: tuple[int, int], store_hash: int) -> int:
+        """
+        The XOR of zobrist.cell_hash over the squares of tile `key`, were they all holding a state with hash `store_hash`.
+
+        complexity: O(1), O(t^2) the first time for each key and hash
+        t: TILE_SIZE
+        """
+        if store_hash == 0:
+            return 0
+        cached = self.blank_hashes.get((key, store_hash))
+        if cached is None:
+            size = self.TILE_SIZE
+            cached = 0
+            for x in range(key[0] * size, min(key[0] * size + size, self.x)):
+                for y in range(key[1] * size, min(key[1] * size + size, self.y)):
+                    cached ^= zobrist.cell_hash(zobrist.cell_key(x, y), store_hash)
+            self.blank_hashes[(key, store_hash)] = cached
+        return cached
+
+    def store_changed(self, store: LayerStore, old_hash: int, old_mask: int) -> None:
+        """
+        Called by a grid square's layer store whenever it changes,
+        to keep the grid hash and the layer -> squares index up to date, and to tell watchers.
+
+        complexity: O(L + w)
+        L: the number of layers which were added to or removed from the square, at most the number of layers
+        w: the number of watchers
+        """
+        batch = self.batch
+        if batch is not None: # Dealt with once the batch ends, from the first state seen
+            if store not in batch:
+                batch[store] = (old_hash, old_mask)
+            return
+        self.hash ^= zobrist.cell_hash(store.key, old_hash) ^ zobrist.cell_hash(store.key, store.hash)
+        if self.tiles is not None:
+            key = (store.position[0] // self.TILE_SIZE, store.position[1] // self.TILE_SIZE)
+            self.dirty_tiles.add(key)
+            self.edits += 1
+            self.tiles[key].version = self.edits
+        for changes in self.watchers:
+            changes.add(store.position)
+        self._index_layers(store.position, old_mask, store.mask)
+
+    def _index_layers(self, position: tuple[int, int], old_mask: int, new_mask: int) -> None:
+        """
+        Updates the layer -> squares index for a square whose layers changed from `old_mask` to `new_mask`.
+
+        complexity: O(L)
+        L: the number of layers which were added to or removed from the square
+        """
+        changed = old_mask ^ new_mask
+        index = 0
+        while changed:
+            if changed & 1:
+                if new_mask >> index & 1:
+                    self.layer_cells.setdefault(index, set()).add(position)
+                else:
+                    self.layer_cells[index].discard(position)
+            changed >>= 1
+            index += 1
+
+    @contextmanager
+    def batched(self):
+        """
+        Context manager deferring what store_changed does until the block ends, then doing it for every
+        changed square at once: the hash per square, but the layer index per group of squares with the same change,
+        and dirty tiles, tile versions and watchers per tile or in bulk. Nothing may read the hash, layer index,
+        dirty tiles or watched changes inside the block. Nested blocks join the outer one.
+
+        complexity: O(k + L . g + t) when the block ends
+        k: the number of squares changed
+        L, g: the layers changed per group and the number of groups of squares with the same change
+        t: the number of tiles changed
+        """
+        if self.batch is not None:
+            yield
+            return
+        self.batch = {}
+        try:
+            yield
+        finally:
+            batch, self.batch = self.batch, None
+            self._end_batch(batch)
+
+    def _end_batch(self, batch: dict) -> None:
+        """
+        Does what store_changed would have for each square changed in a batch.
+
+        complexity: O(k + L . g + t), as batched
+        """
+        cell_hash = zobrist.cell_hash
+        grid_hash = self.hash
+        groups: dict[tuple[int, int], list[tuple[int, int]]] = {}
+        for store, (old_hash, old_mask) in batch.items():
+            new_hash, new_mask = store.hash, store.mask
+            if new_hash != old_hash:
+                grid_hash ^= cell_hash(store.key, old_hash) ^ cell_hash(store.key, new_hash)
+            elif new_mask == old_mask:
+                continue # Changed back within the batch
+            group = groups.get((old_mask, new_mask))
+            if group is None:
+                group = groups[(old_mask, new_mask)] = []
+            group.append(store.position)
+        self.hash = grid_hash
+        for (old_mask, new_mask), positions in groups.items():
+            self._index_many(positions, old_mask, new_mask)
+            for changes in self.watchers:
+                changes.update(positions)
+            if self.tiles is not None:
+                size = self.TILE_SIZE
+                keys = {(x // size, y // size) for x, y in positions}
+                self.dirty_tiles |= keys
+                self.edits += 1
+                for key in keys:
+                    self.tiles[key].version = self.edits
+
+    def _index_many(self, positions: list[tuple[int, int]], old_mask: int, new_mask: int) -> None:
+        """
+        Updates the layer -> squares index for squares whose layers all changed from `old_mask` to `new_mask`.
+
+        complexity: O(L . p)
+        L: the number of layers added or removed
+        p: the number of positions, with a small constant as each set is changed in bulk
+        """
+        changed = old_mask ^ new_mask
+        index = 0
+        while changed:
+            if changed & 1:
+                if new_mask >> index & 1:
+                    self.layer_cells.setdefault(index, set()).update(positions)
+                else:
+                    self.layer_cells[index].difference_update(positions)
+            changed >>= 1
+            index += 1
+
+    def cells_with(self, layer: Layer) -> set[tuple[int, int]]:
+        """
+        Returns the squares whose store contains `layer`. The set is live, so copy it before changing the grid.
+        Tiles of a loaded canvas which use the layer and haven't been read yet are read first.
+
+        complexity: O(1), plus O(u + read) while tiles are unloaded
+        u: the number of squares in unloaded tiles
+        read: restoring the tiles using the layer
+        """
+        if self.unloaded:
+            for tile in [tile for tile in self.unloaded.values() if tile.uses(layer)]:
+                tile.load()
+        return self.layer_cells.get(layer.index, set())
+
+    def count_cells(self, layer: Layer) -> int:
+        """
+        Returns how many squares use `layer`.
+
+        complexity: O(1)
+        """
+        return len(self.cells_with(layer))
+
+    def replace_layer(self, old: Layer, new: Layer|None) -> list[tuple[int, int, object, object]]:
+        """
+        Replaces `old` with `new` in every square using it, or erases it everywhere if `new` is None.
+        Returns (x, y, state before, state after) for each square changed,
+        with states as returned by the store's `snapshot`, which is enough to undo and redo the change.
+
+        complexity: O(k * replace_layer)
+        k: the number of squares using `old`
+        replace_layer: the complexity of the store's replace_layer
+        """
+        changed = []
+        for x, y in list(self.cells_with(old)):
+            store = self.grid[x][y]
+            before = store.snapshot()
+            if store.replace_layer(old, new):
+                changed.append((x, y, before, store.snapshot()))
+        return changed
+
+    def erase_layer(self, layer: Layer) -> list[tuple[int, int, object, object]]:
+        """
+        Erases `layer` from every square using it. Returns the same as `replace_layer`.
+
+        complexity: O(k * replace_layer)
+        k: the number of squares using `layer`
+        """
+        return self.replace_layer(layer, None)
+
+    def apply_many(self, cells, layer: Layer, op: str=OP_ADD):
+        """
+        Adds `layer` to (op OP_ADD) or erases it from (op OP_ERASE) every (x, y) in `cells`, in one pass.
+        Squares outside the grid are ignored and each square is only touched once, however often it is listed.
+
+        Returns one PaintAction holding what changed: a single BulkPaintStep for adds,
+        and a RestoreStep per changed square for erases, since erasing isn't undone by adding back on every store.
+
+        complexity: O(c + k * add/erase + batched)
+        c: the number of cells given
+        k: the number of distinct squares in the grid
+        """
+        from action import BulkPaintStep, PaintAction
+
+        # Set and sequence squares already showing the layer can't change on add, and
+        # sequence squares without it can't change on erase, so those skip the store entirely.
+        masked = self.layer_store_type is not AdditiveLayerStore
+        sequence = self.layer_store_type is SequenceLayerStore
+        adding = op == self.OP_ADD
+        bit = 1 << layer.index
+        width, height, blank, peek = self.x, self.y, self.blank, self.peek
+        tiles, size = self.tiles, self.TILE_SIZE
+        seen = set()
+        changed = array("I")
+        restores = []
+        # The stores tell the grid about their changes once for the whole batch, not square by square
+        with self.batched():
+            for x, y in cells:
+                if not (0 <= x < width and 0 <= y < height) or (x, y) in seen:
+                    continue
+                seen.add((x, y))
+                if tiles is None:
+                    store = peek(x, y)
+                else: # peek, inlined as it runs for every cell
+                    tile = tiles.get((x // size, y // size))
+                    store = blank if tile is None else tile.stores[(x - tile.x0) * tile.height + (y - tile.y0)]
+                if adding:
+                    if masked and store.mask & bit:
+                        continue
+                    if store is blank:
+                        store = self.store_at(x, y)
+                    if store.add(layer):
+                        changed.append(x)
+                        changed.append(y)
+                else:
+                    if store is blank or (sequence and not store.mask & bit):
+                        continue
+                    before = store.snapshot()
+                    if store.erase(layer):
+                        restores.append((x, y, before, store.snapshot()))
+        if op == self.OP_ADD:
+            return PaintAction([BulkPaintStep(changed, layer)] if changed else [])
+        return PaintAction.from_restores(restores)
+
+    def brush_cells(self, px: int, py: int, size: int):
+        """
+        Yields the squares covered by a diamond brush of manhattan radius `size` centred on (px, py),
+        leaving out any outside the grid.
+
+        complexity: O(size^2)
+        """
+        for i in range(max(-size, -px), min(size, self.x - 1 - px) + 1):
+            reach = size - abs(i)
+            for j in range(max(-reach, -py), min(reach, self.y - 1 - py) + 1):
+                yield px + i, py + j
+
+    def stroke(self, positions, sizes, layer: Layer, op: str=OP_ADD):
+        """
+        Paints a whole stroke at once: a brush of sizes[i] at each positions[i], or of `sizes` everywhere if it is an int.
+        Squares covered by several brush positions are only painted once, and one PaintAction is returned.
+
+        complexity: O(p * s^2 + apply_many)
+        p: the number of positions
+        s: the largest brush size
+        """
+        if isinstance(sizes, int):
+            sizes = [sizes] * len(positions)
+        return self.apply_many(
+            (cell for (px, py), size in zip(positions, sizes) for cell in self.brush_cells(px, py, size)),
+            layer, op,
+        )
+
+    def state_hash(self) -> int:
+        """
+        Returns a 64-bit hash of the whole grid's contents.
+        Grids of the same size and draw style with the same layers hash equally,
+        so comparing hashes is a constant time stand-in for comparing every square.
+        The brush size is not part of the hash.
+
+        complexity: O(1)
+        """
+        return self.hash
+
+    def fill_region(self, x: int, y: int, match_layers: bool=False, timestamp: float=0, bg=(255, 255, 255)) -> array:
+        """
+        Finds the connected region of squares around (x, y) which look the same as it,
+        using a scanline fill along each column.
+        - match_layers False: squares match if they show the same colour at `timestamp` on background `bg`.
+        - match_layers True: squares match if their layer stores are identical, compared through their hashes.
+
+        Returns the region flat, as x0, y0, x1, y1, ...
+
+        complexity: O(k * get_color)
+        k: the number of squares in the region and bordering it
+        """
+        if match_layers:
+            key = lambda sx, sy: self.peek(sx, sy).hash
+        else:
+            # As a tuple, since empty squares hand back `bg` itself, which may be a list
+            key = lambda sx, sy: tuple(self.peek(sx, sy).get_color(bg, timestamp, sx, sy))
+        target = key(x, y)
+        visited = bytearray(self.x * self.y)
+        region = array("I")
+        seeds = [(x, y)]
+        while seeds:
+            sx, sy = seeds.pop()
+            base = sx * self.y
+            if visited[base + sy] or key(sx, sy) != target:
+                continue
+            # Extend the span along the column as far as it matches
+            lo = sy
+            while lo > 0 and not visited[base + lo - 1] and key(sx, lo - 1) == target:
+                lo -= 1
+            hi = sy
+            while hi < self.y - 1 and not visited[base + hi + 1] and key(sx, hi + 1) == target:
+                hi += 1
+            for sy in range(lo, hi + 1):
+                visited[base + sy] = 1
+                region.append(sx)
+                region.append(sy)
+            # Seed one square per matching run in the neighbouring columns
+            for nx in (sx - 1, sx + 1):
+                if not 0 <= nx < self.x:
+                    continue
+                nbase = nx * self.y
+                in_run = False
+                for ny in range(lo, hi + 1):
+                    if not visited[nbase + ny] and key(nx, ny) == target:
+                        if not in_run:
+                            seeds.append((nx, ny))
+                            in_run = True
+                    else:
+                        in_run = False
+        return region
+
+    def copy_region(self, x: int, y: int, width: int, height: int) -> ArrayR:
+        """
+        Copies the width x height rectangle with bottom left square (x, y), clipped to the grid.
+        Returns an ArrayR of columns of cloned stores, which share their layers with the grid copy-on-write.
+
+        complexity: O(wh * clone)
+        w, h: the width and height of the clipped rectangle
+        """
+        x0, y0 = max(x, 0), max(y, 0)
+        x1, y1 = min(x + width, self.x), min(y + height, self.y)
+        region = ArrayR(max(x1 - x0, 0))
+        for i in range(len(region)):
+            region[i] = ArrayR(max(y1 - y0, 0))
+            for j in range(len(region[i])):
+                region[i][j] = self.peek(x0 + i, y0 + j).clone()
+        return region
+
+    def paste_region(self, region: ArrayR, x: int, y: int) -> list[tuple[int, int, LayerStore, LayerStore]]:
+        """
+        Pastes a region from `copy_region` with its bottom left square at (x, y). Squares falling outside the grid are skipped.
+        Pasted squares share the region's stores copy-on-write, so no layers are copied.
+
+        Returns (x, y, before, after) for each square that changed, where before and after are stores
+        holding the square's old and new layers, for undo and redo.
+
+        complexity: O(wh * clone)
+        w, h: the width and height of the region
+        """
+        changed = []
+        for i in range(len(region)):
+            for j in range(len(region[i])):
+                tx, ty = x + i, y + j
+                if not (0 <= tx < self.x and 0 <= ty < self.y):
+                    continue
+                store = self.peek(tx, ty)
+                source = region[i][j]
+                if store.hash == source.hash and store.mask == source.mask:
+                    continue
+                before = store.clone()
+                store = self.store_at(tx, ty)
+                store.share_from(source)
+                changed.append((tx, ty, before, source))
+        return changed
+
+    def snapshot(self, cache: dict|None=None) -> tuple:
+        """
+        Returns a compact copy of every grid square's state, column by column.
+        Used as a keyframe so the grid can later be restored without replaying from scratch.
+        For a tiled grid, only allocated tiles are kept, as ((tx, ty), square states) pairs,
+        followed by (None, state of self.blank) if unallocated squares aren't empty.
+
+        A tiled grid can be given a `cache` dict, kept between snapshots of this grid only, of
+        tile key -> (tile version, square states). Tiles which haven't changed since they were cached
+        share their states with the earlier snapshot instead of being copied again. The cache is updated.
+
+        complexity: O(nm * snapshot), O(T + c * snapshot) tiled with a cache
+        n: the length of the X axis / outer Array
+        m: the length of the Y axis / inner Array
+        T: the number of allocated tiles
+        c: the number of squares in tiles changed since the last snapshot with the cache
+        snapshot because copying a layer store's state differs depending on the type of layer store
+        """
+        if self.tiles is not None:
+            if cache is None:
+                cache = {}
+            for key in [key for key in cache if key not in self.tiles]:
+                del cache[key]
+            for key, tile in self.tiles.items():
+                cached = cache.get(key)
+                if cached is None or cached[0] != tile.version:
+                    stores = tile.stores
+                    cache[key] = (tile.version, tuple(stores[i].snapshot() for i in range(len(stores))))
+            tiles = tuple((key, cache[key][1]) for key in self.tiles)
+            return tiles + ((None, self.blank.snapshot()),) if self.blank.hash else tiles
+        return tuple(self.grid[x][y].snapshot() for x in range(self.x) for y in range(self.y))
+
+    def restore(self, snapshot: tuple) -> None:
+        """
+        Restores every grid square to the state stored in a snapshot taken from a grid of the same size and style.
+
+        complexity: O(nm * restore)
+        n: the length of the X axis / outer Array
+        m: the length of the Y axis / inner Array
+        """
+        if self.tiles is not None:
+            self._restore_tiles(snapshot)
+            return
+        i = 0
+        for x in range(self.x):
+            for y in range(self.y):
+                self.grid[x][y].restore(snapshot[i])
+                i += 1
+
+    def clear(self) -> None:
+        """
+        Empties every grid square, as if the grid had just been created.
+        The brush size is left untouched.
+
+        complexity: O(nm)
+        n: the length of the X axis / outer Array
+        m: the length of the Y axis / inner Array
+        """
+        if self.tiles is not None:
+            self._restore_tiles(())
+            return
+        blank = self.layer_store_type().snapshot()
+        for x in range(self.x):
+            for y in range(self.y):
+                self.grid[x][y].restore(blank)
+
+    def _restore_tiles(self, snapshot: tuple) -> None:
+        """
+        Restores a tiled grid from its snapshot. Tiles missing from the snapshot are made blank and freed.
+
+        complexity: O(k * restore + _set_blank)
+        k: the number of squares in tiles allocated before or after
+        """
+        kept = dict(snapshot)
+        blank = kept.pop(None, self.layer_store_type().snapshot())
+        if not self.SPECIAL_VIA_BLANK and blank != self.blank.snapshot():
+            size = self.TILE_SIZE
+            for tx in range(-(-self.x // size)): # Holds what unallocated squares would hold in every tile instead
+                for ty in range(-(-self.y // size)):
+                    if (tx, ty) not in kept:
+                        kept[(tx, ty)] = (blank,) * (min(size, self.x - tx * size) * min(size, self.y - ty * size))
+            blank = self.blank.snapshot()
+        self._set_blank(blank)
+        for key in [key for key in self.tiles if key not in kept]:
+            tile = self.tiles[key]
+            for i in range(len(tile.stores)):
+                tile.stores[i].restore(blank) # Keeps the hash and layer index right
+            self._free_tile(key)
+        for key, states in kept.items():
+            tile = self.tiles.get(key)
+            if tile is None:
+                tile = self._new_tile(key)
+            for i in range(len(states)):
+                tile.stores[i].restore(states[i])
+
+    def save(self, path: str) -> None:
+        """
+        Saves every square to a compact canvas file at `path`, which `Grid.load` reads back.
+
+        complexity: O(grid_file.save)
+        """
+        import grid_file
+        grid_file.save(self, path)
+
+    @staticmethod
+    def load(path: str, tiled: bool|None=None) -> Grid:
+        """
+        Returns a new grid with the size, draw style and squares saved in the canvas file at `path`.
+        :raises ValueError: if it isn't a canvas file
+
+        Only an untiled grid is restored straight away. A tiled grid keeps the file mapped and gets a
+        grid_file.SavedTile for each saved tile, which reads its squares the first time they are used,
+        so opening a large canvas doesn't cost restoring every square. Its hash is read from the file.
+
+        complexity: O(k * restore) untiled, O(T) tiled, plus O(t^2 + restore) the first time each tile is used
+        k: the number of non-empty squares saved
+        T: the number of tiles saved
+        t: TILE_SIZE
+        """
+        import grid_file
+        f = grid_file.GridFile(path)
+        grid = f.make_grid(tiled)
+        if grid.tiles is None:
+            with f:
+                f.load_into(grid)
+        else:
+            f.load_lazily(grid)
+        return grid
+
+    def to_array(self, timestamp: float, bg: tuple[int, int, int]=(255, 255, 255), region: tuple[int, int, int, int]|None=None):
+        """
+        Returns the colours of the grid, or of the (x, y, width, height) rectangle `region`, at `timestamp`
+        as an (H, W, 3) uint8 NumPy array with the top row first. Needs NumPy, but no window.
+
+        complexity: O(render.to_array)
+        """
+        import render
+        return render.to_array(self, timestamp, bg, region)
+
     def __getitem__ (self, x: int):
         """
         Magic method to access a value inside the grid based on index
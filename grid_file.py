@@ -0,0 +1,285 @@
+"""
+Compact, memory-mappable canvas files.
+
+A canvas is saved column by column in a handful of flat arrays rather than pickled store by store,
+so opening one is a header read and an mmap, and tiles can be read one at a time.
+
+Layout (little endian). Squares are grouped by Grid.TILE_SIZE tiles, and only tiles with
+at least one non-empty square are saved. Within a tile they're in Tile.stores order, column by column:
+- Header: MAGIC, FORMAT_VERSION, x, y, draw style index into Grid.DRAW_STYLE_OPTIONS,
+  tile size, number of tiles saved, total layers in the arena, grid hash (Grid.state_hash)
+- Tile table: tx, ty, index of the tile's first square, and where its stacks start in the arena, for each tile
+- lengths: uint16 per square, the number of layers in its stack
+- masks: uint64 per square, LayerStore.mask
+- flags: uint8 per square, shared_grid.SQUARE_SPECIAL if a set store's special is on
+- arena: one byte per layer index, stacks as in shared_grid.flatten
+"""
+from __future__ import annotations
+import mmap
+import struct
+from array import array
+from grid import Grid, Tile
+from layer_util import Layer
+from shared_grid import flatten, unflatten
+
+MAGIC = b"SPGF"
+FORMAT_VERSION = 2
+
+HEADER = struct.Struct("<4sIIIIIIQQ")
+TILE_ENTRY = struct.Struct("<IIQQ")
+
+def _align(n: int) -> int:
+    """ Rounds n up to a multiple of 8. """
+    return (n + 7) & ~7
+
+def _tile_squares(grid: Grid, tx: int, ty: int):
+    """ Yields the store of every square of tile (tx, ty), in Tile.stores order, without allocating. """
+    x0, y0 = tx * Grid.TILE_SIZE, ty * Grid.TILE_SIZE
+    for x in range(x0, min(x0 + Grid.TILE_SIZE, grid.x)):
+        for y in range(y0, min(y0 + Grid.TILE_SIZE, grid.y)):
+            yield grid.peek(x, y)
+
+def save(grid: Grid, path: str) -> None:
+    """
+    Saves a grid's squares to `path`.
+
+    Complexity: O(nm) untiled, O(k) tiled, times O(snapshot)
+    k: The number of squares in allocated tiles
+    """
+    if grid.tiles is not None and not grid.blank.hash:
+        keys = sorted(grid.tiles)
+    else: # Unallocated squares aren't empty after a special, so they're saved as ordinary squares
+        keys = [(tx, ty) for tx in range(-(-grid.x // Grid.TILE_SIZE)) for ty in range(-(-grid.y // Grid.TILE_SIZE))]
+    entries = bytearray()
+    lengths = array("H")
+    masks = array("Q")
+    flags = bytearray()
+    arena = bytearray()
+    saved = 0
+    for tx, ty in keys:
+        stacks = [(flatten(store.snapshot()), store.mask) for store in _tile_squares(grid, tx, ty)]
+        if not any(stack or flag for (stack, flag), _ in stacks):
+            continue # Every square is empty, as the tile reads back when missing
+        entries += TILE_ENTRY.pack(tx, ty, len(lengths), len(arena))
+        for (stack, flag), mask in stacks:
+            lengths.append(len(stack))
+            masks.append(mask)
+            flags.append(flag)
+            arena += stack
+        saved += 1
+
+    header = HEADER.pack(
+        MAGIC, FORMAT_VERSION, grid.x, grid.y, Grid.DRAW_STYLE_OPTIONS.index(grid.draw_style),
+        Grid.TILE_SIZE, saved, len(arena), grid.hash,
+    )
+    with open(path, "wb") as f:
+        for section in (header, entries, lengths.tobytes(), masks.tobytes(), flags):
+            f.write(section)
+            f.write(bytes(_align(len(section)) - len(section))) # Keeps the next array aligned for mmap views
+        f.write(arena)
+
+
+class GridFile:
+    """
+    A canvas file saved by `save`, mapped into memory.
+
+    Opening only reads the header and tile table. The header is exposed as `x`, `y`, `draw_style` and `hash`,
+    and `tiles` maps each saved tile to where its squares are. `tile_states` reads one tile,
+    `load_into` restores some or all of them into a grid, and `load_lazily` hands them to a grid to read when used.
+    """
+
+    def __init__(self, path: str) -> None:
+        """
+        Opens and maps the file.
+        :raises ValueError: if it isn't a canvas file this version can read
+
+        Complexity: O(T)
+        T: The number of tiles saved
+        """
+        self.path = path
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.map) < HEADER.size:
+            self.map.close()
+            raise ValueError(f"{path} is not a canvas file")
+        magic, version, self.x, self.y, style, tile_size, count, arena_size, self.hash = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or version != FORMAT_VERSION or tile_size != Grid.TILE_SIZE:
+            self.map.close()
+            raise ValueError(f"{path} is not a canvas file this version can read")
+        self.draw_style = Grid.DRAW_STYLE_OPTIONS[style]
+
+        pos = _align(HEADER.size)
+        self.tiles: dict[tuple[int, int], tuple[int, int]] = {} # (tx, ty) -> (first square, arena start)
+        for i in range(count):
+            tx, ty, first, start = TILE_ENTRY.unpack_from(self.map, pos + i * TILE_ENTRY.size)
+            self.tiles[(tx, ty)] = (first, start)
+        squares = sum(self._tile_size(key) for key in self.tiles)
+        pos = _align(pos + count * TILE_ENTRY.size)
+        buf = memoryview(self.map)
+        self.lengths = buf[pos:pos + 2 * squares].cast("H")
+        pos = _align(pos + 2 * squares)
+        self.masks = buf[pos:pos + 8 * squares].cast("Q")
+        pos = _align(pos + 8 * squares)
+        self.flags = buf[pos:pos + squares]
+        pos = _align(pos + squares)
+        self.arena = buf[pos:pos + arena_size]
+        self.buf = buf
+
+    def _tile_size(self, key: tuple[int, int]) -> int:
+        """ The number of squares in tile `key` of a grid the size of this file's. """
+        tx, ty = key
+        return min(Grid.TILE_SIZE, self.x - tx * Grid.TILE_SIZE) * min(Grid.TILE_SIZE, self.y - ty * Grid.TILE_SIZE)
+
+    def __enter__(self) -> GridFile:
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def make_grid(self, tiled: bool|None=None) -> Grid:
+        """
+        Returns an empty grid with the size and draw style of the file.
+
+        Complexity: O(Grid.__init__)
+        """
+        return Grid(self.draw_style, self.x, self.y, tiled)
+
+    def tile_states(self, key: tuple[int, int]) -> list|None:
+        """
+        Returns the layer store snapshot of every square of tile `key`, in Tile.stores order,
+        or None if the tile wasn't saved because every square is empty.
+
+        Complexity: O(t^2 + l)
+        t: Grid.TILE_SIZE
+        l: The number of layers in the tile
+        """
+        entry = self.tiles.get(key)
+        if entry is None:
+            return None
+        first, pos = entry
+        states = []
+        for i in range(first, first + self._tile_size(key)):
+            length = self.lengths[i]
+            states.append(unflatten(self.draw_style, self.arena[pos:pos + length], self.flags[i]))
+            pos += length
+        return states
+
+    def load_into(self, grid: Grid, keys=None) -> None:
+        """
+        Restores the saved tiles with the given keys (every saved tile by default) into an empty grid
+        of the file's size and draw style. Only non-empty squares are restored.
+
+        Complexity: O(T * t^2 + k * restore)
+        T: The number of tiles loaded
+        k: The number of non-empty squares in them
+        """
+        for key in self.tiles if keys is None else keys:
+            states = self.tile_states(key)
+            if states is None:
+                continue
+            first = self.tiles[key][0]
+            x0, y0 = key[0] * Grid.TILE_SIZE, key[1] * Grid.TILE_SIZE
+            height = min(Grid.TILE_SIZE, self.y - y0)
+            tile: Tile|None = None
+            for i in range(len(states)):
+                if not self.lengths[first + i] and not self.flags[first + i]:
+                    continue
+                if grid.tiles is None:
+                    grid.grid[x0 + i // height][y0 + i % height].restore(states[i])
+                else:
+                    if tile is None:
+                        grid.store_at(x0, y0) # Allocates the tile
+                        tile = grid.tiles[key]
+                    tile.stores[i].restore(states[i])
+
+    def load_lazily(self, grid: Grid) -> None:
+        """
+        Gives an empty tiled grid of the file's size and draw style a SavedTile for every saved tile, and the saved hash.
+        The file stays mapped until the last of them is read, and is closed straight away if there are none.
+
+        Complexity: O(T)
+        T: The number of tiles saved
+        """
+        grid.hash = self.hash
+        for key in self.tiles:
+            grid.tiles[key] = grid.unloaded[key] = SavedTile(grid, self, key)
+            grid.dirty_tiles.add(key)
+        if not self.tiles:
+            self.close()
+
+    def close(self) -> None:
+        """ Releases the mapping. """
+        for view in (self.lengths, self.masks, self.flags, self.arena, self.buf):
+            view.release()
+        self.map.close()
+
+
+class SavedTile(Tile):
+    """
+    A tile of a lazily loaded grid whose squares are still in the canvas file.
+    Its position and size are there from the start, but `stores` is only made, and its squares restored,
+    when first used, after which it is an ordinary Tile.
+    """
+
+    def __init__(self, grid: Grid, file: GridFile, key: tuple[int, int]) -> None:
+        """
+        Complexity: O(1)
+        """
+        self.x0 = key[0] * Grid.TILE_SIZE
+        self.y0 = key[1] * Grid.TILE_SIZE
+        self.width = min(Grid.TILE_SIZE, grid.x - self.x0)
+        self.height = min(Grid.TILE_SIZE, grid.y - self.y0)
+        grid.edits += 1
+        self.version = grid.edits
+        self.grid = grid
+        self.file = file
+        self.key = key
+
+    def __getattr__(self, name: str):
+        # Only called for attributes not set yet, which is `stores` until the tile is loaded
+        if name != "stores":
+            raise AttributeError(name)
+        self.load()
+        return self.stores
+
+    def uses(self, layer: Layer) -> bool:
+        """
+        Returns whether any saved square of the tile has `layer`, from the saved masks.
+
+        Complexity: O(t^2)
+        t: Grid.TILE_SIZE
+        """
+        first = self.file.tiles[self.key][0]
+        bit = 1 << layer.index
+        return any(mask & bit for mask in self.file.masks[first:first + len(self)])
+
+    def __len__(self) -> int:
+        return self.width * self.height
+
+    def load(self) -> None:
+        """
+        Makes the tile's stores and restores its saved squares, which indexes their layers in the grid.
+        The grid's hash, watchers and dirty tiles are left as they were, since what the grid holds doesn't change,
+        and squares restored inside Grid.batched aren't counted as changes of the batch.
+        Closes the file once every tile of the grid has been loaded.
+
+        Complexity: O(t^2 + k * restore)
+        t: Grid.TILE_SIZE
+        k: The number of non-empty squares in the tile
+        """
+        grid, file = self.grid, self.file
+        if grid.unloaded.pop(self.key, None) is None:
+            return
+        grid_hash, watchers, dirty, batch = grid.hash, grid.watchers, grid.dirty_tiles, grid.batch
+        grid.watchers, grid.dirty_tiles, grid.batch = [], set(), None
+        try:
+            Tile.__init__(self, grid, *self.key)
+            first = file.tiles[self.key][0]
+            states = file.tile_states(self.key)
+            for i in range(len(states)):
+                if file.lengths[first + i] or file.flags[first + i]:
+                    self.stores[i].restore(states[i])
+        finally:
+            grid.hash, grid.watchers, grid.dirty_tiles, grid.batch = grid_hash, watchers, dirty, batch
+        if not grid.unloaded:
+            file.close()
@@ -0,0 +1,312 @@
+"""
+Image writers which only need the standard library.
+
+Images are passed as packed RGB bytes, row by row from the top,
+with 3 bytes per pixel.
+
+The AnimationWriters (GifWriter, ApngWriter, RawFrameWriter) write each frame as it is given,
+so long animations never have to fit in memory.
+"""
+from __future__ import annotations
+import struct
+import sys
+import zlib
+from abc import ABC, abstractmethod
+
+def write_ppm(path: str, width: int, height: int, pixels: bytes) -> None:
+    """
+    Writes a binary (P6) PPM image.
+
+    Complexity: O(width * height)
+    """
+    with open(path, "wb") as f:
+        f.write(b"P6\n%d %d\n255\n" % (width, height))
+        f.write(pixels)
+
+def _png_chunk(kind: bytes, data: bytes) -> bytes:
+    """ Returns a PNG chunk with its length and CRC. """
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF)
+
+def encode_png(width: int, height: int, pixels: bytes) -> bytes:
+    """
+    Returns the bytes of an 8-bit RGB PNG image.
+
+    Complexity: O(width * height)
+    """
+    stride = width * 3
+    raw = bytearray()
+    for row in range(height):
+        raw.append(0) # No filter
+        raw += pixels[row * stride:(row + 1) * stride]
+    return b"".join([
+        b"\x89PNG\r\n\x1a\n",
+        _png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)),
+        _png_chunk(b"IDAT", zlib.compress(bytes(raw), 6)),
+        _png_chunk(b"IEND", b""),
+    ])
+
+def write_png(path: str, width: int, height: int, pixels: bytes) -> None:
+    """
+    Writes an 8-bit RGB PNG image.
+
+    Complexity: O(width * height)
+    """
+    with open(path, "wb") as f:
+        f.write(encode_png(width, height, pixels))
+
+def write_image(path: str, width: int, height: int, pixels: bytes) -> None:
+    """
+    Writes a PPM image if `path` ends in .ppm, and a PNG image otherwise.
+
+    Complexity: O(width * height)
+    """
+    if path.lower().endswith(".ppm"):
+        write_ppm(path, width, height, pixels)
+    else:
+        write_png(path, width, height, pixels)
+
+def _lzw(indices: bytes, min_size: int=8) -> bytearray:
+    """
+    Returns GIF LZW codes for a string of palette indices, packed least significant bit first.
+
+    Complexity: O(n)
+    n: the number of indices
+    """
+    clear = 1 << min_size
+    out = bytearray()
+    bits = 0 # Codes not written out yet, the oldest in the lowest bits
+    count = 0
+    size = min_size + 1
+
+    def emit(code: int) -> None:
+        nonlocal bits, count
+        bits |= code << count
+        count += size
+        while count >= 8:
+            out.append(bits & 0xFF)
+            bits >>= 8
+            count -= 8
+
+    table: dict[int, int] = {} # (prefix code << 8 | index) -> code
+    next_code = clear + 2
+    emit(clear)
+    prefix = indices[0]
+    for index in indices[1:]:
+        key = prefix << 8 | index
+        code = table.get(key)
+        if code is not None:
+            prefix = code
+            continue
+        emit(prefix)
+        if next_code < 4096:
+            table[key] = next_code
+            next_code += 1
+            # The decoder adds each code one step behind, so it widens codes once next_code passes the limit
+            if next_code > 1 << size and size < 12:
+                size += 1
+        else:
+            emit(clear)
+            table = {}
+            next_code = clear + 2
+            size = min_size + 1
+        prefix = index
+    emit(prefix)
+    emit(clear + 1)
+    if count:
+        out.append(bits & 0xFF)
+    return out
+
+def _palette_indices(pixels: bytes) -> tuple[bytes, bytes]:
+    """
+    Returns a 256 colour palette and the index of every pixel in it.
+    The palette holds the exact colours if there are 256 or fewer,
+    and otherwise 3 bits of red and green and 2 of blue.
+
+    Complexity: O(p)
+    p: the number of pixels
+    """
+    colors: dict[tuple[int, int, int], int] = {}
+    indices = bytearray()
+    for rgb in zip(pixels[0::3], pixels[1::3], pixels[2::3]):
+        index = colors.get(rgb)
+        if index is None:
+            if len(colors) == 256:
+                break
+            index = colors[rgb] = len(colors)
+        indices.append(index)
+    else:
+        palette = b"".join(bytes(rgb) for rgb in colors)
+        return palette + bytes(768 - len(palette)), bytes(indices)
+    palette = b"".join(
+        bytes((r * 255 // 7, g * 255 // 7, b * 255 // 3)) for r in range(8) for g in range(8) for b in range(4)
+    )
+    return palette, bytes(
+        (r & 0xE0) | (g >> 5 << 2) | (b >> 6) for r, g, b in zip(pixels[0::3], pixels[1::3], pixels[2::3])
+    )
+
+
+class AnimationWriter(ABC):
+    """
+    Writes an animation one frame at a time, without keeping earlier frames.
+    Use as a context manager, or call `close` to finish the file.
+    """
+
+    # Whether players loop the file, so an exporter only needs to write one period of a repeating animation
+    loops = True
+
+    @abstractmethod
+    def write(self, pixels: bytes) -> None:
+        """ Appends a frame of packed RGB rows. """
+        pass
+
+    @abstractmethod
+    def close(self) -> None:
+        """ Finishes the file. """
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+class GifWriter(AnimationWriter):
+    """
+    Writes an animated GIF which loops forever, each frame with its own palette.
+    """
+
+    def __init__(self, path: str, width: int, height: int, duration: int=50) -> None:
+        """
+        Starts the file, showing each frame for `duration` milliseconds (rounded to hundredths of a second).
+
+        Complexity: O(1)
+        """
+        self.width = width
+        self.height = height
+        self.delay = max(round(duration / 10), 1)
+        self.frames = 0
+        self.file = open(path, "wb")
+        self.file.write(b"GIF89a" + struct.pack("<HHBBB", width, height, 0, 0, 0))
+        self.file.write(b"\x21\xFF\x0BNETSCAPE2.0\x03\x01" + struct.pack("<H", 0) + b"\x00") # Loop forever
+
+    def write(self, pixels: bytes) -> None:
+        """
+        Appends a frame.
+
+        Complexity: O(width * height)
+        """
+        palette, indices = _palette_indices(pixels)
+        data = _lzw(indices)
+        self.file.write(b"\x21\xF9\x04" + struct.pack("<BHBB", 0, self.delay, 0, 0))
+        self.file.write(b"\x2C" + struct.pack("<HHHHB", 0, 0, self.width, self.height, 0x87) + palette)
+        self.file.write(b"\x08")
+        for i in range(0, len(data), 255):
+            block = data[i:i + 255]
+            self.file.write(bytes((len(block),)) + block)
+        self.file.write(b"\x00")
+        self.frames += 1
+
+    def close(self) -> None:
+        """
+        Finishes the file.
+        :raises ValueError: if no frames were written
+        """
+        self.file.write(b"\x3B")
+        self.file.close()
+        if not self.frames:
+            raise ValueError("A GIF needs at least one frame")
+
+
+class ApngWriter(AnimationWriter):
+    """
+    Writes an animated PNG which loops forever, in full colour.
+    The frame count is filled in when the file is closed.
+    """
+
+    def __init__(self, path: str, width: int, height: int, duration: int=50) -> None:
+        self.width = width
+        self.height = height
+        self.duration = duration
+        self.frames = 0
+        self.sequence = 0 # Numbers the frame control and frame data chunks, which share one sequence
+        self.file = open(path, "wb")
+        self.file.write(b"\x89PNG\r\n\x1a\n")
+        self.file.write(_png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)))
+        self.actl = self.file.tell()
+        self.file.write(_png_chunk(b"acTL", struct.pack(">II", 0, 0)))
+
+    def write(self, pixels: bytes) -> None:
+        """
+        Appends a frame.
+
+        Complexity: O(width * height)
+        """
+        stride = self.width * 3
+        raw = bytearray()
+        for row in range(self.height):
+            raw.append(0) # No filter
+            raw += pixels[row * stride:(row + 1) * stride]
+        self.file.write(_png_chunk(b"fcTL", struct.pack(
+            ">IIIIIHHBB", self.sequence, self.width, self.height, 0, 0, self.duration, 1000, 0, 0,
+        )))
+        self.sequence += 1
+        data = zlib.compress(bytes(raw), 6)
+        if self.frames == 0: # The first frame is also the image shown by viewers without animation support
+            self.file.write(_png_chunk(b"IDAT", data))
+        else:
+            self.file.write(_png_chunk(b"fdAT", struct.pack(">I", self.sequence) + data))
+            self.sequence += 1
+        self.frames += 1
+
+    def close(self) -> None:
+        """
+        Finishes the file.
+        :raises ValueError: if no frames were written
+        """
+        self.file.write(_png_chunk(b"IEND", b""))
+        self.file.seek(self.actl)
+        self.file.write(_png_chunk(b"acTL", struct.pack(">II", self.frames, 0)))
+        self.file.close()
+        if not self.frames:
+            raise ValueError("An animated PNG needs at least one frame")
+
+
+class RawFrameWriter(AnimationWriter):
+    """
+    Writes frames back to back as packed RGB bytes, to a file or to standard output for path "-",
+    ready to pipe into a video encoder (e.g. ffmpeg -f rawvideo -pix_fmt rgb24).
+    """
+
+    # There is nowhere to say the stream repeats, so every frame has to be written
+    loops = False
+
+    def __init__(self, path: str, width: int, height: int, duration: int=50) -> None:
+        self.width = width
+        self.height = height
+        self.frames = 0
+        self.file = sys.stdout.buffer if path == "-" else open(path, "wb")
+
+    def write(self, pixels: bytes) -> None:
+        self.file.write(pixels)
+        self.frames += 1
+
+    def close(self) -> None:
+        if self.file is sys.stdout.buffer:
+            self.file.flush()
+        else:
+            self.file.close()
+
+def open_animation(path: str, width: int, height: int, duration: int=50) -> AnimationWriter:
+    """
+    Returns a writer for an animated GIF if `path` ends in .gif, an animated PNG for .png or .apng,
+    and a raw RGB frame stream otherwise.
+
+    Complexity: O(1)
+    """
+    lower = path.lower()
+    if lower.endswith(".gif"):
+        return GifWriter(path, width, height, duration)
+    if lower.endswith((".png", ".apng")):
+        return ApngWriter(path, width, height, duration)
+    return RawFrameWriter(path, width, height, duration)
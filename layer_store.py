@@ -12,10 +12,30 @@ from data_structures.sorted_list_adt import ListItem
 from data_structures.bset import BSet
 from data_structures.set_adt import *
 
+import zobrist
 
 class LayerStore(ABC):
+    """
+    Every store keeps `hash`, a 64-bit hash of its contents (0 when empty) updated in O(1) on every change,
+    and `mask`, with bit i set if the layer with index i is in the store.
+    A Grid sets `key`, `position` and `observer` on its stores, and is told about every change through `store_changed`.
+    """
+
+    key = 0
+    position = (0, 0)
+    observer = None
+
     def __init__(self) -> None:
-        pass
+        self.hash = 0
+
+    def _changed(self, old_hash: int, old_mask: int) -> None:
+        """
+        Tells the observer, if any, that the store changed from a state with hash `old_hash` and mask `old_mask`.
+
+        Complexity: O(1)
+        """
+        if self.observer is not None and (old_hash != self.hash or old_mask != self.mask):
+            self.observer.store_changed(self, old_hash, old_mask)
         
     @abstractmethod
     def add(self, layer: Layer) -> bool:
@@ -41,12 +61,54 @@ class LayerStore(ABC):
         pass
 
     @abstractmethod
-    def special(self):
+    def special(self) -> bool|Layer:
         """
         Special mode. Different for each store implementation.
+        Returns what changed, so the effect can be undone without running it again:
+        - False if the LayerStore was left unchanged.
+        - The Layer that was removed, for stores whose special removes a layer.
+        - True otherwise, in which case running special again undoes it.
+        """
+        pass
+
+    @abstractmethod
+    def replace_layer(self, old: Layer, new: Layer|None) -> bool:
+        """
+        Replaces every use of `old` in the store with `new`, or removes them if `new` is None.
+        Returns true if the LayerStore was actually changed.
+        """
+        pass
+
+    @abstractmethod
+    def snapshot(self):
+        """
+        Returns a compact, immutable copy of the store's state.
+        Layers are kept by reference, so this never copies Layer objects.
+        """
+        pass
+
+    @abstractmethod
+    def restore(self, state) -> None:
+        """
+        Replaces the store's state with one previously returned by `snapshot`.
         """
         pass
 
+    def clone(self) -> LayerStore:
+        """
+        Returns a store of the same type with the same layers, not attached to any grid.
+        Stores with large state may share it with the clone instead of copying it.
+        """
+        copy = type(self)()
+        copy.restore(self.snapshot())
+        return copy
+
+    def share_from(self, other: LayerStore) -> None:
+        """
+        Replaces the store's state with the state of `other`, usually a clone.
+        """
+        self.restore(other.snapshot())
+
 class SetLayerStore(LayerStore):
     """
     Set layer store. A single layer can be stored at a time (or nothing at all)
@@ -69,6 +131,22 @@ class SetLayerStore(LayerStore):
         """
         self.layers = None
         self.spec = False
+        self.hash = 0
+
+    @property
+    def mask(self) -> int:
+        """ Bit i is set if the current layer has index i. """
+        return 0 if self.layers is None else 1 << self.layers.index
+
+    def _rehash(self, old_mask: int) -> None:
+        """
+        Recomputes self.hash from the current layer and special flag.
+
+        Complexity: O(1)
+        """
+        old = self.hash
+        self.hash = (zobrist.layer_key(self.layers.index) if self.layers is not None else 0) ^ (zobrist.SPECIAL_KEY if self.spec else 0)
+        self._changed(old, old_mask)
 
     def get_color(self, start, timestamp, x, y) -> tuple[int, int, int]:
         """
@@ -119,7 +197,9 @@ class SetLayerStore(LayerStore):
         Complexity: O(1)
         """
         if layer != self.layers:
+            old_mask = self.mask
             self.layers = layer
+            self._rehash(old_mask)
             return True
         return False
     
@@ -141,11 +221,13 @@ class SetLayerStore(LayerStore):
         Complexity: O(1)
         """
         if self.layers != None:
+            old_mask = self.mask
             self.layers = None
+            self._rehash(old_mask)
             return True
         return False
     
-    def special(self) -> None:
+    def special(self) -> bool:
         """
         Explanation:
         Toggles on and off the special effect of the layer.
@@ -153,12 +235,46 @@ class SetLayerStore(LayerStore):
         if not then it remains the same, uninverted
 
         Parameters: None
-        Returns:    None
+        Returns:    True, the toggle always changes the store and is its own inverse
 
         Complexity: O(1)
         """
         self.spec = not self.spec
-        
+        self._rehash(self.mask)
+        return True
+
+    def replace_layer(self, old: Layer, new: Layer|None) -> bool:
+        """
+        Explanation:
+        Replaces the current layer with `new` (or removes it if `new` is None) if it is `old`.
+
+        Complexity: O(1)
+        """
+        if self.layers != old:
+            return False
+        if new is None:
+            return self.erase(old)
+        return self.add(new)
+
+    def snapshot(self) -> tuple[Layer|None, bool]:
+        """
+        Explanation:
+        Returns the current layer and special flag as a tuple.
+
+        Complexity: O(1)
+        """
+        return (self.layers, self.spec)
+
+    def restore(self, state: tuple[Layer|None, bool]) -> None:
+        """
+        Explanation:
+        Sets the current layer and special flag from a snapshot.
+
+        Complexity: O(1)
+        """
+        old_mask = self.mask
+        self.layers, self.spec = state
+        self._rehash(old_mask)
         
 
 class AdditiveLayerStore(LayerStore):
@@ -171,6 +287,9 @@ class AdditiveLayerStore(LayerStore):
     
     NUMBER_OF_LAYERS = 9
 
+    # True while self.layers and self.counts may be shared with a clone, so they must be copied before changing.
+    shared = False
+
     def __init__(self) -> None:
         """
         Initialises a CircularQueue which is going to be used to store layers
@@ -179,6 +298,14 @@ class AdditiveLayerStore(LayerStore):
         n: NUMBER_OF_LAYERS * 100
         """
         self.layers = CircularQueue(self.NUMBER_OF_LAYERS * 100)
+        # Polynomial hashes of the layers, read front to back and back to front,
+        # so appending, serving and reversing all update the hash in O(1).
+        self.hash = 0
+        self.reverse_hash = 0
+        self.power = 1 # zobrist.BASE ** len(self.layers)
+        # How many times each layer index is in the queue, for self.mask
+        self.counts: dict[int, int] = {}
+        self.mask = 0
     
     def add(self, layer: Layer) -> bool:
         """ 
@@ -198,7 +325,9 @@ class AdditiveLayerStore(LayerStore):
         Complexity: O(1)
         """
         if not self.layers.is_full(): # Checks whether self.layers (Circular Queue) is full
+            self._detach()
             self.layers.append(layer) # if not, then append the layer we want to add
+            self._hash_append(layer)
             return True 
         return False # if full, don't add
 
@@ -225,12 +354,12 @@ class AdditiveLayerStore(LayerStore):
         """
         if self.layers.is_empty(): # Checks whether self.layers is empty or not
             return start # if empty, return start: base color
-        else: # if not, keep serving and applying colors from the Queue on top of each other
+        else: # if not, keep applying colors from the Queue on top of each other, oldest first
+            # Read the underlying array rather than serving and re-appending, so a queue shared with a clone is never changed
             temp_color = start
-            for _ in range(len(self.layers)):
-                temp_layer = self.layers.serve()
-                self.layers.append(temp_layer)
-                temp_color = temp_layer.apply(temp_color, timestamp, x, y)
+            array = self.layers.array
+            for i in range(len(self.layers)):
+                temp_color = array[(self.layers.front + i) % len(array)].apply(temp_color, timestamp, x, y)
             return temp_color # Returns the end result color
 
     def erase(self, layer: Layer) -> bool:
@@ -251,27 +380,183 @@ class AdditiveLayerStore(LayerStore):
         Complexity: O(1)
         """
         if not self.layers.is_empty(): # Check whether the Queue is empty or not
-            self.layers.serve() # If not empty, erase the oldest color
+            self._detach()
+            served = self.layers.serve() # If not empty, erase the oldest color
+            old = self.hash
+            old_mask = self.mask
+            self._count(served, -1)
+            value = zobrist.layer_key(served.index)
+            self.power = self.power * zobrist.BASE_INVERSE % zobrist.MOD
+            self.hash = (self.hash - value) * zobrist.BASE_INVERSE % zobrist.MOD
+            self.reverse_hash = (self.reverse_hash - value * self.power) % zobrist.MOD
+            self._changed(old, old_mask)
             return True
         return False
             
-    def special(self) -> None:
+    def special(self) -> bool:
         """
         Explanation:
         Reverse the order of the layers inside the Circular Queue in self.layers
 
         Parameters: self
-        Returns   : None
+        Returns   : - True if the order changed, i.e there were at least two layers. Reversing again undoes it.
+                    - False otherwise
 
         Complexity: O(n)
         n: n is the length of Circular Queue in self.layers
         """
+        if len(self.layers) < 2:
+            return False
+        self._detach()
         temp_stack = ArrayStack(len(self.layers)) 
         for _ in range(len(self.layers)): # Add all elements in self.layers into a stack
             temp_stack.push(self.layers.serve())
         for _ in range(len(temp_stack)): # Add it back to self.layers in order to reverse the queue
             self.layers.append(temp_stack.pop())
-    
+        old = self.hash
+        self.hash, self.reverse_hash = self.reverse_hash, self.hash
+        self._changed(old, self.mask)
+        return True
+
+    def replace_layer(self, old: Layer, new: Layer|None) -> bool:
+        """
+        Explanation:
+        Replaces every occurrence of `old` in the queue with `new`, keeping their positions,
+        or removes them if `new` is None.
+
+        Complexity: O(n)
+        n: the length of the Circular Queue in self.layers
+        """
+        if old.index not in self.counts:
+            return False
+        state = self.snapshot()
+        if new is None:
+            self.restore(tuple(layer for layer in state if layer != old))
+        else:
+            self.restore(tuple(new if layer == old else layer for layer in state))
+        return True
+
+    def snapshot(self) -> tuple[Layer, ...]:
+        """
+        Explanation:
+        Returns the layers in the Circular Queue as a tuple, oldest first.
+        Reads the underlying array directly so the queue is left untouched.
+
+        Complexity: O(n)
+        n: the length of the Circular Queue in self.layers
+        """
+        array = self.layers.array
+        return tuple(array[(self.layers.front + i) % len(array)] for i in range(len(self.layers)))
+
+    def restore(self, state: tuple[Layer, ...]) -> None:
+        """
+        Explanation:
+        Refills the Circular Queue with the layers of a snapshot, oldest first.
+
+        Complexity: O(n)
+        n: the length of the snapshot
+        """
+        old = self.hash
+        old_mask = self.mask
+        if self.shared: # Start a fresh queue rather than copying the shared one just to clear it
+            self.layers = CircularQueue(len(self.layers.array))
+            self.shared = False
+        else:
+            self.layers.clear()
+        self.hash = 0
+        self.reverse_hash = 0
+        self.power = 1
+        self.counts = {}
+        self.mask = 0
+        for layer in state:
+            self.layers.append(layer)
+            self._hash_append(layer, False)
+        self._changed(old, old_mask)
+
+    def clone(self) -> AdditiveLayerStore:
+        """
+        Explanation:
+        Returns a store sharing this store's queue copy-on-write,
+        so cloning never copies the layers. Whichever store changes first copies the queue then.
+
+        Complexity: O(1)
+        """
+        copy = object.__new__(AdditiveLayerStore)
+        copy._take(self)
+        return copy
+
+    def share_from(self, other: LayerStore) -> None:
+        """
+        Explanation:
+        Makes this store share the queue of `other` copy-on-write.
+
+        Complexity: O(1) for additive stores, O(restore) otherwise
+        """
+        if not isinstance(other, AdditiveLayerStore):
+            return super().share_from(other)
+        old = self.hash
+        old_mask = self.mask
+        self._take(other)
+        self._changed(old, old_mask)
+
+    def _take(self, other: AdditiveLayerStore) -> None:
+        """
+        Points this store at the queue and hashes of `other`, marking both as shared.
+
+        Complexity: O(1)
+        """
+        self.layers = other.layers
+        self.counts = other.counts
+        self.hash = other.hash
+        self.reverse_hash = other.reverse_hash
+        self.power = other.power
+        self.mask = other.mask
+        self.shared = other.shared = True
+
+    def _detach(self) -> None:
+        """
+        Gives this store its own copy of the queue if it may be shared, before the queue is changed.
+
+        Complexity: O(n) if shared, O(1) otherwise
+        n: the length of the Circular Queue in self.layers
+        """
+        if self.shared:
+            state = self.snapshot()
+            self.layers = CircularQueue(len(self.layers.array))
+            for layer in state:
+                self.layers.append(layer)
+            self.counts = dict(self.counts)
+            self.shared = False
+
+    def _count(self, layer: Layer, change: int) -> None:
+        """
+        Adjusts how many times `layer` is counted in the queue, and self.mask with it.
+
+        Complexity: O(1)
+        """
+        count = self.counts.get(layer.index, 0) + change
+        if count:
+            self.counts[layer.index] = count
+            self.mask |= 1 << layer.index
+        else:
+            del self.counts[layer.index]
+            self.mask &= ~(1 << layer.index)
+
+    def _hash_append(self, layer: Layer, notify: bool=True) -> None:
+        """
+        Updates the hashes for a layer appended to the back of the queue.
+
+        Complexity: O(1)
+        """
+        old = self.hash
+        old_mask = self.mask
+        self._count(layer, 1)
+        value = zobrist.layer_key(layer.index)
+        self.hash = (self.hash + value * self.power) % zobrist.MOD
+        self.reverse_hash = (self.reverse_hash * zobrist.BASE + value) % zobrist.MOD
+        self.power = self.power * zobrist.BASE % zobrist.MOD
+        if notify:
+            self._changed(old, old_mask)
         
 
 class SequenceLayerStore(LayerStore):
@@ -300,6 +585,7 @@ class SequenceLayerStore(LayerStore):
         """
         self.layers = get_layers()[:self.NUMBER_OF_LAYERS]
         self.layers_set = BSet(self.NUMBER_OF_LAYERS)
+        self.hash = 0 # XOR of the keys of the applied layers
 
     def get_color(self, start, timestamp, x, y) -> tuple[int, int, int]:
         """
@@ -336,6 +622,9 @@ class SequenceLayerStore(LayerStore):
         """
         if layer.index+1 not in self.layers_set: # Check whether the index+1 of the layer we want to add is in self.layers_set
             self.layers_set.add(layer.index+1) # If not in then add the index+1 to self.layers_set to indicate that the layer is currently applying
+            old = self.hash
+            self.hash ^= zobrist.layer_key(layer.index)
+            self._changed(old, self.mask & ~(1 << layer.index))
             return True
         return False
             
@@ -357,17 +646,20 @@ class SequenceLayerStore(LayerStore):
         """
         if layer.index+1 in self.layers_set:
             self.layers_set.remove(layer.index+1)
+            old = self.hash
+            self.hash ^= zobrist.layer_key(layer.index)
+            self._changed(old, self.mask | (1 << layer.index))
         else:
             return False
         return True
     
-    def special(self) -> None:
+    def special(self) -> Layer|None:
         """
         Explanation:
         Function to remove the median applying layer lexicographically ordered
 
         Parameters: self
-        Returns   : None
+        Returns   : The layer which was removed, or None if no layers were applying
 
         Complexity: O(n . logn) 
         n: the length of self.layers 
@@ -381,9 +673,58 @@ class SequenceLayerStore(LayerStore):
             
             # Remove the middle value of the alphabetical_ordered_list from self.layers_set
             if len(alphabetical_ordered_list) % 2 != 0:
-                self.erase(alphabetical_ordered_list[(len(alphabetical_ordered_list)//2)].value)
+                median = alphabetical_ordered_list[(len(alphabetical_ordered_list)//2)].value
             else: # Case when the amount of layers in alphabetical_ordered_list is even, remove the least (lexicographically) from self.layers_set
-                self.erase(alphabetical_ordered_list[((len(alphabetical_ordered_list))//2)-1].value)
+                median = alphabetical_ordered_list[((len(alphabetical_ordered_list))//2)-1].value
+            self.erase(median)
+            return median
+        return None
+
+    def snapshot(self) -> int:
+        """
+        Explanation:
+        Returns the bit-vector of applied layers, which is already a compact integer.
+
+        Complexity: O(1)
+        """
+        return self.layers_set.elems
+
+    def restore(self, state: int) -> None:
+        """
+        Explanation:
+        Sets the bit-vector of applied layers from a snapshot.
+
+        Complexity: O(1)
+        """
+        old_mask = self.mask
+        self.layers_set.elems = state
+        old = self.hash
+        self.hash = 0
+        index = 0
+        while state:
+            if state & 1:
+                self.hash ^= zobrist.layer_key(index)
+            state >>= 1
+            index += 1
+        self._changed(old, old_mask)
+
+    @property
+    def mask(self) -> int:
+        """ Bit i is set if the layer with index i is applied. BSet already stores index i at bit i. """
+        return self.layers_set.elems
+
+    def replace_layer(self, old: Layer, new: Layer|None) -> bool:
+        """
+        Explanation:
+        Stops applying `old`, and applies `new` instead if it isn't None.
+
+        Complexity: O(1)
+        """
+        if not self.erase(old):
+            return False
+        if new is not None:
+            self.add(new)
+        return True
 
 
    
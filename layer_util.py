@@ -6,6 +6,7 @@ No need to edit unless adding new features.
 
 from __future__ import annotations
 from dataclasses import dataclass, field
+from fractions import Fraction
 from data_structures.referential_array import ArrayR
 
 LAYERS: ArrayR[Layer] = ArrayR(20)
@@ -18,12 +19,26 @@ class Layer:
     apply: function
     name: str = field(init=False)
     bg: tuple[int, int, int] | None = None
+    animated: bool = False
+    kernel: function | None = None
+    period: Fraction | None = None
 
     def __post_init__(self):
         if hasattr(self.apply, "__bg__"):
             self.bg = self.apply.__bg__
+        if hasattr(self.apply, "__animated__"):
+            self.animated = True
+        if hasattr(self.apply, "__kernel__"):
+            self.kernel = self.apply.__kernel__
+        if hasattr(self.apply, "__period__"):
+            self.period = self.apply.__period__
         self.name = self.apply.__name__
 
+    def __reduce__(self):
+        # Layers are registered once per process, so pickle them by index.
+        # This lets grid snapshots be sent to worker processes.
+        return (get_layer, (self.index,))
+
 class background(object):
     """Simple decorator to add a __bg__ property to a layer
 
@@ -43,6 +58,62 @@ class background(object):
         func.__bg__ = self.val
         return layer
 
+def animated(layer: function|Layer):
+    """Decorator to mark a layer whose colour depends on the timestamp,
+    so squares using it have to be redrawn every frame.
+
+    Usage:  @register
+            @animated
+            def my_moving_layer(...):
+    """
+    if isinstance(layer, Layer):
+        layer.apply.__animated__ = True
+        layer.animated = True
+    else:
+        layer.__animated__ = True
+    return layer
+
+class periodic(object):
+    """Decorator to record that an animated layer repeats itself every `period` time units,
+    so exporters can loop the animation instead of rendering it forever.
+    Give periods which aren't whole numbers as a Fraction, so they combine exactly.
+
+    Usage:  @register
+            @periodic(20)
+            @animated
+            def my_moving_layer(...):
+    """
+    def __init__(self, period: int|Fraction):
+        self.val = Fraction(period)
+
+    def __call__(self, layer: function|Layer):
+        if isinstance(layer, Layer):
+            layer.apply.__period__ = self.val
+            layer.period = self.val
+        else:
+            layer.__period__ = self.val
+        return layer
+
+class vectorized(object):
+    """Decorator to give a layer a NumPy kernel, which applies it to many squares at once.
+    The kernel takes an (N, 3) integer array of colours and arrays of N x and N y coordinates,
+    and returns the (N, 3) colours `apply` would give for each square.
+
+    Usage:  @register
+            @vectorized(my_kernel)
+            def my_special_layer(...):
+    """
+    def __init__(self, kernel):
+        self.kernel = kernel
+
+    def __call__(self, layer: function|Layer):
+        if isinstance(layer, Layer):
+            layer.apply.__kernel__ = self.kernel
+            layer.kernel = self.kernel
+        else:
+            layer.__kernel__ = self.kernel
+        return layer
+
 def register(func):
     """
     Layer register function.
@@ -61,3 +132,19 @@ def register(func):
 def get_layers():
     import layers # Force all registrations to occur.
     return LAYERS
+
+def get_layer(index: int) -> Layer:
+    return get_layers()[index]
+
+def animated_mask() -> int:
+    """
+    Returns a mask with bit i set if the layer with index i is animated,
+    to compare against LayerStore.mask.
+    """
+    mask = 0
+    for layer in get_layers():
+        if layer is None:
+            break
+        if layer.animated:
+            mask |= 1 << layer.index
+    return mask
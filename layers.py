@@ -1,11 +1,38 @@
 """
 All layers are defined here.
+
+Kernels give the same colours as their layers for arrays of squares at once (see layer_util.vectorized).
+They only run once NumPy is installed, and import it themselves so this file doesn't need it.
 """
 
 import colorsys
-from layer_util import background, register
+from fractions import Fraction
+from layer_util import animated, background, periodic, register, vectorized
+
+def _hls_value(m1, m2, hue):
+    # colorsys._v, one array of hues at a time
+    import numpy as np
+    hue = hue % 1.0
+    return np.where(hue < 1/6, m1 + (m2 - m1) * hue * 6.0,
+           np.where(hue < 0.5, m2,
+           np.where(hue < 2/3, m1 + (m2 - m1) * (2/3 - hue) * 6.0, m1)))
+
+def _rainbow_kernel(colors, timestamp, xs, ys):
+    import numpy as np
+    # colorsys.hls_to_rgb(h, 0.6, 0.6), step by step so every float comes out the same
+    h = (timestamp/20 + xs/20 + ys/20) % 1
+    m2 = 0.6 + 0.6 - (0.6*0.6)
+    m1 = 2.0*0.6 - m2
+    return np.stack([
+        (255 * _hls_value(m1, m2, h + 1/3)).astype(np.int64),
+        (255 * _hls_value(m1, m2, h)).astype(np.int64),
+        (255 * _hls_value(m1, m2, h - 1/3)).astype(np.int64),
+    ], axis=1)
 
 @register
+@vectorized(_rainbow_kernel)
+@periodic(20) # The hue goes round once every 20 time units
+@animated
 @background(200, 0, 120)
 def rainbow(color, timestamp, x, y):
     return tuple(
@@ -14,11 +41,13 @@ def rainbow(color, timestamp, x, y):
     )
 
 @register
+@vectorized(lambda colors, timestamp, xs, ys: colors * 0)
 @background(170, 170, 170)
 def black(color, timestamp, x, y):
     return (0, 0, 0)
 
 @register
+@vectorized(lambda colors, timestamp, xs, ys: (colors + 40).clip(max=255))
 @background(240, 240, 240)
 def lighten(color, timestamp, x, y):
     return tuple(
@@ -27,6 +56,7 @@ def lighten(color, timestamp, x, y):
     )
 
 @register
+@vectorized(lambda colors, timestamp, xs, ys: 255 - colors)
 @background(0, 255, 255)
 def invert(color, timestamp, x, y):
     return tuple(
@@ -35,21 +65,44 @@ def invert(color, timestamp, x, y):
     )
 
 @register
+@vectorized(lambda colors, timestamp, xs, ys: colors * 0 + (255, 0, 0))
 @background(255, 0, 0)
 def red(color, timestamp, x, y):
     return (255, 0, 0)
 
 @register
+@vectorized(lambda colors, timestamp, xs, ys: colors * 0 + (0, 255, 0))
 @background(0, 255, 0)
 def green(color, timestamp, x, y):
     return (0, 255, 0)
 
 @register
+@vectorized(lambda colors, timestamp, xs, ys: colors * 0 + (0, 0, 255))
 @background(0, 0, 255)
 def blue(color, timestamp, x, y):
     return (0, 0, 255)
 
+def _lcg_steps(other, steps):
+    # Runs the generator in sparkle on each square for its own number of steps
+    import numpy as np
+    for step in range(int(steps.max())):
+        other = np.where(step < steps, (1103515245 * other + 12345) % (1 << 31), other)
+    return other
+
+def _sparkle_kernel(colors, timestamp, xs, ys):
+    import numpy as np
+    ts = ((timestamp + xs/3 + ys/5) * 3).astype(np.int64)
+    steps = 10 + (ts * 31 % 17)
+    other = _lcg_steps(xs, steps) + ys
+    other = _lcg_steps(other, steps)
+    other = (other & ((1 << 31)-1)) >> 16
+    lit = (other/(1 << 15) < 0.1)[:, None]
+    return np.where(lit, lighten.kernel(colors, timestamp, xs, ys), darken.kernel(colors, timestamp, xs, ys))
+
 @register
+@vectorized(_sparkle_kernel)
+@periodic(Fraction(17, 3)) # Only the step count, 10 + ts * 31 % 17, depends on ts = int(3 * timestamp + ...)
+@animated
 @background(100, 170, 255)
 def sparkle(color, timestamp, x, y):
     ts = int((timestamp + x/3 + y/5) * 3)
@@ -66,6 +119,7 @@ def sparkle(color, timestamp, x, y):
     return darken.apply(color, timestamp, x, y)
 
 @register
+@vectorized(lambda colors, timestamp, xs, ys: (colors - 40).clip(min=0))
 @background(30, 30, 30)
 def darken(color, timestamp, x, y):
     return tuple(
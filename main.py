@@ -1,12 +1,18 @@
 import arcade
 import arcade.key as keys
+import argparse
 import math
 from grid import Grid
-from layer_util import get_layers, Layer
+from layer_util import animated_mask, get_layers, Layer
 from layers import lighten
 from undo import UndoTracker
 from replay import ReplayTracker
-from action import PaintAction, PaintStep
+from action import PaintAction, PasteStep
+import memory_report
+import replay_log
+from replay_log import ReplayLogReader, ReplayLogWriter
+from profiler import profiler
+from tile_render import TileRenderPipeline
 
 class MyWindow(arcade.Window):
     """ Painter Window """
@@ -17,7 +23,19 @@ class MyWindow(arcade.Window):
     BUTTONS_HEIGHT = 100
     SCREEN_TITLE = "Paint"
 
-    REPLAY_TIMER_DELTA = 0.05
+    REPLAY_TIMER_DELTA = ReplayTracker.REPLAY_TIMER_DELTA
+    # Replay speed multipliers, cycled with S during a replay. None plays everything that is left at once.
+    REPLAY_SPEEDS = (1, 2, 10, None)
+    # Most replay steps played in one update when catching up after slow frames; the rest wait for the next updates
+    MAX_REPLAY_STEPS_PER_UPDATE = 10
+    SCRUB_BAR_HEIGHT = 12
+    # Tools cycled with F: the brush, then flood fill matching colours, then matching layer stacks.
+    FILL_MODES = (None, "colour", "layers")
+    # Zoom per mouse wheel notch, the largest a square may get on screen,
+    # and the smallest a drawn block may get before squares are merged into blocks
+    ZOOM_FACTOR = 1.25
+    MAX_SQUARE_PIXELS = 64
+    MIN_SQUARE_PIXELS = 4
 
     GRID_SIZE_X = 32
     GRID_SIZE_Y = 32
@@ -39,6 +57,17 @@ class MyWindow(arcade.Window):
         self.y_timer = 0
         self.enable_ui = True
         self.replay_timer = 0
+        self.replay_speed_index = 0
+        self.scrubbing = False
+        self.fill_mode_index = 0
+        self.selecting = False
+        self.clipboard = None
+        self.tile_grid = None # The tiled grid whose tiles are cached in tile_shapes
+        self.tile_shapes = {}
+        self.tile_masks = {}
+        self.render_pipeline = None # A TileRenderPipeline when tiles are evaluated on a process pool
+        self.show_profile = False # Whether the frame time overlay is drawn, toggled with F3
+        self.profile_path = None # Where the profiler's trace is written on close
         self.on_init()
 
     def reset(self) -> None:
@@ -47,9 +76,15 @@ class MyWindow(arcade.Window):
         self.timestamp = 0
 
         self.selected_layer_index = -1
+        self.previous_layer_index = -1
         self.dragging = None
         self.prev_drawn = None
         self.prev_pos = None
+        self.selection = None # (x0, y0, x1, y1) squares at the corners of the selected rectangle
+        self.hover_square = None
+        self.zoom = 1
+        self.view_x = 0
+        self.view_y = 0
         self.draw_size = 2
 
         # Visual calculations
@@ -103,10 +138,43 @@ class MyWindow(arcade.Window):
         """Set up the game and initialize the variables."""
         self.reset()
 
+    @profiler.timed("on_draw")
     def on_draw(self) -> None:
         """Draw everything"""
+        profiler.end_frame() # Frames run from one draw to the next, taking in the input and updates between
         self.clear()
+        # Grid, drawn in grid square units through the view transform
+        left, bottom, right, top = self.visible_rect()
+        arcade.set_viewport(
+            self.view_x, self.view_x + self.SCREEN_WIDTH / self.square_width(),
+            self.view_y, self.view_y + self.SCREEN_HEIGHT / self.square_height(),
+        )
+        step = self.lod_step()
+        if self.grid.tiles is not None:
+            self.draw_tiles(left, bottom, right, top, step)
+        else:
+            with profiler.span("on_draw.colours"):
+                colors = [
+                    (x, y, self.grid[x][y].get_color(self.BG[:], self.timestamp, x, y))
+                    for x in range(left, right, step)
+                    for y in range(bottom, top, step)
+                ]
+            profiler.count("cells", len(colors))
+            with profiler.span("on_draw.submit"):
+                for x, y, color in colors:
+                    arcade.draw_lrtb_rectangle_filled(
+                        x, min(x+step, self.GRID_SIZE_X), min(y+step, self.GRID_SIZE_Y), y, color,
+                    )
+        # Selection
+        if self.selection is not None:
+            x0, y0, x1, y1 = self.selection
+            arcade.draw_lrtb_rectangle_outline(
+                min(x0, x1), max(x0, x1)+1, max(y0, y1)+1, min(y0, y1),
+                (0, 120, 255), border_width=2 / self.square_width(),
+            )
+        arcade.set_viewport(0, self.SCREEN_WIDTH, 0, self.SCREEN_HEIGHT)
         # UI - Layers
+        arcade.draw_lrtb_rectangle_filled(self.DRAW_PANEL, self.SCREEN_WIDTH, self.SCREEN_HEIGHT, 0, self.BG) # Covers the grid when zoomed in
         for i, layer in enumerate(get_layers()):
             if layer is None: break
             xstart = (i % 2) * self.LAYER_BUTTON_SIZE + self.DRAW_PANEL
@@ -123,17 +191,201 @@ class MyWindow(arcade.Window):
             arcade.draw_text(str(i), xstart, (ystart+yend)/2, (0, 0, 0), 18, width=xend-xstart, align="center", bold=True, anchor_y="center")
         # UI - Draw Modes / Action buttons
         self.action_buttons.draw()
-        # Grid
-        for x in range(self.GRID_SIZE_X):
-            for y in range(self.GRID_SIZE_Y):
-                arcade.draw_lrtb_rectangle_filled(
-                    self.GRID_SQ_WIDTH * x,
-                    self.GRID_SQ_WIDTH * (x+1),
-                    self.GRID_SQ_HEIGHT * (y+1),
-                    self.GRID_SQ_HEIGHT * y,
-                    self.grid[x][y].get_color(self.BG[:], self.timestamp, x, y),
-                )
+        # Fill tool indicator
+        fill_mode = self.FILL_MODES[self.fill_mode_index]
+        if fill_mode is not None and self.enable_ui:
+            arcade.draw_text(f"fill: {fill_mode}", 4, 4, (0, 0, 0), 12, bold=True)
+        # Replay scrub bar, only while the replay can seek: a streamed replay log can't go back
+        if not self.enable_ui:
+            if self.replay_tracker.seekable:
+                total = len(self.replay_tracker.history)
+                progress = self.replay_tracker.position / total if total else 1
+                arcade.draw_lrtb_rectangle_filled(0, self.DRAW_PANEL, self.SCRUB_BAR_HEIGHT, 0, (60, 60, 60))
+                arcade.draw_lrtb_rectangle_filled(0, self.DRAW_PANEL * progress, self.SCRUB_BAR_HEIGHT, 0, (240, 200, 0))
+            speed = self.REPLAY_SPEEDS[self.replay_speed_index]
+            arcade.draw_text(
+                f"{speed}x" if speed is not None else "end", 4, self.SCRUB_BAR_HEIGHT + 4, (0, 0, 0), 12, bold=True,
+            )
+        if self.show_profile:
+            self.draw_profile()
+
+    def draw_profile(self) -> None:
+        """Draw the profiler overlay at the top left: frame times, with the last frames as bars,
+        the cells evaluated in the last frame, and the mean time per frame of the slowest spans."""
+        stats = profiler.stats()
+        lines = [
+            f"frame {stats['frame_ms']:.1f} ms  p50 {stats['p50']:.1f}  p99 {stats['p99']:.1f}",
+            f"cells {stats['counts'].get('cells', 0)}",
+        ] + [f"{name} {ms:.2f} ms" for name, ms in list(stats["spans"].items())[:8]]
+        width, line_height, chart_height = 300, 14, 40
+        top = self.SCREEN_HEIGHT
+        bottom = top - chart_height - line_height * len(lines) - 8
+        arcade.draw_lrtb_rectangle_filled(0, width, top, bottom, (0, 0, 0, 180))
+        # One bar per frame, newest on the right, with a line at 60 frames a second
+        frames = list(profiler.frame_ms)[-width:]
+        scale = chart_height / max(max(frames, default=0), 1000 / 30)
+        for i, ms in enumerate(frames):
+            x = width - len(frames) + i
+            arcade.draw_line(x, top - chart_height, x, top - chart_height + ms * scale, (0, 200, 0) if ms <= 1000 / 60 else (255, 80, 0))
+        target = top - chart_height + 1000 / 60 * scale
+        arcade.draw_line(0, target, width, target, (255, 255, 255, 120))
+        for i, line in enumerate(lines):
+            arcade.draw_text(line, 4, top - chart_height - (i + 1) * line_height, (255, 255, 255), 10)
+
+    def draw_tiles(self, left: int, bottom: int, right: int, top: int, step: int) -> None:
+        """Draw the visible part of a tiled grid, tile by tile.
+        Each tile keeps a shape list built at one level of detail, which is only rebuilt when the tile changed,
+        shows an animated layer or is needed at another level of detail. Tiles off screen are never evaluated,
+        and tiles never painted are covered by a single rectangle."""
+        arcade.draw_lrtb_rectangle_filled(
+            left, right, top, bottom, self.grid.blank.get_color(self.BG[:], self.timestamp, 0, 0),
+        )
+        visible = self.update_tile_shapes(left, bottom, right, top, step)
+        with profiler.span("on_draw.submit"):
+            for key in visible:
+                if key in self.tile_shapes:
+                    self.tile_shapes[key][1].draw()
+
+    def update_tile_shapes(self, left: int, bottom: int, right: int, top: int, step: int) -> list[tuple[int, int]]:
+        """Brings the shapes of the visible allocated tiles up to date, and returns their keys.
+        tile_shapes holds (step, shapes, generation) per tile, the generation being the render pipeline's for the tile
+        when its colours were submitted, or 0 without a pipeline.
+        Without a pipeline, changed tiles are rebuilt straight away. With one, colours arrive a frame late,
+        so a changed tile keeps drawing its old shapes until colours from after the change arrive."""
+        if self.tile_grid is not self.grid: # New grid, nothing cached is valid
+            self.tile_grid = self.grid
+            self.tile_shapes = {}
+            self.tile_masks = {}
+        dirty = self.grid.take_dirty_tiles()
+        if self.render_pipeline is None:
+            for key in dirty: # Rebuilt when next visible
+                self.tile_shapes.pop(key, None)
+            generations = {}
+        else:
+            self.render_pipeline.invalidate(dirty)
+            generations = self.render_pipeline.generations
+        animated = animated_mask()
+        size = Grid.TILE_SIZE
+        visible = [
+            (tx, ty)
+            for tx in range(left // size, (right - 1) // size + 1)
+            for ty in range(bottom // size, (top - 1) // size + 1)
+            if (tx, ty) in self.grid.tiles
+        ]
+        stale = [
+            key for key in visible
+            if key not in self.tile_shapes or self.tile_shapes[key][0] != step
+            or self.tile_shapes[key][2] != generations.get(key, 0) or self.tile_masks[key] & animated
+        ]
+        if self.render_pipeline is not None:
+            # Tiles are evaluated on the pool a frame ahead; until a stale tile's colours arrive, its old shapes are drawn
+            with profiler.span("on_draw.pipeline"):
+                frame = self.render_pipeline.next_frame(self.grid, stale, self.timestamp, step, tuple(self.BG))
+            for key, (frame_step, mask, rgb, generation) in frame.items():
+                if key not in self.grid.tiles: # Freed since it was submitted
+                    continue
+                if key in self.tile_shapes and self.tile_shapes[key][2] > generation: # Older than what is drawn
+                    continue
+                # Even if the tile changed again since, these colours are newer than its shapes, and it stays stale
+                colors = [tuple(rgb[i:i+3]) for i in range(0, len(rgb), 3)]
+                shapes = self.build_tile_shape(self.grid.tiles[key], frame_step, colors)[0]
+                self.tile_shapes[key] = (frame_step, shapes, generation)
+                self.tile_masks[key] = mask
+        else:
+            with profiler.span("on_draw.colours"):
+                for key in stale:
+                    shapes, self.tile_masks[key] = self.build_tile_shape(self.grid.tiles[key], step)
+                    self.tile_shapes[key] = (step, shapes, 0)
+        return visible
+
+    def build_tile_shape(self, tile, step: int, colors: list|None=None) -> tuple[arcade.ShapeElementList, int]:
+        """Builds the shapes for a tile in grid square units, evaluating colours at the current timestamp
+        unless they are given, one per block, column by column.
+        With a step above 1, each step x step block is drawn in the colour of its bottom left square.
+        Returns them with the mask of layers used in the tile."""
+        points = []
+        point_colors = []
+        mask = 0
+        block = 0
+        for i in range(0, tile.width, step):
+            for j in range(0, tile.height, step):
+                x, y = tile.x0 + i, tile.y0 + j
+                if colors is not None:
+                    color = colors[block]
+                    block += 1
+                else:
+                    store = tile.stores[i * tile.height + j]
+                    color = store.get_color(self.BG[:], self.timestamp, x, y)
+                    block += 1
+                right, top = tile.x0 + min(i+step, tile.width), tile.y0 + min(j+step, tile.height)
+                points += [(x, top), (right, top), (right, y), (x, y)]
+                point_colors += [color] * 4
+        if colors is None:
+            profiler.count("cells", block)
+            for i in range(len(tile.stores)): # Including squares skipped over, which can still be animated
+                mask |= tile.stores[i].mask
+        shapes = arcade.ShapeElementList()
+        shapes.append(arcade.create_rectangles_filled_with_colors(points, point_colors))
+        return shapes, mask
+
+    # View transform: the draw panel shows the grid from square (view_x, view_y) at the bottom left,
+    # with each square zoom times bigger than when the whole grid fits.
+
+    def square_width(self) -> float:
+        """On-screen width of a grid square, in pixels."""
+        return self.GRID_SQ_WIDTH * self.zoom
+
+    def square_height(self) -> float:
+        """On-screen height of a grid square, in pixels."""
+        return self.GRID_SQ_HEIGHT * self.zoom
+
+    def to_square(self, x: float, y: float) -> tuple[int, int]:
+        """The grid square under a point of the draw panel. May be outside the grid."""
+        return (
+            math.floor(self.view_x + x / self.square_width()),
+            math.floor(self.view_y + y / self.square_height()),
+        )
 
+    def visible_rect(self) -> tuple[int, int, int, int]:
+        """The squares intersecting the draw panel, as (left, bottom, right, top) with right and top exclusive."""
+        left, bottom = self.to_square(0, 0)
+        right = math.ceil(self.view_x + self.DRAW_PANEL / self.square_width())
+        top = math.ceil(self.view_y + self.SCREEN_HEIGHT / self.square_height())
+        return max(left, 0), max(bottom, 0), min(right, self.GRID_SIZE_X), min(top, self.GRID_SIZE_Y)
+
+    def lod_step(self) -> int:
+        """How many squares each drawn block covers along each axis. A power of two,
+        so that blocks are at least MIN_SQUARE_PIXELS on screen and line up with tiles."""
+        step = 1
+        while min(self.square_width(), self.square_height()) * step < self.MIN_SQUARE_PIXELS and step < Grid.TILE_SIZE:
+            step *= 2
+        return step
+
+    def set_view(self, zoom: float, view_x: float, view_y: float) -> None:
+        """Moves the view, keeping the zoom within [1, MAX_SQUARE_PIXELS per square] and the view on the grid."""
+        max_zoom = max(1, self.MAX_SQUARE_PIXELS / min(self.GRID_SQ_WIDTH, self.GRID_SQ_HEIGHT))
+        self.zoom = min(max(zoom, 1), max_zoom)
+        self.view_x = min(max(view_x, 0), self.GRID_SIZE_X * (1 - 1 / self.zoom))
+        self.view_y = min(max(view_y, 0), self.GRID_SIZE_Y * (1 - 1 / self.zoom))
+
+    @profiler.timed("input")
+    def on_mouse_scroll(self, x: int, y: int, scroll_x: int, scroll_y: int) -> None:
+        """Called when the mouse wheel is scrolled. Zooms around the mouse."""
+        if x > self.DRAW_PANEL:
+            return
+        gx = self.view_x + x / self.square_width()
+        gy = self.view_y + y / self.square_height()
+        self.set_view(self.zoom * self.ZOOM_FACTOR ** scroll_y, self.view_x, self.view_y)
+        self.set_view(self.zoom, gx - x / self.square_width(), gy - y / self.square_height())
+
+    def on_mouse_drag(self, x: int, y: int, dx: int, dy: int, buttons: int, modifiers: int) -> None:
+        """Called when the mouse moves with a button held. The right button pans the view."""
+        if buttons & arcade.MOUSE_BUTTON_RIGHT:
+            self.set_view(self.zoom, self.view_x - dx / self.square_width(), self.view_y - dy / self.square_height())
+            return
+        self.on_mouse_motion(x, y, dx, dy)
+
+    @profiler.timed("input")
     def on_mouse_press(self, x: int, y: int, button: int, modifiers: int) -> None:
         """Called when the mouse buttons are pressed."""
         if x > self.DRAW_PANEL:
@@ -147,6 +399,8 @@ class MyWindow(arcade.Window):
                 ystart = self.SCREEN_HEIGHT - (i//2) * self.LAYER_BUTTON_SIZE
                 yend = self.SCREEN_HEIGHT - (i//2+1) * self.LAYER_BUTTON_SIZE
                 if xstart <= x < xend and yend <= y < ystart:
+                    if i != self.selected_layer_index:
+                        self.previous_layer_index = self.selected_layer_index
                     self.selected_layer_index = i
                     break
             # Actions
@@ -180,18 +434,47 @@ class MyWindow(arcade.Window):
             yend = 2 * self.LAYER_BUTTON_SIZE
             if xstart <= x < xend and yend <= y < ystart:
                 self.on_special()
+        elif button == arcade.MOUSE_BUTTON_RIGHT:
+            pass # Right dragging pans the view, see on_mouse_drag
+        elif not self.enable_ui:
+            if y < self.SCRUB_BAR_HEIGHT and self.replay_tracker.seekable:
+                self.scrubbing = True
+                self.on_replay_seek(x / self.DRAW_PANEL)
+        elif modifiers & keys.MOD_SHIFT:
+            # Start selecting a rectangle
+            px, py = self.to_square(x, y)
+            self.selecting = True
+            self.selection = (px, py, px, py)
+        elif self.FILL_MODES[self.fill_mode_index] is not None:
+            px, py = self.to_square(x, y)
+            if self.selected_layer_index != -1 and 0 <= px < self.GRID_SIZE_X and 0 <= py < self.GRID_SIZE_Y:
+                self.on_fill(get_layers()[self.selected_layer_index], px, py)
         else:
             self.dragging = True
             self.try_draw(x, y)
 
+    @profiler.timed("input")
     def on_mouse_release(self, x: int, y: int, button: int, modifiers: int):
         """Called when the mouse buttons are released."""
         self.dragging = False
+        self.scrubbing = False
+        self.selecting = False
         self.prev_drawn = None
         self.prev_pos = None
 
+    @profiler.timed("input")
     def on_mouse_motion(self, x, y, dx, dy) -> None:
         """Called when the mouse moves."""
+        if self.scrubbing:
+            self.on_replay_seek(min(max(x / self.DRAW_PANEL, 0), 1))
+            return
+        px, py = self.to_square(x, y)
+        px = min(max(px, 0), self.GRID_SIZE_X - 1)
+        py = min(max(py, 0), self.GRID_SIZE_Y - 1)
+        self.hover_square = (px, py)
+        if self.selecting:
+            self.selection = self.selection[:2] + (px, py)
+            return
         if not self.dragging:
             return
         if not(0 <= self.selected_layer_index < len(get_layers())):
@@ -200,12 +483,39 @@ class MyWindow(arcade.Window):
             return
         self.try_draw(x, y)
 
+    @profiler.timed("input")
     def on_key_press(self, symbol: int, modifiers: int) -> None:
         """Called when a keyboard key is pressed."""
+        if symbol == keys.HOME: # Show the whole grid again
+            self.set_view(1, 0, 0)
+        if symbol == keys.F3: # Frame time overlay, which needs the profiler on
+            self.show_profile = not self.show_profile
+            profiler.enabled = self.show_profile or self.profile_path is not None
+        if symbol == keys.F4:
+            self.on_memory_report()
         if not self.enable_ui:
+            if symbol == keys.S:
+                self.replay_speed_index = (self.replay_speed_index + 1) % len(self.REPLAY_SPEEDS)
             return
         self.z_pressed = keys.Z == symbol and (modifiers & keys.MOD_CTRL)
         self.y_pressed = keys.Y == symbol and (modifiers & keys.MOD_CTRL)
+        if keys.B == symbol and (modifiers & keys.MOD_CTRL):
+            self.on_switch_branch()
+        if keys.C == symbol and (modifiers & keys.MOD_CTRL) and self.selection is not None:
+            x0, y0, x1, y1 = self.selection
+            self.on_copy(min(x0, x1), min(y0, y1), abs(x1 - x0) + 1, abs(y1 - y0) + 1)
+        if keys.V == symbol and (modifiers & keys.MOD_CTRL) and self.hover_square is not None:
+            self.on_paste(*self.hover_square)
+        if symbol == keys.ESCAPE:
+            self.selection = None
+        if symbol == keys.F:
+            self.fill_mode_index = (self.fill_mode_index + 1) % len(self.FILL_MODES)
+        if symbol == keys.DELETE and self.selected_layer_index != -1:
+            self.on_erase_layer_everywhere(get_layers()[self.selected_layer_index])
+        if symbol == keys.R and self.selected_layer_index != -1 and self.previous_layer_index != -1:
+            # Replace the previously selected layer with the selected one
+            layers = get_layers()
+            self.on_replace_layer(layers[self.previous_layer_index], layers[self.selected_layer_index])
         if self.z_pressed:
             self.on_undo()
             self.z_timer = 0.5
@@ -232,14 +542,10 @@ class MyWindow(arcade.Window):
                 distance = min(d * increment / mhat_dist, 1)
                 nx = distance * (x - self.prev_pos[0]) + self.prev_pos[0]
                 ny = distance * (y - self.prev_pos[1]) + self.prev_pos[1]
-                nx_pos = int(nx // self.GRID_SQ_WIDTH)
-                ny_pos = int(ny // self.GRID_SQ_HEIGHT)
-                points_to_draw.append((nx_pos, ny_pos))
+                points_to_draw.append(self.to_square(nx, ny))
         else:
-            x_pos = int(x // self.GRID_SQ_WIDTH)
-            y_pos = int(y // self.GRID_SQ_HEIGHT)
             points_to_draw = [
-                (x_pos, y_pos)
+                self.to_square(x, y)
             ]
         for px, py in points_to_draw:
             if self.prev_drawn is None or (px, py) != self.prev_drawn:
@@ -253,8 +559,10 @@ class MyWindow(arcade.Window):
         self.enable_ui = False
         self.grid = Grid(self.draw_style, self.GRID_SIZE_X, self.GRID_SIZE_Y)
         self.replay_timer = self.REPLAY_TIMER_DELTA
+        self.replay_speed_index = 0
         self.on_replay_start()
 
+    @profiler.timed("on_update")
     def on_update(self, delta_time) -> None:
         """Movement and game logic."""
         self.timestamp += delta_time
@@ -269,10 +577,19 @@ class MyWindow(arcade.Window):
                 self.on_redo()
                 self.y_timer += 0.05
         if not self.enable_ui:
-            self.replay_timer -= delta_time
-            if self.replay_timer <= 0:
-                self.replay_timer += self.REPLAY_TIMER_DELTA
-                finished = self.on_replay_next_step()
+            speed = self.REPLAY_SPEEDS[self.replay_speed_index]
+            if speed is None:
+                steps = None # Everything left, including actions still streaming from a log
+            else:
+                # Play the steps that fell due this frame, so slow frames catch up instead of slowing the replay.
+                # A long stall is caught up over several updates, so one update never plays an unbounded number.
+                self.replay_timer -= delta_time * speed
+                steps = 0
+                if self.replay_timer <= 0:
+                    steps = min(int(-self.replay_timer // self.REPLAY_TIMER_DELTA) + 1, self.MAX_REPLAY_STEPS_PER_UPDATE)
+                    self.replay_timer += steps * self.REPLAY_TIMER_DELTA
+            if steps is None or steps > 0:
+                finished = self.on_replay_next_steps(steps)
                 if finished:
                     self.enable_ui = True
 
@@ -291,12 +608,12 @@ class MyWindow(arcade.Window):
     def on_init(self) -> None:
         """Initialisation that occurs after the system initialisation.
 
-        Complexity: O(n + m)
-        n: The size of the ArrayStack in undo_tracker
+        Complexity: O(m)
         m: The size of the CircularQueue in replay_tracker
         """
         self.undo_tracker = UndoTracker()
         self.replay_tracker = ReplayTracker()
+        self.replay_log: ReplayLogWriter|None = None
         
     
     def on_reset(self) -> None:
@@ -304,10 +621,12 @@ class MyWindow(arcade.Window):
         
         Complexity: O(1)
         """
-        self.undo_tracker.tracker.clear() # Clear the undo tracker 
-        self.undo_tracker.undone.clear()
-        self.replay_tracker.actions.clear() # Clear the replay tracker
+        self.undo_tracker.clear() # Clear the undo tracker 
+        self.replay_tracker.clear() # Clear the replay tracker
+        if self.replay_log is not None: # The log only keeps the current session
+            self.replay_log.restart(self.draw_style, self.GRID_SIZE_X, self.GRID_SIZE_Y)
 
+    @profiler.timed("on_paint")
     def on_paint(self, layer: Layer, px: int, py: int) -> None:
         """
         Called when a grid square is clicked on, which should trigger painting in the vicinity.
@@ -317,40 +636,114 @@ class MyWindow(arcade.Window):
         px: x position of the brush.
         py: y position of the brush.
 
-        complexity: O(n^2)
-        n: is 2*brush size (negative and positive) + 1 (for 0)
+        The squares in the brush's diamond are painted in one Grid.apply_many pass,
+        recorded as a single BulkPaintStep of the squares that changed.
+
+        complexity: O(apply_many) over the b = 2*size*(size+1) + 1 squares of the diamond, O(b * add)
+        size: the brush size
         """
-        action = PaintAction()
-        manhattan_distance = self.grid.brush_size
-        for i in range(-manhattan_distance, manhattan_distance+1): # Loops through from negative size to positive size + 1 (accounting for 0)
-            for j in range(-manhattan_distance, manhattan_distance+1): # Loops through from negative size to positive size + 1 (accounting for 0)
-                if abs(i) + abs(j) <= manhattan_distance and px+i >= 0 and px+i < len(self.grid.grid)\
-                    and py+j >= 0 and py+j < len(self.grid.grid): # Check whether it's a valid position to add a layer on the grid
-                    if self.grid[px+i][py+j].add(layer): # If add process is successful add step into action
-                        action.add_step(PaintStep((px+i, py+j), layer))
-   
+        action = self.grid.apply_many(self.grid.brush_cells(px, py, self.grid.brush_size), layer) # Adds the layer in the brush's diamond
         self.undo_tracker.add_action(action) # Store the action into undo_tracker
-        self.replay_tracker.add_action(action) # Store the action into replay_tracker
+        self.replay_tracker.add_action(action, grid=self.grid) # Store the action into replay_tracker
+        if self.replay_log is not None:
+            self.replay_log.write(replay_log.PAINT, action)
                 
     def on_undo(self) -> None:
         """Called when an undo is requested.
         
-        Complexity: O(n)
-        n: The amount of PaintSteps in the action's steps list
+        Complexity: O(s + undo_apply)
+        s: The number of steps in the action, for decoding it if it is packed
+        undo_apply: Undoing each step, O(k) for a BulkPaintStep of k squares, O(nm . special) for a special
         """
         action = self.undo_tracker.undo(self.grid) # Undo the action
         if action != None:
-            self.replay_tracker.add_action(action, True) # Add action to replay_tracker
+            self.replay_tracker.add_action(action, True, self.grid) # Add action to replay_tracker
+            if self.replay_log is not None:
+                self.replay_log.write(replay_log.UNDO, action)
 
     def on_redo(self) -> None:
         """Called when a redo is requested.
         
-        Complexity: O(n)
-        n: The amount of PaintSteps in the action's steps list
+        Complexity: O(s + redo_apply)
+        s: The number of steps in the action, for decoding it if it is packed
+        redo_apply: Redoing each step, O(k) for a BulkPaintStep of k squares, O(nm . special) for a special
         """
         action = self.undo_tracker.redo(self.grid) # Redo the action
         if action != None:
-            self.replay_tracker.add_action(action) # Add the action to replay_tracker
+            self.replay_tracker.add_action(action, grid=self.grid) # Add the action to replay_tracker
+            if self.replay_log is not None:
+                self.replay_log.write(replay_log.REDO, action)
+
+    def record_action(self, action: PaintAction) -> None:
+        """Stores a newly applied action in the undo and replay trackers, and the replay log if recording.
+
+        Complexity: O(add_action)
+        """
+        self.undo_tracker.add_action(action)
+        self.replay_tracker.add_action(action, grid=self.grid)
+        if self.replay_log is not None:
+            self.replay_log.write(replay_log.PAINT, action)
+
+    def on_erase_layer_everywhere(self, layer: Layer) -> None:
+        """Called when erasing a layer from the whole canvas is requested. Recorded as one undoable action, if anything changed.
+
+        Complexity: O(k . replace_layer)
+        k: The number of grid squares using the layer
+        """
+        changes = self.grid.erase_layer(layer)
+        if changes:
+            self.record_action(PaintAction.from_restores(changes))
+
+    def on_replace_layer(self, old: Layer, new: Layer) -> None:
+        """Called when replacing one layer with another on the whole canvas is requested. Recorded as one undoable action, if anything changed.
+
+        Complexity: O(k . replace_layer)
+        k: The number of grid squares using the old layer
+        """
+        changes = self.grid.replace_layer(old, new)
+        if changes:
+            self.record_action(PaintAction.from_restores(changes))
+
+    def on_fill(self, layer: Layer, px: int, py: int) -> None:
+        """Called when the fill tool is used on a grid square. Recorded as one undoable action.
+
+        Complexity: O(fill_region + apply_many)
+        """
+        region = self.grid.fill_region(
+            px, py, self.FILL_MODES[self.fill_mode_index] == "layers", self.timestamp, self.BG[:],
+        )
+        action = self.grid.apply_many(zip(region[::2], region[1::2]), layer)
+        if action.steps:
+            self.record_action(action)
+
+    def on_copy(self, x: int, y: int, width: int, height: int) -> None:
+        """Called when copying a rectangle of the canvas is requested. Its squares share their layers with the clipboard.
+
+        Complexity: O(copy_region)
+        """
+        self.clipboard = self.grid.copy_region(x, y, width, height)
+
+    def on_paste(self, px: int, py: int) -> None:
+        """Called when pasting the clipboard with its bottom left square at (px, py) is requested. Recorded as one undoable action.
+
+        Complexity: O(paste_region)
+        """
+        if self.clipboard is None:
+            return
+        changes = self.grid.paste_region(self.clipboard, px, py)
+        if changes:
+            self.record_action(PaintAction([PasteStep.from_changes(changes)]))
+
+    def on_switch_branch(self) -> None:
+        """Called when switching to the next undo branch is requested.
+
+        Complexity: O(switch_branch)
+        switch_branch: The complexity of UndoTracker.switch_branch
+        """
+        for action, is_undo in self.undo_tracker.switch_branch(self.grid):
+            self.replay_tracker.add_action(action, is_undo, self.grid)
+            if self.replay_log is not None:
+                self.replay_log.write(replay_log.UNDO if is_undo else replay_log.REDO, action)
 
     def on_special(self) -> None:
         """Called when the special action is requested.
@@ -360,11 +753,12 @@ class MyWindow(arcade.Window):
         m: The length f the Y/vertical of the grid (self.grid.y)
         Special because special functions may differ depending on the type of layer store
         """
-        self.grid.special()
-
-        action = PaintAction(0, is_special = True)
+        action = PaintAction(is_special = True)
+        action.redo_apply(self.grid) # Applies the special and records which squares it changed
         self.undo_tracker.add_action(action) # Add action to undo_tracker
-        self.replay_tracker.add_action(action) # Add action to replay_tracker
+        self.replay_tracker.add_action(action, grid=self.grid) # Add action to replay_tracker
+        if self.replay_log is not None:
+            self.replay_log.write(replay_log.SPECIAL, action)
 
     def on_replay_start(self):
         """Called when the replay starting is requested.
@@ -385,6 +779,71 @@ class MyWindow(arcade.Window):
         Special because the time complexity may differ depending on the type of layer store
         """
         return self.replay_tracker.play_next_action(self.grid)
+
+    @profiler.timed("replay")
+    def on_replay_next_steps(self, count: int|None) -> bool:
+        """
+        Called when several replay steps fell due in the same frame, or with None when the rest should be played at once.
+        Returns whether the replay is finished.
+
+        Complexity: O(count . nm . special)
+        Worst case when every action played is special
+        """
+        if count == 1:
+            return self.on_replay_next_step()
+        return self.replay_tracker.play_next_actions(self.grid, count)
+
+    def start_recording(self, path: str) -> None:
+        """Starts appending every action of the current session to a replay log at `path`.
+
+        Complexity: O(1)
+        """
+        self.replay_log = ReplayLogWriter(path, self.draw_style, self.GRID_SIZE_X, self.GRID_SIZE_Y)
+
+    def load_replay(self, path: str) -> None:
+        """Replays a session saved with `start_recording`, streaming its actions from the file.
+
+        Complexity: O(Grid.__init__)
+        """
+        log = ReplayLogReader(path)
+        self.draw_style = log.draw_style
+        self.GRID_SIZE_X = log.x
+        self.GRID_SIZE_Y = log.y
+        self.reset()
+        self.start_replay()
+        self.replay_tracker.add_source(log)
+
+    def on_close(self) -> None:
+        """Called when the window is closed."""
+        if self.replay_log is not None:
+            self.replay_log.close()
+        if self.render_pipeline is not None:
+            self.render_pipeline.close()
+        if self.profile_path is not None:
+            profiler.export_chrome_trace(self.profile_path)
+        super().on_close()
+
+    def on_memory_report(self) -> None:
+        """Called when a memory report is requested. Prints the bytes held by the grid, actions and trackers.
+
+        Complexity: O(k)
+        k: The number of objects the session holds
+        """
+        print(memory_report.format_session(
+            memory_report.session_report(self.grid, self.undo_tracker, self.replay_tracker)
+        ))
+
+    @profiler.timed("replay")
+    def on_replay_seek(self, fraction: float) -> None:
+        """Called when the replay scrub bar is clicked or dragged.
+        Jumps the replay to `fraction` of the way through the recorded actions.
+
+        Complexity: O(seek)
+        seek: The complexity of ReplayTracker.seek
+        """
+        index = round(fraction * len(self.replay_tracker.history))
+        self.replay_tracker.seek(self.grid, index)
+        self.replay_timer = self.REPLAY_TIMER_DELTA
         
     def on_increase_brush_size(self) -> None:
         """Called when an increase to the brush size is requested.
@@ -402,8 +861,30 @@ class MyWindow(arcade.Window):
 
 def main():
     """ Main function """
+    p = argparse.ArgumentParser()
+    p.add_argument("--record", help="Save the session to this replay log as you paint.")
+    p.add_argument("--replay", help="Play back a replay log saved with --record.")
+    p.add_argument("--size", type=int, nargs=2, metavar=("X", "Y"),
+                   help="Grid size in squares. Large canvases (e.g. 1024 1024) are stored and drawn in tiles.")
+    p.add_argument("--render-workers", type=int, metavar="N",
+                   help="Evaluate the colours of a large canvas on N processes (0 for one per core).")
+    p.add_argument("--profile", metavar="TRACE",
+                   help="Time the drawing, input, painting and replay, and write a Chrome trace here on close.")
+    args = p.parse_args()
+
     window = MyWindow()
+    if args.size:
+        window.GRID_SIZE_X, window.GRID_SIZE_Y = args.size
     window.setup()
+    if args.render_workers is not None:
+        window.render_pipeline = TileRenderPipeline(args.render_workers)
+    if args.replay:
+        window.load_replay(args.replay)
+    if args.record:
+        window.start_recording(args.record)
+    if args.profile:
+        window.profile_path = args.profile
+        profiler.enabled = True
     arcade.run()
 
 def run_with_func(func, pause=False):
@@ -0,0 +1,293 @@
+"""
+Memory footprint of a painting session, and projections for other grid sizes.
+
+`session_report` walks the objects a session holds with sys.getsizeof, and breaks their bytes down into
+the grid's stores, the rest of the grid, the actions, the undo tree and the replay tracker's queue, history
+and keyframes. Anything shared is counted once, under the first of CATEGORIES that reaches it:
+the actions, for instance, are shared by the undo tree and the replay history, and are counted on their own.
+Layers, functions, classes and modules are shared by every session, and aren't counted.
+
+`project` measures sample grids and a sample session of a draw style the same way, and scales them up
+to a target grid size and number of actions. The sample grids are traced with tracemalloc too,
+which also sees the allocator's overhead, as a check on the walker.
+
+Usage:
+    python memory_report.py --size 1024 1024 --actions 10000
+    python memory_report.py --size 512 512 --style ADD --depth 4 --coverage 0.25
+    python memory_report.py --replay session.sprl
+
+Press F4 in the window to print the report of the session being painted.
+"""
+from __future__ import annotations
+import argparse
+import ctypes
+import sys
+import tracemalloc
+from types import BuiltinFunctionType, FunctionType, MethodType, ModuleType
+from grid import Grid
+from layer_util import Layer, get_layers
+from replay import ReplayTracker
+from undo import UndoTracker
+
+CATEGORIES = (
+    "grid.stores", "grid.index", "grid", "actions", "undo", "replay.queue", "replay.history", "replay.keyframes",
+)
+SHARED_TYPES = (type, ModuleType, FunctionType, BuiltinFunctionType, MethodType, Layer)
+SAMPLE_SIZES = (32, 64) # Sides of the sample grids projections are fitted to
+SAMPLE_ACTIONS = 2 * ReplayTracker.KEYFRAME_INTERVAL
+
+def deep_sizeof(obj, seen: set[int]|None=None) -> int:
+    """
+    Returns the bytes held by an object and everything it refers to which isn't in `seen` yet,
+    following attributes, slots, containers and ctypes arrays (so ArrayR counts its references).
+    Everything counted is added to `seen`.
+
+    Complexity: O(k)
+    k: The number of objects reached
+    """
+    if seen is None:
+        seen = set()
+    total = 0
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or obj is None or isinstance(obj, SHARED_TYPES):
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+        if isinstance(obj, (str, bytes, bytearray, int, float, range)):
+            continue
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)) or type(obj).__name__ == "deque":
+            stack.extend(obj)
+        elif isinstance(obj, ctypes.Array):
+            total += ctypes.sizeof(obj) # Held outside the object itself
+            if obj._type_ is ctypes.py_object:
+                stack.extend(item for item in obj[:] if item is not None)
+        if hasattr(obj, "__dict__"):
+            stack.append(obj.__dict__)
+        for cls in type(obj).__mro__:
+            for name in getattr(cls, "__slots__", ()):
+                if hasattr(obj, name) and name != "__dict__":
+                    stack.append(getattr(obj, name))
+    return total
+
+def session_report(grid: Grid, undo: UndoTracker|None=None, replay: ReplayTracker|None=None) -> dict:
+    """
+    Returns the bytes a session holds in each of CATEGORIES, with "total", and what they were counted over:
+    the squares whose stores exist, the distinct actions, the undo nodes and the keyframes.
+
+    Complexity: O(k)
+    k: The number of objects the session holds
+    """
+    seen = {id(grid)} # Stores refer back to their grid
+    bytes_held = dict.fromkeys(CATEGORIES, 0)
+    if grid.tiles is not None:
+        bytes_held["grid.stores"] = deep_sizeof(grid.tiles, seen)
+        squares = sum(len(tile.stores) for tile in grid.tiles.values())
+    else:
+        bytes_held["grid.stores"] = deep_sizeof(grid.grid, seen)
+        squares = grid.x * grid.y
+    bytes_held["grid.index"] = deep_sizeof(grid.layer_cells, seen)
+    seen.discard(id(grid))
+    bytes_held["grid"] = deep_sizeof(grid, seen)
+
+    actions = {}
+    nodes = 0
+    if undo is not None:
+        stack = [undo.root]
+        while stack:
+            node = stack.pop()
+            nodes += 1
+            if node.action is not None:
+                actions[id(node.action)] = node.action
+            stack.extend(node.children)
+    keyframes = 0
+    if replay is not None:
+        for item in replay.history:
+            actions[id(item.key)] = item.key
+        keyframes = sum(1 for keyframe in replay.keyframes if keyframe is not None)
+    bytes_held["actions"] = deep_sizeof(list(actions.values()), seen)
+    if undo is not None:
+        bytes_held["undo"] = deep_sizeof(undo, seen)
+    if replay is not None:
+        bytes_held["replay.queue"] = deep_sizeof(replay.actions, seen)
+        bytes_held["replay.keyframes"] = deep_sizeof(replay.keyframes, seen)
+        bytes_held["replay.history"] = deep_sizeof(replay, seen) # The history, hashes and the rest
+    bytes_held["total"] = sum(bytes_held.values())
+    return {
+        "bytes": bytes_held,
+        "squares": squares,
+        "actions": len(actions),
+        "undo_nodes": nodes,
+        "keyframes": keyframes,
+    }
+
+def traced_bytes(build) -> tuple[int, object]:
+    """
+    Calls build() and returns the bytes it left allocated, as traced by tracemalloc, with what it returned.
+
+    Complexity: O(build)
+    """
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        result = build()
+        return tracemalloc.get_traced_memory()[0] - before, result
+    finally:
+        if not tracing:
+            tracemalloc.stop()
+
+def painted_grid(draw_style: str, size: int, depth: int, tiled: bool|None=None) -> Grid:
+    """
+    Returns a size x size grid with `depth` layers added to every square (or none, if depth is 0).
+
+    Complexity: O(size^2 . depth)
+    """
+    grid = Grid(draw_style, size, size, tiled)
+    layers = [layer for layer in get_layers() if layer is not None]
+    squares = [(x, y) for x in range(size) for y in range(size)]
+    for i in range(depth):
+        grid.apply_many(squares, layers[i % len(layers)])
+    if depth == 0 and grid.tiles is not None:
+        for x in range(0, size, Grid.TILE_SIZE):
+            for y in range(0, size, Grid.TILE_SIZE):
+                grid.store_at(x, y) # Tiles have to exist to be measured
+    return grid
+
+def sample_session(draw_style: str, size: int, actions: int, seed: int=0) -> tuple[Grid, UndoTracker, ReplayTracker]:
+    """
+    Returns a session of `actions` random brush strokes, recorded by the trackers as MyWindow.on_paint does.
+
+    Complexity: O(actions . stroke)
+    """
+    import random
+    rng = random.Random(seed)
+    layers = [layer for layer in get_layers() if layer is not None]
+    grid = Grid(draw_style, size, size)
+    undo, replay = UndoTracker(), ReplayTracker()
+    for _ in range(actions):
+        action = grid.stroke([(rng.randrange(size), rng.randrange(size))], Grid.DEFAULT_BRUSH_SIZE, rng.choice(layers))
+        undo.add_action(action)
+        replay.add_action(action, grid=grid)
+    return grid, undo, replay
+
+def project(
+    draw_style: str, x: int, y: int, actions: int=0, depth: int=1, coverage: float=1.0, tiled: bool|None=None,
+) -> dict[str, int]:
+    """
+    Projects the bytes a session holds on an x by y grid after `actions` brush strokes, in each of CATEGORIES
+    and in total, with `depth` layers on every painted square. On a tiled grid only `coverage` of it is painted.
+    "grid.traced" is the whole grid as tracemalloc sees it, to check the walker against.
+
+    The grid's categories are fitted to fixed + per square bytes over painted grids of SAMPLE_SIZES.
+    The history is scaled from a sample session of SAMPLE_ACTIONS strokes: actions, undo nodes and history
+    by the number of actions, the queue is fixed, and each keyframe copies the painted squares.
+
+    Complexity: O(sample grids and session)
+    """
+    if tiled is None:
+        tiled = x * y >= Grid.LARGE_CANVAS_SQUARES
+    squares = x * y * (coverage if tiled else 1)
+
+    def fit(small: float, large: float) -> int:
+        # Fixed + per square bytes through the two sample sizes, at the target's squares
+        per_square = max(large - small, 0) / (SAMPLE_SIZES[1] ** 2 - SAMPLE_SIZES[0] ** 2)
+        return round(max(small - per_square * SAMPLE_SIZES[0] ** 2, 0) + per_square * squares)
+
+    grids = [session_report(painted_grid(draw_style, size, depth, tiled))["bytes"] for size in SAMPLE_SIZES]
+    traced = [traced_bytes(lambda: painted_grid(draw_style, size, depth, tiled))[0] for size in SAMPLE_SIZES]
+    size = SAMPLE_SIZES[1]
+    sample = session_report(*sample_session(draw_style, size, SAMPLE_ACTIONS))
+    held = sample["bytes"]
+    keyframe_per_square = held["replay.keyframes"] / max(sample["keyframes"], 1) / (size * size)
+    scale = actions / SAMPLE_ACTIONS
+    projected = {name: fit(grids[0][name], grids[1][name]) for name in ("grid.stores", "grid.index", "grid")}
+    projected.update({
+        "actions": round(held["actions"] * scale),
+        "undo": round(held["undo"] * scale),
+        "replay.queue": held["replay.queue"],
+        "replay.history": round(held["replay.history"] * scale),
+        "replay.keyframes": round(keyframe_per_square * squares * (actions // ReplayTracker.KEYFRAME_INTERVAL)),
+    })
+    projected["total"] = sum(projected.values())
+    projected["grid.traced"] = fit(*traced) # All of the grid as tracemalloc sees it, allocator overhead included
+    return projected
+
+def _format_bytes(n: float) -> str:
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if abs(n) < 1024 or unit == "GiB":
+            return f"{n:.0f} {unit}" if unit == "B" else f"{n:.1f} {unit}"
+        n /= 1024
+
+def format_report(columns: dict[str, dict[str, int]]) -> str:
+    """
+    Lays out byte counts by category as a table, one column per key of `columns`.
+
+    Complexity: O(columns)
+    """
+    rows = CATEGORIES + ("total",)
+    if any("grid.traced" in held for held in columns.values()):
+        rows += ("grid.traced",)
+    lines = [f"{'':18}" + "".join(f"{name:>14}" for name in columns)]
+    for row in rows:
+        lines.append(f"{row:18}" + "".join(f"{_format_bytes(held.get(row, 0)):>14}" for held in columns.values()))
+    return "\n".join(lines)
+
+def format_session(report: dict) -> str:
+    """
+    Lays out a session_report as a table, followed by what it was counted over.
+
+    Complexity: O(1)
+    """
+    return format_report({"session": report["bytes"]}) + (
+        f"\n{report['squares']} squares, {report['actions']} actions, "
+        f"{report['undo_nodes']} undo nodes, {report['keyframes']} keyframes"
+    )
+
+def replay_session(path: str) -> tuple[Grid, UndoTracker, ReplayTracker]:
+    """
+    Rebuilds the session recorded in a replay log, with its grid and trackers as the window held them.
+    Redos are added as new actions, so the undo tree can come out a little bigger than the window's.
+
+    Complexity: O(log length . stroke)
+    """
+    from replay_log import ReplayLogReader
+    log = ReplayLogReader(path)
+    grid = log.make_grid()
+    undo, replay = UndoTracker(), ReplayTracker()
+    for action, is_undo in log:
+        if is_undo:
+            action = undo.undo(grid)
+            if action is None:
+                continue
+        else:
+            action.redo_apply(grid)
+            undo.add_action(action)
+        replay.add_action(action, is_undo, grid)
+    return grid, undo, replay
+
+def main() -> None:
+    p = argparse.ArgumentParser(description="Report or project the memory a painting session holds.")
+    p.add_argument("--replay", help="Report on the session recorded in this replay log.")
+    p.add_argument("--size", type=int, nargs=2, default=(32, 32), metavar=("X", "Y"), help="Grid size to project for.")
+    p.add_argument("--style", choices=Grid.DRAW_STYLE_OPTIONS, help="Only project this draw style.")
+    p.add_argument("--actions", type=int, default=0, help="Brush strokes in the projected history.")
+    p.add_argument("--depth", type=int, default=1, help="Layers on each painted square.")
+    p.add_argument("--coverage", type=float, default=1.0, help="Fraction of a tiled grid that is painted.")
+    args = p.parse_args()
+
+    if args.replay:
+        print(format_session(session_report(*replay_session(args.replay))))
+        return
+    x, y = args.size
+    styles = [args.style] if args.style else Grid.DRAW_STYLE_OPTIONS
+    print(f"Projected for {x}x{y}, {args.actions} actions, {args.depth} layers per square:")
+    print(format_report({style: project(style, x, y, args.actions, args.depth, args.coverage) for style in styles}))
+
+if __name__ == "__main__":
+    main()
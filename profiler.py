@@ -0,0 +1,204 @@
+"""
+Frame-time instrumentation of the hot paths.
+
+Code marks what it wants timed with `profiler.span(name)` blocks or the `@profiler.timed(name)` decorator,
+and counts work with `profiler.count(name, n)`. The window calls `profiler.end_frame()` as it starts drawing,
+so a frame runs from one draw to the next.
+While the profiler is off, each of these is a flag check and nothing is recorded.
+
+While on, it keeps the last FRAMES frames: how long each took, the time spent in each span, and the counts,
+for the overlay's rolling p50/p99. Every span is also kept as a trace event, the newest TRACE_EVENTS of them,
+which `export_chrome_trace` writes in the Chrome trace-event format, for chrome://tracing or ui.perfetto.dev.
+"""
+from __future__ import annotations
+import functools
+import json
+import math
+import os
+import threading
+import time
+from collections import deque
+from contextlib import nullcontext
+
+def percentile(samples, q: float) -> float:
+    """
+    Returns the nearest-rank q-th quantile (0 <= q <= 1) of some samples, or 0 if there are none.
+
+    Complexity: O(n log n)
+    n: The number of samples
+    """
+    ordered = sorted(samples)
+    if not ordered:
+        return 0
+    return ordered[min(max(math.ceil(q * len(ordered)) - 1, 0), len(ordered) - 1)]
+
+
+class _Span:
+    """ Times one `with` block into a profiler. """
+
+    __slots__ = ("profiler", "name", "start")
+
+    def __init__(self, profiler: Profiler, name: str) -> None:
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self) -> None:
+        self.start = time.perf_counter_ns()
+
+    def __exit__(self, *exc) -> None:
+        self.profiler.record(self.name, self.start, time.perf_counter_ns())
+
+
+class Profiler:
+    """
+    Collects span timings and counts per frame, and trace events, while `enabled`.
+    """
+
+    FRAMES = 300 # Frames kept for the rolling statistics
+    TRACE_EVENTS = 200000 # Spans kept for the trace, newest first to go
+
+    _DISABLED = nullcontext()
+
+    def __init__(self, enabled: bool=False) -> None:
+        """
+        Complexity: O(1)
+        """
+        self.enabled = enabled
+        self.clear()
+
+    def clear(self) -> None:
+        """
+        Forgets everything recorded.
+
+        Complexity: O(1)
+        """
+        self.frame_ms: deque[float] = deque(maxlen=self.FRAMES)
+        self.frame_spans: deque[dict[str, float]] = deque(maxlen=self.FRAMES) # ms per span name
+        self.frame_counts: deque[dict[str, int]] = deque(maxlen=self.FRAMES)
+        self.events: deque[tuple] = deque(maxlen=self.TRACE_EVENTS) # (name, start ns, duration ns, thread id)
+        self.counters: deque[tuple] = deque(maxlen=self.TRACE_EVENTS) # (frame end ns, counts)
+        self.spans: dict[str, int] = {} # ns per span name in the current frame
+        self.counts: dict[str, int] = {}
+        self.frame_start: int|None = None
+
+    def span(self, name: str):
+        """
+        Returns a context manager timing its block as `name`.
+
+        Complexity: O(1)
+        """
+        if not self.enabled:
+            return self._DISABLED
+        return _Span(self, name)
+
+    def timed(self, name: str):
+        """
+        Decorator timing every call of a function as `name`, while the profiler is enabled.
+        """
+        def decorate(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return function(*args, **kwargs)
+                start = time.perf_counter_ns()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self.record(name, start, time.perf_counter_ns())
+            return wrapper
+        return decorate
+
+    def record(self, name: str, start: int, end: int) -> None:
+        """
+        Adds a span from `start` to `end` perf_counter_ns.
+
+        Complexity: O(1)
+        """
+        self.spans[name] = self.spans.get(name, 0) + end - start
+        self.events.append((name, start, end - start, threading.get_ident()))
+
+    def count(self, name: str, n: int=1) -> None:
+        """
+        Adds n to a count of the current frame, such as the squares whose colours were evaluated.
+
+        Complexity: O(1)
+        """
+        if self.enabled:
+            self.counts[name] = self.counts.get(name, 0) + n
+
+    def end_frame(self) -> None:
+        """
+        Closes the current frame, which began when the last one ended, and starts the next.
+
+        Complexity: O(s)
+        s: The number of span names and counts used in the frame
+        """
+        if not self.enabled:
+            self.frame_start = None
+            return
+        now = time.perf_counter_ns()
+        if self.frame_start is not None:
+            self.frame_ms.append((now - self.frame_start) / 1e6)
+            self.frame_spans.append({name: ns / 1e6 for name, ns in self.spans.items()})
+            self.frame_counts.append(self.counts)
+            self.events.append(("frame", self.frame_start, now - self.frame_start, threading.get_ident()))
+            self.counters.append((now, self.counts))
+        self.spans = {}
+        self.counts = {}
+        self.frame_start = now
+
+    def stats(self) -> dict:
+        """
+        Returns the rolling statistics of the frames kept: the last frame's ms, the p50 and p99 frame ms,
+        the mean ms per frame spent in each span, and the last frame's counts.
+
+        Complexity: O(F log F + F . s)
+        F: The number of frames kept
+        s: The number of span names used per frame
+        """
+        spans = {}
+        for frame in self.frame_spans:
+            for name, ms in frame.items():
+                spans[name] = spans.get(name, 0) + ms
+        frames = max(len(self.frame_spans), 1)
+        return {
+            "frames": len(self.frame_ms),
+            "frame_ms": self.frame_ms[-1] if self.frame_ms else 0,
+            "p50": percentile(self.frame_ms, 0.5),
+            "p99": percentile(self.frame_ms, 0.99),
+            "spans": {name: ms / frames for name, ms in sorted(spans.items(), key=lambda item: -item[1])},
+            "counts": self.frame_counts[-1] if self.frame_counts else {},
+        }
+
+    def chrome_trace(self) -> dict:
+        """
+        Returns the trace events kept, in the Chrome trace-event format: a complete ("X") event per span
+        and frame, and a counter ("C") event per frame for its counts. Times are in microseconds.
+
+        Complexity: O(e)
+        e: The number of events kept
+        """
+        pid = os.getpid()
+        events = [
+            {"name": name, "ph": "X", "ts": start / 1000, "dur": duration / 1000, "pid": pid, "tid": tid}
+            for name, start, duration, tid in self.events
+        ]
+        events += [
+            {"name": "counts", "ph": "C", "ts": end / 1000, "pid": pid, "args": counts}
+            for end, counts in self.counters if counts
+        ]
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def export_chrome_trace(self, path: str) -> None:
+        """
+        Writes `chrome_trace` to a JSON file.
+
+        Complexity: O(e)
+        e: The number of events kept
+        """
+        with open(path, "w") as f:
+            json.dump(self.chrome_trace(), f)
+
+
+# The profiler the application's hot paths report to.
+profiler = Profiler()
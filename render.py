@@ -0,0 +1,307 @@
+"""
+Headless replay renderer.
+
+Replays a log saved with `python main.py --record` without opening a window,
+and writes the final canvas, or every Nth frame, as PNG/PPM images.
+
+Frames use a virtual timestamp of (actions played) * REPLAY_TIMER_DELTA,
+the same pace as the interactive replay, so animated layers such as
+rainbow and sparkle come out identical on every run.
+
+Frames are independent once the grid state for each is known, so with
+--workers the log is replayed once in this process and the frames are
+rasterized from grid snapshots on a process pool.
+
+Usage:
+    python render.py session.sprl -o final.png
+    python render.py session.sprl -o frames/frame_{:05d}.ppm --every 10 --scale 8
+    python render.py session.sprl -o timelapse.gif --every 5 --scale 8 --workers 0
+"""
+from __future__ import annotations
+import argparse
+import os
+from array import array
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator
+from grid import Grid
+from image_io import GifWriter, write_image
+from layer_util import Layer, get_layers
+from layers import invert
+from replay import ReplayTracker
+from replay_log import ReplayLogReader
+
+BG = (255, 255, 255)
+# Frames sent to a worker process at a time when rendering in parallel.
+FRAMES_PER_TASK = 16
+
+def _region_squares(grid: Grid, x0: int, y0: int, x1: int, y1: int):
+    """
+    Yields (x, y, store) for the squares with x0 <= x < x1 and y0 <= y < y1,
+    leaving out the squares of unallocated tiles, which all hold grid.blank.
+
+    Complexity: O(wh) untiled, O(k) tiled
+    k: The number of squares in allocated tiles overlapping the region
+    """
+    if grid.tiles is None:
+        for x in range(x0, x1):
+            column = grid.grid[x]
+            for y in range(y0, y1):
+                yield x, y, column[y]
+        return
+    for tile in list(grid.tiles.values()):
+        for x in range(max(x0, tile.x0), min(x1, tile.x0 + tile.width)):
+            first = (x - tile.x0) * tile.height - tile.y0
+            for y in range(max(y0, tile.y0), min(y1, tile.y0 + tile.height)):
+                yield x, y, tile.stores[first + y]
+
+def _apply_layer(layer: Layer, colors, timestamp: float, xs, ys):
+    """
+    Applies a layer to an (N, 3) array of colours of the squares at xs, ys,
+    with its kernel if it has one, or square by square otherwise.
+
+    Complexity: O(N * apply)
+    """
+    if layer.kernel is not None:
+        return layer.kernel(colors, timestamp, xs, ys)
+    import numpy as np
+    return np.array([
+        layer.apply(tuple(color), timestamp, x, y)
+        for color, x, y in zip(colors.tolist(), xs.tolist(), ys.tolist())
+    ], np.int64).reshape(-1, 3)
+
+def to_array(grid: Grid, timestamp: float, bg: tuple[int, int, int]=BG, region: tuple[int, int, int, int]|None=None):
+    """
+    Returns the grid's colours at `timestamp` as an (H, W, 3) uint8 NumPy array, top row first.
+    `region` is (x, y, width, height) with bottom left square (x, y), clipped to the grid; the whole grid by default.
+
+    Squares with the same layer stack are evaluated together, one layer at a time over all of them,
+    using the layer's kernel where it has one. Squares holding the same as grid.blank, such as empty ones, are left as its colour.
+    :raises ImportError: if NumPy isn't installed
+
+    Complexity: O(k + s * (flatten + N * apply / vectorization))
+    k: The number of squares looked at (in allocated tiles, for a tiled grid)
+    s: The number of distinct stacks among them
+    N: The number of squares with each stack
+    """
+    import numpy as np
+    from shared_grid import SQUARE_SPECIAL, flatten
+
+    x0, y0, width, height = region if region is not None else (0, 0, grid.x, grid.y)
+    x0, y0, x1, y1 = max(x0, 0), max(y0, 0), min(x0 + width, grid.x), min(y0 + height, grid.y)
+    pixels = np.empty((max(y1 - y0, 0), max(x1 - x0, 0), 3), np.uint8)
+    blank = grid.blank # What unallocated squares hold, empty unless a special reached them
+    pixels[:] = blank.get_color(tuple(bg), timestamp, 0, 0)
+    # Store hash -> (layer stack, x0, y0, x1, y1, ... of the squares with it). Equal hashes stand in for equal stacks.
+    groups: dict[int, tuple[tuple[bytes, int], array]] = {}
+    for x, y, store in _region_squares(grid, x0, y0, x1, y1):
+        if store.hash == blank.hash and store.mask == blank.mask:
+            continue
+        group = groups.get(store.hash)
+        if group is None:
+            group = groups[store.hash] = (flatten(store.snapshot()), array("q"))
+        group[1].append(x)
+        group[1].append(y)
+
+    layers = get_layers()
+    for (stack, flags), cells in groups.values():
+        cells = np.frombuffer(cells, np.int64)
+        xs, ys = cells[0::2], cells[1::2]
+        colors = np.empty((len(xs), 3), np.int64)
+        colors[:] = bg
+        for index in stack:
+            colors = _apply_layer(layers[index], colors, timestamp, xs, ys)
+        if flags & SQUARE_SPECIAL:
+            colors = _apply_layer(invert, colors, timestamp, xs, ys)
+        pixels[y1 - 1 - ys, xs - x0] = colors
+    return pixels
+
+def rasterize(grid: Grid, timestamp: float, bg: tuple[int, int, int]=BG, scale: int=1) -> bytes:
+    """
+    Returns the grid's colours as packed RGB rows, from the top of the canvas down,
+    with every grid square drawn as a `scale` x `scale` block of pixels.
+    Square (0, 0) is at the bottom left, as in the window.
+    Uses `to_array` when NumPy is installed.
+
+    Complexity: O(nm * get_color + nm * scale^2)
+    n: The horizontal length of the grid
+    m: The vertical length of the grid
+    """
+    try:
+        import numpy as np
+    except ImportError:
+        np = None
+    if np is not None:
+        pixels = to_array(grid, timestamp, bg)
+        if scale != 1:
+            pixels = pixels.repeat(scale, axis=0).repeat(scale, axis=1)
+        return pixels.tobytes()
+    pixels = bytearray()
+    for y in range(grid.y - 1, -1, -1):
+        row = bytearray()
+        for x in range(grid.x):
+            row += bytes(grid.peek(x, y).get_color(bg, timestamp, x, y)) * scale
+        pixels += bytes(row) * scale
+    return bytes(pixels)
+
+def replay_frames(
+    path: str,
+    every: int=0,
+    size: tuple[int, int]|None=None,
+    draw_style: str|None=None,
+) -> Iterator[tuple[int, Grid]]:
+    """
+    Replays the log at `path`, yielding (actions played, grid) every `every` actions
+    and once more at the end. The same grid object is yielded each time and keeps changing,
+    so use it before asking for the next frame.
+
+    `size` and `draw_style` override the values recorded in the log.
+
+    Complexity: O(a . nm . special)
+    a: The number of actions in the log
+    """
+    log = ReplayLogReader(path)
+    x, y = size if size is not None else (log.x, log.y)
+    grid = Grid(draw_style or log.draw_style, x, y)
+    replay = ReplayTracker()
+    replay.add_source(log)
+
+    played = 0
+    while not replay.play_next_action(grid):
+        played += 1
+        if every > 0 and played % every == 0:
+            yield played, grid
+    if every <= 0 or played % every != 0:
+        yield played, grid
+
+def frame_timestamp(played: int) -> float:
+    """ The virtual timestamp of the frame after `played` actions. """
+    return played * ReplayTracker.REPLAY_TIMER_DELTA
+
+def _render_serial(frames: Iterator[tuple[int, Grid]], scale: int, bg: tuple[int, int, int]) -> Iterator[tuple[int, bytes]]:
+    """ Rasterizes each frame in this process. """
+    for played, grid in frames:
+        yield played, rasterize(grid, frame_timestamp(played), bg, scale)
+
+def _render_chunk(
+    draw_style: str, x: int, y: int,
+    snapshots: list[tuple[int, tuple]],
+    scale: int, bg: tuple[int, int, int],
+) -> list[tuple[int, bytes]]:
+    """
+    Worker task: restores each (actions played, grid snapshot) pair into one grid
+    and rasterizes it at that frame's timestamp.
+    """
+    grid = Grid(draw_style, x, y)
+    rendered = []
+    for played, snapshot in snapshots:
+        grid.restore(snapshot)
+        rendered.append((played, rasterize(grid, frame_timestamp(played), bg, scale)))
+    return rendered
+
+def _render_parallel(
+    frames: Iterator[tuple[int, Grid]], scale: int, bg: tuple[int, int, int], workers: int,
+) -> Iterator[tuple[int, bytes]]:
+    """
+    Rasterizes frames on a process pool. This process only replays the log and
+    snapshots the grid for every frame; workers restore the snapshots and evaluate the colours.
+    Results are yielded in frame order, with at most a few chunks in flight at a time.
+    """
+    with ProcessPoolExecutor(workers) as pool:
+        pending = deque()
+        chunk = []
+        grid = None
+        for played, grid in frames:
+            chunk.append((played, grid.snapshot()))
+            if len(chunk) == FRAMES_PER_TASK:
+                pending.append(pool.submit(_render_chunk, grid.draw_style, grid.x, grid.y, chunk, scale, bg))
+                chunk = []
+            while len(pending) > 2 * workers:
+                yield from pending.popleft().result()
+        if chunk:
+            pending.append(pool.submit(_render_chunk, grid.draw_style, grid.x, grid.y, chunk, scale, bg))
+        while pending:
+            yield from pending.popleft().result()
+
+def render_log(
+    path: str,
+    output: str,
+    every: int=0,
+    scale: int=1,
+    bg: tuple[int, int, int]=BG,
+    size: tuple[int, int]|None=None,
+    draw_style: str|None=None,
+    workers: int=1,
+    fps: int=20,
+) -> int:
+    """
+    Replays the log at `path` and writes the final canvas to `output`.
+    If `every` is positive, every `every`th frame is written too.
+
+    If `output` ends in .gif, all frames go into one animated GIF played at `fps`, written as they are rendered.
+    Otherwise each frame is its own PNG/PPM, with `output` formatted with the number of actions played so far.
+    With more than one worker, frames are rasterized on a process pool.
+
+    Returns the number of actions played.
+    :raises ValueError: if `every` is positive and `output` is neither a GIF nor has a {} for the frame number
+
+    Complexity: O(a . nm . special + f . rasterize / workers)
+    a: The number of actions in the log
+    f: The number of frames written
+    """
+    gif = output.lower().endswith(".gif")
+    if every > 0 and not gif and output.format(1) == output.format(2):
+        raise ValueError(f"{output} has no {{}} for the frame number, so every frame would overwrite the last")
+    log = ReplayLogReader(path)
+    x, y = size if size is not None else (log.x, log.y)
+    frames = replay_frames(path, every, size, draw_style)
+    if workers > 1:
+        rendered = _render_parallel(frames, scale, bg, workers)
+    else:
+        rendered = _render_serial(frames, scale, bg)
+
+    played = 0
+    if gif:
+        with GifWriter(output, x * scale, y * scale, round(1000 / fps)) as writer:
+            for played, frame in rendered:
+                writer.write(frame)
+    else:
+        for played, frame in rendered:
+            write_image(output.format(played), x * scale, y * scale, frame)
+    return played
+
+def write_frame(grid: Grid, path: str, timestamp: float, bg: tuple[int, int, int]=BG, scale: int=1) -> None:
+    """
+    Rasterizes the grid at `timestamp` and writes it to `path` as PNG or PPM.
+
+    Complexity: O(rasterize)
+    """
+    write_image(path, grid.x * scale, grid.y * scale, rasterize(grid, timestamp, bg, scale))
+
+def main() -> None:
+    p = argparse.ArgumentParser(description="Render a replay log without opening a window.")
+    p.add_argument("log", help="Replay log saved with `python main.py --record`.")
+    p.add_argument("-o", "--output", default="replay.png",
+                   help="Output image (.png or .ppm). With --every, formatted with the action number, e.g. frame_{:05d}.png")
+    p.add_argument("--every", type=int, default=0, help="Also write a frame every N actions.")
+    p.add_argument("--scale", type=int, default=1, help="Pixels per grid square.")
+    p.add_argument("--bg", type=int, nargs=3, default=BG, metavar=("R", "G", "B"), help="Background colour.")
+    p.add_argument("--size", type=int, nargs=2, metavar=("X", "Y"), help="Override the recorded grid size.")
+    p.add_argument("--style", choices=Grid.DRAW_STYLE_OPTIONS, help="Override the recorded draw style.")
+    p.add_argument("-j", "--workers", type=int, default=1,
+                   help="Rasterize frames on this many processes (0 for one per core).")
+    p.add_argument("--fps", type=int, default=20, help="Frame rate of animated GIF output.")
+    args = p.parse_args()
+
+    try:
+        played = render_log(
+            args.log, args.output, args.every, args.scale, tuple(args.bg),
+            tuple(args.size) if args.size else None, args.style,
+            args.workers or os.cpu_count(), args.fps,
+        )
+    except ValueError as e:
+        p.error(str(e))
+    print(f"Replayed {played} actions.")
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,71 @@
 from __future__ import annotations
+from typing import Iterable
 from action import PaintAction
 from grid import Grid
+from profiler import profiler
 from data_structures.queue_adt import CircularQueue
 from data_structures.sorted_list_adt import ListItem
 
 class ReplayTracker:
 
     MAX_ACTIONS = 10000
+    KEYFRAME_INTERVAL = 100
+    # Seconds between two replayed actions at normal speed.
+    REPLAY_TIMER_DELTA = 0.05
+
     def __init__(self) -> None:
         """
         Instantiates instance variables:
-        - self.actions: a Circular Queue used to store Paint actions
+        - self.actions: a Circular Queue used to store Paint actions which are yet to be played
+        - self.history: every action added since the last clear, in order, so we can seek through them
+        - self.keyframes: grid snapshots, where self.keyframes[i] is the grid after i * KEYFRAME_INTERVAL actions.
+                          self.keyframes[0] is None, which stands for an empty grid.
+        - self.hashes: the grid's state hash after each action of self.history, or None if it wasn't recorded
+        - self.tile_snapshots: the Grid.snapshot cache of the grid keyframes were last captured from,
+                               so each keyframe of a tiled grid only copies the tiles changed since the one before
 
         Cmoplexity: O(n)
         n: MAX_ACTIONS
         """
         self.actions = CircularQueue(self.MAX_ACTIONS)
+        self.history: list[ListItem] = []
+        self.keyframes: list[tuple|None] = [None]
+        self.hashes: list[int|None] = []
+        self.snapshot_grid: Grid|None = None
+        self.tile_snapshots: dict = {}
+        self.source = None
+
+    def clear(self) -> None:
+        """
+        Forgets every recorded action and keyframe.
+
+        Complexity: O(1)
+        """
+        self.actions.clear()
+        self.history = []
+        self.keyframes = [None]
+        self.hashes = []
+        self.snapshot_grid = None
+        self.tile_snapshots = {}
+        self.source = None
+
+    @property
+    def position(self) -> int:
+        """
+        The number of actions in self.history which have already been played.
+
+        Complexity: O(1)
+        """
+        return len(self.history) - len(self.actions)
+
+    @property
+    def seekable(self) -> bool:
+        """
+        Whether `seek` can be used. Not while actions are streamed from a source, which can't go back.
+
+        Complexity: O(1)
+        """
+        return self.source is None
 
     def start_replay(self) -> None:
         """
@@ -28,17 +78,110 @@ class ReplayTracker:
         # NULL
         pass
 
-    def add_action(self, action: PaintAction, is_undo: bool=False) -> None:
+    @profiler.timed("ReplayTracker.add_action")
+    def add_action(self, action: PaintAction, is_undo: bool=False, grid: Grid|None=None) -> None:
         """
         Adds an action to the replay.
 
         `is_undo` specifies whether the action was an undo action or not.
         Special, Redo, and Draw all have this is False.
 
+        `grid` is the grid the action has just been applied to.
+        If given, its state hash is recorded, and a keyframe of it is captured every KEYFRAME_INTERVAL actions.
+
+        Complexity: O(1), or O(snapshot) when a keyframe is captured
+        snapshot: The complexity of Grid.snapshot
+        """
+        item = ListItem(is_undo, action)
+        self.actions.append(item)
+        self.history.append(item)
+        self.hashes.append(grid.state_hash() if grid is not None else None)
+        if grid is not None:
+            self._capture_keyframe(grid, len(self.history))
+
+    def matches_recording(self, grid: Grid) -> bool:
+        """
+        Checks `grid` against the state hash recorded at the current replay position.
+        Returns False only if a hash was recorded there and it differs.
+
+        Complexity: O(1)
+        """
+        position = self.position
+        expected = 0 if position == 0 else self.hashes[position - 1]
+        return expected is None or expected == grid.state_hash()
+
+    def add_source(self, source: Iterable[tuple[PaintAction, bool]]) -> None:
+        """
+        Queues a stream of (action, is_undo) pairs, such as a ReplayLogReader,
+        to be played after the actions already added.
+
+        Streamed actions are pulled one at a time while playing and are not kept,
+        so they are not part of self.history and cannot be seeked to.
+
         Complexity: O(1)
         """
-        self.actions.append(ListItem(is_undo, action))
+        self.source = iter(source)
+
+    def _capture_keyframe(self, grid: Grid, index: int) -> None:
+        """
+        Stores a snapshot of `grid` if it is the next missing keyframe.
+        `grid` must be the state after playing the first `index` actions of self.history.
+        Tiles unchanged since the last keyframe share their states with it.
 
+        Complexity: O(1), or O(snapshot) when a keyframe is captured, which for a tiled grid
+        only copies the tiles changed since the last keyframe
+        """
+        if index % self.KEYFRAME_INTERVAL == 0 and index // self.KEYFRAME_INTERVAL == len(self.keyframes):
+            if grid is not self.snapshot_grid: # Tile versions only mean something within one grid
+                self.snapshot_grid = grid
+                self.tile_snapshots = {}
+            self.keyframes.append(grid.snapshot(self.tile_snapshots))
+
+    @profiler.timed("ReplayTracker.seek")
+    def seek(self, grid: Grid, index: int) -> None:
+        """
+        Puts `grid` in the state it had after the first `index` recorded actions,
+        and makes `play_next_action` continue from there.
+
+        The nearest keyframe at or before `index` is restored, and the remaining actions are replayed.
+        Keyframes missing from recording are captured on the way, so later seeks are cheaper.
+
+        Complexity: O(restore + KEYFRAME_INTERVAL . nm . special + h)
+        restore: The complexity of Grid.restore
+        n, m: The horizontal and vertical lengths of the grid, for special actions
+        h: The length of self.history, to refill the queue of actions yet to be played
+
+        Does nothing while a source is streaming (see `seekable`),
+        as its actions aren't kept and the rest of it would be played over the wrong state.
+        """
+        if not self.seekable:
+            return
+        index = max(0, min(index, len(self.history)))
+        keyframe = min(index // self.KEYFRAME_INTERVAL, len(self.keyframes) - 1)
+        if self.keyframes[keyframe] is None:
+            grid.clear()
+        else:
+            grid.restore(self.keyframes[keyframe])
+        for i in range(keyframe * self.KEYFRAME_INTERVAL, index):
+            self._apply(self.history[i], grid)
+            self._capture_keyframe(grid, i + 1)
+
+        self.actions.clear()
+        for i in range(index, len(self.history)):
+            self.actions.append(self.history[i])
+
+    def _apply(self, item: ListItem, grid: Grid) -> None:
+        """
+        Applies a recorded (is_undo, action) pair to the grid.
+
+        Complexity: O(nm . special) when the action is special
+        """
+        if item.value == False: # If its not an undo action, redo the actio
+            item.key.redo_apply(grid)
+        elif item.value == True: # If it's an undo act
+            item.key.undo_apply(grid)
+
+    @profiler.timed("ReplayTracker.play_next_action")
     def play_next_action(self, grid: Grid) -> bool:
         """
         Plays the next replay action on the grid.
@@ -53,16 +196,51 @@ class ReplayTracker:
         Special because the time complexity may differ depending on the type of layer store
         """
 
-        if self.actions.is_empty(): # If theres nothing to play return True 
-            return True
+        if self.actions.is_empty(): # If theres nothing to play, try the stream, otherwise return True
+            return self._play_from_source(grid)
         action = self.actions.serve() 
         if action.key == None: # If theres nothing to play return True (just in case)
             return True
-        if action.value == False: # If its not an undo action, redo the actio
-            action.key.redo_apply(grid)
-        elif action.value == True: # If it's an undo act
-            action.key.undo_apply(grid) 
+        self._apply(action, grid)
         return False
+
+    def _play_from_source(self, grid: Grid) -> bool:
+        """
+        Plays the next action of self.source, with the same return value as `play_next_action`.
+
+        Complexity: O(nm . special) when the action is special
+        """
+        if self.source is None:
+            return True
+        try:
+            action, is_undo = next(self.source)
+        except StopIteration:
+            self.source = None
+            return True
+        self._apply(ListItem(is_undo, action), grid)
+        return False
+
+    @profiler.timed("ReplayTracker.play_next_actions")
+    def play_next_actions(self, grid: Grid, n: int|None) -> bool:
+        """
+        Plays up to `n` replay actions on the grid in one go, or every action left, streamed ones included, if `n` is None,
+        so fast replays only need to redraw the grid once per batch.
+        Returns a boolean.
+            - If the replay ran out of actions, return True.
+            - Otherwise, return False.
+
+        Complexity: O(n . nm . special)
+        n: The actions played, all of those left if None
+        Worst case when every action played is special
+        """
+        if n is None:
+            while not self.play_next_action(grid):
+                pass
+            return True
+        for _ in range(n):
+            if self.play_next_action(grid):
+                return True
+        return self.actions.is_empty() and self.source is None
         
 
 if __name__ == "__main__":
@@ -0,0 +1,357 @@
+"""
+Binary replay log.
+
+A session is saved as a header followed by one record per replay action,
+so it can be appended to while painting and read back one action at a time.
+
+Layout (every integer is an unsigned LEB128 varint):
+- Header: MAGIC, FORMAT_VERSION, grid x, grid y, draw style index into Grid.DRAW_STYLE_OPTIONS
+- Record: kind (PAINT, UNDO, REDO or SPECIAL), then the action
+- Action: flags, number of steps, then x, y, layer index for each step.
+  Flag bit 0 marks a special action. Bit 1 means its special steps follow:
+  their number, then x, y, and removed layer index + 1 (0 for none) for each.
+  Bit 2 means restore steps follow: their number, then x, y, state before and state after for each.
+  Bit 3 means bulk steps follow: their number, then for each the layer index,
+  the number of squares, and x, y for each square.
+  Bit 4 means the special also reached every tile not allocated when it ran:
+  the number of tiles that were, then tx, ty for each.
+- State: a layer store snapshot. 0 then the bit-vector for sequence stores,
+  1 then layer index + 1 (0 for none) and the special flag for set stores,
+  2 then the number of layers and each layer index for additive stores.
+"""
+from __future__ import annotations
+from typing import BinaryIO, Iterator
+from array import array
+from action import BlankSpecialStep, BulkPaintStep, PaintAction, PasteStep, PaintStep, RestoreStep, SpecialStep
+from grid import Grid
+from layer_util import get_layers
+
+MAGIC = b"SPRL"
+FORMAT_VERSION = 1
+
+PAINT = 0
+UNDO = 1
+REDO = 2
+SPECIAL = 3
+
+FLAG_SPECIAL = 1
+FLAG_SPECIAL_STEPS = 2
+FLAG_RESTORE_STEPS = 4
+FLAG_BULK_STEPS = 8
+FLAG_BLANK_SPECIAL = 16
+
+STATE_SEQUENCE = 0
+STATE_SET = 1
+STATE_ADDITIVE = 2
+
+def encode_varint(value: int, out: bytearray) -> None:
+    """
+    Appends `value` to `out` as an unsigned LEB128 varint.
+
+    Complexity: O(log value)
+    """
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+def encode_state(state, out: bytearray) -> None:
+    """
+    Appends the encoding of a layer store snapshot to `out`.
+
+    Complexity: O(n)
+    n: The number of layers in the snapshot
+    """
+    if isinstance(state, int):
+        encode_varint(STATE_SEQUENCE, out)
+        encode_varint(state, out)
+    elif len(state) == 2 and isinstance(state[1], bool):
+        encode_varint(STATE_SET, out)
+        encode_varint(0 if state[0] is None else state[0].index + 1, out)
+        encode_varint(int(state[1]), out)
+    else:
+        encode_varint(STATE_ADDITIVE, out)
+        encode_varint(len(state), out)
+        for layer in state:
+            encode_varint(layer.index, out)
+
+def encode_action(action: PaintAction, out: bytearray) -> None:
+    """
+    Appends the encoding of `action` to `out`.
+    PaintSteps are written before RestoreSteps and BulkPaintSteps, so an action mixing them would replay them in that order.
+    PasteSteps are written as one restore step per square, and read back as RestoreSteps.
+
+    Complexity: O(n)
+    n: The amount of steps in the action
+    """
+    all_steps = action.steps if action.steps else []
+    steps = [step for step in all_steps if isinstance(step, PaintStep)]
+    restores = [(step.affected_grid_square, step.before, step.after) for step in all_steps if isinstance(step, RestoreStep)]
+    for step in all_steps:
+        if isinstance(step, PasteStep):
+            squares = step.affected_grid_squares
+            for i in range(len(step)):
+                restores.append(((squares[2 * i], squares[2 * i + 1]), step.before[i].snapshot(), step.after[i].snapshot()))
+    bulks = [step for step in all_steps if isinstance(step, BulkPaintStep)]
+    specials = blanks = None
+    if action.special_steps is not None:
+        specials = [step for step in action.special_steps if isinstance(step, SpecialStep)]
+        blanks = [step for step in action.special_steps if isinstance(step, BlankSpecialStep)]
+    flags = FLAG_SPECIAL if action.is_special else 0
+    if specials is not None:
+        flags |= FLAG_SPECIAL_STEPS
+    if blanks:
+        flags |= FLAG_BLANK_SPECIAL
+    if restores:
+        flags |= FLAG_RESTORE_STEPS
+    if bulks:
+        flags |= FLAG_BULK_STEPS
+    encode_varint(flags, out)
+    encode_varint(len(steps), out)
+    for step in steps:
+        encode_varint(step.affected_grid_square[0], out)
+        encode_varint(step.affected_grid_square[1], out)
+        encode_varint(step.affected_layer.index, out)
+    if specials is not None:
+        encode_varint(len(specials), out)
+        for step in specials:
+            encode_varint(step.affected_grid_square[0], out)
+            encode_varint(step.affected_grid_square[1], out)
+            encode_varint(0 if step.removed_layer is None else step.removed_layer.index + 1, out)
+    if restores:
+        encode_varint(len(restores), out)
+        for (x, y), before, after in restores:
+            encode_varint(x, out)
+            encode_varint(y, out)
+            encode_state(before, out)
+            encode_state(after, out)
+    if bulks:
+        encode_varint(len(bulks), out)
+        for step in bulks:
+            encode_varint(step.affected_layer.index, out)
+            encode_varint(len(step), out)
+            for coord in step.affected_grid_squares:
+                encode_varint(coord, out)
+    if blanks:
+        tiles = blanks[0].allocated_tiles
+        encode_varint(len(tiles), out)
+        for tx, ty in tiles:
+            encode_varint(tx, out)
+            encode_varint(ty, out)
+
+
+class ByteReader:
+    """
+    Decodes varints from a file, a chunk at a time,
+    so records can be read without loading the whole file.
+    """
+
+    CHUNK_SIZE = 1 << 16
+
+    def __init__(self, file: BinaryIO) -> None:
+        self.file = file
+        self.buffer = b""
+        self.pos = 0
+
+    def _refill(self) -> bool:
+        """
+        Reads the next chunk, keeping any bytes which haven't been consumed yet.
+        Returns False at the end of the file.
+        """
+        chunk = self.file.read(self.CHUNK_SIZE)
+        if not chunk:
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def at_end(self) -> bool:
+        """ True if every byte of the file has been consumed. """
+        return self.pos >= len(self.buffer) and not self._refill()
+
+    def read_bytes(self, n: int) -> bytes:
+        """
+        Reads exactly n raw bytes.
+        :raises EOFError: if the file ends first
+        """
+        while len(self.buffer) - self.pos < n:
+            if not self._refill():
+                raise EOFError("Replay log ended in the middle of a record")
+        data = self.buffer[self.pos:self.pos + n]
+        self.pos += n
+        return data
+
+    def read_varint(self) -> int:
+        """
+        Reads one unsigned LEB128 varint.
+        :raises EOFError: if the file ends first
+        """
+        result = 0
+        shift = 0
+        while True:
+            if self.pos >= len(self.buffer) and not self._refill():
+                raise EOFError("Replay log ended in the middle of a record")
+            byte = self.buffer[self.pos]
+            self.pos += 1
+            result |= (byte & 0x7F) << shift
+            if byte < 0x80:
+                return result
+            shift += 7
+
+def decode_state(reader: ByteReader):
+    """
+    Reads a layer store snapshot written by `encode_state`.
+
+    Complexity: O(n)
+    n: The number of layers in the snapshot
+    """
+    layers = get_layers()
+    kind = reader.read_varint()
+    if kind == STATE_SEQUENCE:
+        return reader.read_varint()
+    if kind == STATE_SET:
+        index = reader.read_varint()
+        return (layers[index - 1] if index else None, bool(reader.read_varint()))
+    return tuple(layers[reader.read_varint()] for _ in range(reader.read_varint()))
+
+def decode_action(reader: ByteReader) -> PaintAction:
+    """
+    Reads an action written by `encode_action`.
+
+    Complexity: O(n)
+    n: The amount of PaintSteps in the action
+    """
+    layers = get_layers()
+    flags = reader.read_varint()
+    action = PaintAction(is_special=bool(flags & FLAG_SPECIAL))
+    for _ in range(reader.read_varint()):
+        x = reader.read_varint()
+        y = reader.read_varint()
+        action.add_step(PaintStep((x, y), layers[reader.read_varint()]))
+    if flags & FLAG_SPECIAL_STEPS:
+        action.special_steps = []
+        for _ in range(reader.read_varint()):
+            x = reader.read_varint()
+            y = reader.read_varint()
+            removed = reader.read_varint()
+            action.special_steps.append(SpecialStep((x, y), layers[removed - 1] if removed else None))
+    if flags & FLAG_RESTORE_STEPS:
+        for _ in range(reader.read_varint()):
+            x = reader.read_varint()
+            y = reader.read_varint()
+            before = decode_state(reader)
+            action.add_step(RestoreStep((x, y), before, decode_state(reader)))
+    if flags & FLAG_BULK_STEPS:
+        for _ in range(reader.read_varint()):
+            layer = layers[reader.read_varint()]
+            squares = array("I", (reader.read_varint() for _ in range(2 * reader.read_varint())))
+            action.add_step(BulkPaintStep(squares, layer))
+    if flags & FLAG_BLANK_SPECIAL:
+        tiles = tuple((reader.read_varint(), reader.read_varint()) for _ in range(reader.read_varint()))
+        action.special_steps.append(BlankSpecialStep(tiles))
+    return action
+
+
+class ReplayLogWriter:
+    """
+    Appends replay actions to a log file as they happen.
+    """
+
+    def __init__(self, path: str, draw_style: str, x: int, y: int) -> None:
+        """
+        Opens `path` for writing and writes the header of a new session.
+
+        Complexity: O(1)
+        """
+        self.path = path
+        self.file = None
+        self.restart(draw_style, x, y)
+
+    def restart(self, draw_style: str, x: int, y: int) -> None:
+        """
+        Discards everything written so far and starts a new session,
+        e.g. when the window is reset with another draw style.
+
+        Complexity: O(1)
+        """
+        if self.file is not None:
+            self.file.close()
+        self.file = open(self.path, "wb")
+        header = bytearray(MAGIC)
+        encode_varint(FORMAT_VERSION, header)
+        encode_varint(x, header)
+        encode_varint(y, header)
+        encode_varint(Grid.DRAW_STYLE_OPTIONS.index(draw_style), header)
+        self.file.write(header)
+
+    def write(self, kind: int, action: PaintAction) -> None:
+        """
+        Appends a record of the given kind (PAINT, UNDO, REDO or SPECIAL).
+
+        Complexity: O(n)
+        n: The amount of PaintSteps in the action
+        """
+        record = bytearray()
+        encode_varint(kind, record)
+        encode_action(action, record)
+        self.file.write(record)
+
+    def flush(self) -> None:
+        """ Makes sure every record so far has reached the file. """
+        self.file.flush()
+
+    def close(self) -> None:
+        """ Closes the log file. """
+        self.file.close()
+
+
+class ReplayLogReader:
+    """
+    Reads a replay log written by ReplayLogWriter.
+
+    The header is read straight away and exposed as `x`, `y` and `draw_style`.
+    Iterating yields (action, is_undo) pairs one record at a time,
+    in the same form `ReplayTracker.add_action` takes them.
+    """
+
+    def __init__(self, path: str) -> None:
+        """
+        Opens the log and reads its header.
+        :raises ValueError: if the file isn't a replay log this version can read
+
+        Complexity: O(1)
+        """
+        self.path = path
+        with open(path, "rb") as f:
+            reader = ByteReader(f)
+            if reader.read_bytes(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{path} is not a replay log")
+            version = reader.read_varint()
+            if version != FORMAT_VERSION:
+                raise ValueError(f"Unsupported replay log version {version}")
+            self.x = reader.read_varint()
+            self.y = reader.read_varint()
+            self.draw_style = Grid.DRAW_STYLE_OPTIONS[reader.read_varint()]
+            self.header_size = f.tell() - (len(reader.buffer) - reader.pos)
+
+    def __iter__(self) -> Iterator[tuple[PaintAction, bool]]:
+        """
+        Yields every recorded (action, is_undo) pair, in order.
+
+        Complexity: O(1) memory, O(n) time over the whole log
+        n: the size of the log
+        """
+        with open(self.path, "rb") as f:
+            f.seek(self.header_size)
+            reader = ByteReader(f)
+            while not reader.at_end():
+                kind = reader.read_varint()
+                yield decode_action(reader), kind == UNDO
+
+    def make_grid(self) -> Grid:
+        """
+        Returns an empty grid with the size and draw style of the recorded session.
+
+        Complexity: O(Grid.__init__)
+        """
+        return Grid(self.draw_style, self.x, self.y)
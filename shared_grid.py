@@ -0,0 +1,360 @@
+"""
+Flat, versioned grid state in shared memory.
+
+A SharedGridWriter publishes a grid's state into a `multiprocessing.shared_memory` block
+which any number of local processes can map with a SharedGridReader, without pickling the grid.
+
+Layout (little endian), with squares numbered x * grid.y + y:
+- Header: MAGIC, FORMAT_VERSION, state version, x, y, draw style index into Grid.DRAW_STYLE_OPTIONS,
+  flags, arena capacity, arena bytes used, and the name of the block which replaced this one (if FLAG_MOVED).
+- offsets: uint32 per square, where the square's layer stack starts in the arena
+- lengths: uint16 per square, the number of layers in the stack
+- masks: uint64 per square, LayerStore.mask
+- flags: uint8 per square, SQUARE_SPECIAL if a set store's special is on
+- arena: one byte per layer index. Additive stacks are oldest first, sequence stacks in index order,
+  and set stacks hold their one layer, if any.
+
+The state version works as a seqlock: it is odd while the writer is publishing and goes up by 2 per publish,
+so readers can tell whether what they read was consistent. Changed squares have their stacks appended to the arena;
+when it fills up every stack is rewritten from the start, or moved to a bigger block.
+"""
+from __future__ import annotations
+import struct
+from multiprocessing import shared_memory
+from grid import Grid
+from layer_util import get_layers
+
+MAGIC = b"SPSG"
+FORMAT_VERSION = 1
+
+FLAG_MOVED = 1
+SQUARE_SPECIAL = 1
+
+HEADER = struct.Struct("<4sIQIIIIQQ32s")
+VERSION_OFFSET = 8 # Of the state version in the header
+ARENA_USED_OFFSET = 40 # Of the arena bytes used in the header
+
+def _align(n: int) -> int:
+    """ Rounds n up to a multiple of 8. """
+    return (n + 7) & ~7
+
+def layout(x: int, y: int) -> tuple[int, int, int, int, int]:
+    """
+    Returns where the offsets, lengths, masks, flags and arena start in a block for an x by y grid.
+
+    Complexity: O(1)
+    """
+    squares = x * y
+    offsets = _align(HEADER.size)
+    lengths = _align(offsets + 4 * squares)
+    masks = _align(lengths + 2 * squares)
+    flags = _align(masks + 8 * squares)
+    arena = _align(flags + squares)
+    return offsets, lengths, masks, flags, arena
+
+def flatten(state) -> tuple[bytes, int]:
+    """
+    Returns the layer stack and square flags of a layer store snapshot.
+
+    Complexity: O(n)
+    n: The number of layers in the snapshot
+    """
+    if isinstance(state, int): # Sequence: bit i set for layer index i
+        return bytes(i for i in range(state.bit_length()) if state >> i & 1), 0
+    if len(state) == 2 and isinstance(state[1], bool): # Set: (layer or None, special)
+        return (bytes() if state[0] is None else bytes((state[0].index,))), SQUARE_SPECIAL if state[1] else 0
+    return bytes(layer.index for layer in state), 0
+
+def unflatten(draw_style: str, stack, flags: int):
+    """
+    Returns the layer store snapshot for a layer stack and square flags, the reverse of `flatten`.
+
+    Complexity: O(n)
+    n: The number of layers in the stack
+    """
+    layers = get_layers()
+    if draw_style == Grid.DRAW_STYLE_SEQUENCE:
+        state = 0
+        for index in stack:
+            state |= 1 << index
+        return state
+    if draw_style == Grid.DRAW_STYLE_SET:
+        return (layers[stack[0]] if len(stack) else None, bool(flags & SQUARE_SPECIAL))
+    return tuple(layers[index] for index in stack)
+
+
+class _Views:
+    """
+    Header access and typed, zero-copy views of the arrays of a block.
+    """
+
+    def __init__(self, block: shared_memory.SharedMemory, x: int, y: int, capacity: int) -> None:
+        self.block = block
+        self.buf = block.buf
+        offsets, lengths, masks, flags, arena = layout(x, y)
+        squares = x * y
+        self.offsets = self.buf[offsets:offsets + 4 * squares].cast("I")
+        self.lengths = self.buf[lengths:lengths + 2 * squares].cast("H")
+        self.masks = self.buf[masks:masks + 8 * squares].cast("Q")
+        self.flags = self.buf[flags:flags + squares]
+        self.arena = self.buf[arena:arena + capacity]
+        self.cells_start = offsets
+        self.cells_end = arena
+
+    @property
+    def version(self) -> int:
+        return struct.unpack_from("<Q", self.buf, VERSION_OFFSET)[0]
+
+    def set_version(self, version: int) -> None:
+        struct.pack_into("<Q", self.buf, VERSION_OFFSET, version)
+
+    def release(self) -> None:
+        """ Releases every view, so the block can be closed. """
+        for view in (self.offsets, self.lengths, self.masks, self.flags, self.arena, self.buf):
+            view.release()
+        self.buf = None
+
+
+class SharedGridWriter:
+    """
+    Publishes the state of a grid into a shared memory block.
+    Only squares which changed since the last publish are written.
+    """
+
+    def __init__(self, grid: Grid, arena_capacity: int=0) -> None:
+        """
+        Creates the block and publishes the grid's current state.
+        The arena starts with room for `arena_capacity` layers, by default 2 per square (at least 64k).
+
+        Complexity: O(k)
+        k: The number of squares in use (in allocated tiles, for a tiled grid)
+        """
+        self.grid = grid
+        self.changes = grid.watch()
+        self.version = 0
+        self.arena_used = 0
+        self.views: _Views|None = None
+        self._create(arena_capacity or max(2 * grid.x * grid.y, 1 << 16))
+        self._publish_all()
+
+    @property
+    def name(self) -> str:
+        """ The name readers attach to. Changes when the block moves, but readers follow it. """
+        return self.views.block.name
+
+    def _create(self, capacity: int) -> None:
+        """
+        Creates a block with room for `capacity` layers in the arena and writes its header.
+        If there was a block before, it's marked as moved to the new one and freed.
+        """
+        block = shared_memory.SharedMemory(create=True, size=layout(self.grid.x, self.grid.y)[4] + capacity)
+        HEADER.pack_into(
+            block.buf, 0, MAGIC, FORMAT_VERSION, self.version + 1, self.grid.x, self.grid.y,
+            Grid.DRAW_STYLE_OPTIONS.index(self.grid.draw_style), 0, capacity, 0, b"",
+        )
+        old = self.views
+        self.views = _Views(block, self.grid.x, self.grid.y, capacity)
+        self.capacity = capacity
+        if old is not None:
+            HEADER.pack_into(
+                old.buf, 0, MAGIC, FORMAT_VERSION, self.version + 2, self.grid.x, self.grid.y,
+                Grid.DRAW_STYLE_OPTIONS.index(self.grid.draw_style), FLAG_MOVED, 0, 0, block.name.encode(),
+            )
+            old.release()
+            old.block.close()
+            old.block.unlink() # Readers still attached keep their mapping until they follow the move
+
+    def _write(self, x: int, y: int, stack: bytes, flags: int, mask: int) -> bool:
+        """
+        Appends one square's stack to the arena and points the square at it.
+        Returns False, writing nothing, if the arena is full.
+        """
+        if self.arena_used + len(stack) > self.capacity:
+            return False
+        i = x * self.grid.y + y
+        views = self.views
+        views.arena[self.arena_used:self.arena_used + len(stack)] = stack
+        views.offsets[i] = self.arena_used
+        views.lengths[i] = len(stack)
+        views.masks[i] = mask
+        views.flags[i] = flags
+        self.arena_used += len(stack)
+        return True
+
+    def _publish_all(self) -> None:
+        """
+        Rewrites every square from the start of the arena, moving to a bigger block if needed.
+
+        Complexity: O(nm) to clear the arrays, plus O(k) to write the squares in use
+        """
+        grid = self.grid
+        if grid.blank.hash: # Unallocated squares aren't empty after a special, so every square is written
+            stores = ((x, y, grid.peek(x, y)) for x in range(grid.x) for y in range(grid.y))
+        else:
+            stores = grid.squares()
+        squares = [(x, y, *flatten(store.snapshot()), store.mask) for x, y, store in stores]
+        needed = sum(len(square[2]) for square in squares)
+        if needed > self.capacity:
+            self._create(2 * needed)
+        views = self.views
+        views.set_version(self.version + 1)
+        views.buf[views.cells_start:views.cells_end] = bytes(views.cells_end - views.cells_start)
+        self.arena_used = 0
+        for square in squares:
+            self._write(*square)
+        self.changes.clear()
+        self._finish()
+
+    def _finish(self) -> None:
+        """ Records the arena use and makes the new state version visible. """
+        struct.pack_into("<Q", self.views.buf, ARENA_USED_OFFSET, self.arena_used)
+        self.version += 2
+        self.views.set_version(self.version)
+
+    def publish(self) -> int:
+        """
+        Writes every square which changed since the last publish, and returns the new state version.
+
+        Complexity: O(c) usually, O(_publish_all) when the arena is full
+        c: The number of changed squares
+        """
+        views = self.views
+        views.set_version(self.version + 1)
+        changes = list(self.changes)
+        self.changes.clear()
+        for x, y in changes:
+            store = self.grid.peek(x, y)
+            if not self._write(x, y, *flatten(store.snapshot()), store.mask):
+                self._publish_all() # Also rewrites the squares not written yet
+                return self.version
+        self._finish()
+        return self.version
+
+    def close(self) -> None:
+        """
+        Stops watching the grid and frees the block.
+
+        Complexity: O(w)
+        w: The number of watchers of the grid
+        """
+        self.grid.unwatch(self.changes)
+        self.views.release()
+        self.views.block.close()
+        self.views.block.unlink()
+
+
+class SharedGridReader:
+    """
+    Maps a block published by a SharedGridWriter, possibly in another process.
+    Stacks, masks and flags are read straight from shared memory without copying.
+
+    Reads can race with the writer; wrap them in `read` to get a consistent result.
+    """
+
+    def __init__(self, name: str) -> None:
+        """
+        Attaches to the block called `name`.
+        :raises ValueError: if it isn't a shared grid this version can read
+
+        Complexity: O(1)
+        """
+        self.views: _Views|None = None
+        self._attach(name)
+
+    def _attach(self, name: str) -> None:
+        """ Attaches to a block, reading its header. """
+        block = shared_memory.SharedMemory(name=name)
+        magic, version, _, x, y, style, _, capacity, _, _ = HEADER.unpack_from(block.buf, 0)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            block.close()
+            raise ValueError(f"{name} is not a shared grid this version can read")
+        self.x = x
+        self.y = y
+        self.draw_style = Grid.DRAW_STYLE_OPTIONS[style]
+        self.views = _Views(block, x, y, capacity)
+        self.store = Grid(self.draw_style, 1, 1, tiled=False).layer_store_type() # Scratch store for get_color
+
+    @property
+    def version(self) -> int:
+        """ The state version: odd while the writer is publishing. """
+        return self.views.version
+
+    def refresh(self) -> bool:
+        """
+        Follows the writer to a new block if it moved. Returns True if it did.
+
+        Complexity: O(1)
+        """
+        _, _, _, _, _, _, flags, _, _, next_name = HEADER.unpack_from(self.views.buf, 0)
+        if not flags & FLAG_MOVED:
+            return False
+        self.close()
+        self._attach(next_name.rstrip(b"\0").decode())
+        return True
+
+    def read(self, func):
+        """
+        Calls func(self) until it runs without the writer publishing meanwhile, and returns its result.
+
+        Complexity: O(func), repeated while the writer is busy
+        """
+        while True:
+            self.refresh()
+            version = self.version
+            if version % 2 == 0:
+                result = func(self)
+                if self.version == version:
+                    return result
+
+    def stack(self, x: int, y: int) -> memoryview:
+        """
+        The layer indices of square (x, y), as a view into shared memory.
+
+        Complexity: O(1)
+        """
+        i = x * self.y + y
+        offset = self.views.offsets[i]
+        return self.views.arena[offset:offset + self.views.lengths[i]]
+
+    def mask(self, x: int, y: int) -> int:
+        """
+        LayerStore.mask of square (x, y).
+
+        Complexity: O(1)
+        """
+        return self.views.masks[x * self.y + y]
+
+    def special(self, x: int, y: int) -> bool:
+        """
+        Whether square (x, y) is a set store with special on.
+
+        Complexity: O(1)
+        """
+        return bool(self.views.flags[x * self.y + y] & SQUARE_SPECIAL)
+
+    def snapshot(self, x: int, y: int):
+        """
+        The layer store snapshot of square (x, y), as LayerStore.snapshot would return it.
+
+        Complexity: O(n)
+        n: The number of layers in the square
+        """
+        return unflatten(self.draw_style, self.stack(x, y), self.views.flags[x * self.y + y])
+
+    def get_color(self, x: int, y: int, start, timestamp: float) -> tuple[int, int, int]:
+        """
+        The colour square (x, y) shows, as LayerStore.get_color would return it.
+
+        Complexity: O(snapshot + get_color)
+        """
+        self.store.restore(self.snapshot(x, y))
+        return self.store.get_color(start, timestamp, x, y)
+
+    def close(self) -> None:
+        """
+        Detaches from the block.
+
+        Complexity: O(1)
+        """
+        self.views.release()
+        self.views.block.close()
@@ -0,0 +1,48 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+from ed_utils.decorators import number
+
+from replay import ReplayTracker
+from replay_log import ReplayLogReader
+from grid import Grid
+from benchmarks.suite import compare, generate_log, replay_cases, run
+
+class TestBenchmarks(unittest.TestCase):
+
+    @number("9.1")
+    def test_benchmark_log(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "bench.sprl")
+            generate_log(path, Grid.DRAW_STYLE_ADD, 16, 300)
+            log = ReplayLogReader(path)
+            self.assertEqual(sum(1 for _ in log), 300)
+            # Replaying it gives the same grid every time
+            hashes = set()
+            for _ in range(2):
+                grid = log.make_grid()
+                replay = ReplayTracker()
+                replay.add_source(log)
+                while not replay.play_next_action(grid):
+                    pass
+                hashes.add(grid.state_hash())
+            self.assertEqual(len(hashes), 1)
+
+        # Cases left out by the filter aren't set up
+        with mock.patch("benchmarks.suite._painted_grid") as painted, mock.patch("benchmarks.suite.generate_log") as generate:
+            self.assertEqual(list(run(quick=True, repeats=1, name_filter="layer_apply/red")), ["layer_apply/red"])
+            self.assertFalse(painted.called or generate.called)
+            # The replay logs go in a folder removed once the replay cases are done
+            cases = replay_cases(quick=True)
+            name, setup = next(cases)
+            self.assertTrue(name.startswith("replay/"))
+            setup()
+            folder = os.path.dirname(generate.call_args[0][0])
+            self.assertTrue(os.path.isdir(folder))
+            list(cases)
+            self.assertFalse(os.path.exists(folder))
+
+        baseline = {"a": {"seconds": 1.0}, "b": {"seconds": 1.0}, "c": {"seconds": 2.0}}
+        results = {"a": {"seconds": 1.2}, "b": {"seconds": 1.5}, "c": {"seconds": 3.0}, "new": {"seconds": 9.0}}
+        self.assertEqual(compare(results, baseline, 0.25), [("b", 1.5), ("c", 1.5)])
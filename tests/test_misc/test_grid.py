@@ -0,0 +1,402 @@
+import unittest
+from ed_utils.decorators import number
+
+import io
+import os
+import tempfile
+from action import BulkPaintStep, PaintAction, PasteStep, RestoreStep
+from layers import green, red, blue, invert
+from grid import Grid
+from grid_file import GridFile
+from disk_grid import DiskGrid
+from replay_log import ByteReader, decode_action, encode_action
+
+class TestGrid(unittest.TestCase):
+
+    @number("7.1")
+    def test_layer_index(self):
+        for style in Grid.DRAW_STYLE_OPTIONS:
+            grid = Grid(style, 6, 6)
+            grid[1][1].add(red)
+            grid[2][3].add(red)
+            grid[0][4].add(blue)
+            grid[5][5].add(blue)
+            self.assertEqual(grid.cells_with(red), {(1, 1), (2, 3)})
+            self.assertEqual(grid.count_cells(blue), 2)
+            self.assertEqual(grid.count_cells(green), 0)
+
+            grid[1][1].erase(red)
+            self.assertEqual(grid.cells_with(red), {(2, 3)})
+            grid[5][5].add(green)
+            self.assertEqual(grid.count_cells(blue), 1 if style == Grid.DRAW_STYLE_SET else 2)
+            self.assertEqual(grid.cells_with(green), {(5, 5)})
+
+    @number("7.2")
+    def test_erase_layer_everywhere(self):
+        for style in Grid.DRAW_STYLE_OPTIONS:
+            grid = Grid(style, 6, 6)
+            control_grid = Grid(style, 6, 6)
+            for x, y, layer in [(1, 1, red), (1, 1, green), (1, 1, red), (4, 2, red), (3, 3, blue)]:
+                grid[x][y].add(layer)
+                control_grid[x][y].add(layer)
+            before = grid.state_hash()
+
+            action = PaintAction.from_restores(grid.erase_layer(red))
+            self.assertEqual(grid.count_cells(red), 0)
+            self.assertEqual(grid.count_cells(blue), 1)
+
+            action.undo_apply(grid)
+            self.assertEqual(grid.state_hash(), before)
+            self.assertGridEqual(grid, control_grid)
+            action.redo_apply(grid)
+            self.assertEqual(grid.count_cells(red), 0)
+
+    @number("7.3")
+    def test_replace_layer(self):
+        grid = Grid(Grid.DRAW_STYLE_ADD, 6, 6)
+        control_grid = Grid(Grid.DRAW_STYLE_ADD, 6, 6)
+        for layer in [red, invert, red]:
+            grid[2][2].add(layer)
+        for layer in [blue, invert, blue]:
+            control_grid[2][2].add(layer)
+        action = PaintAction.from_restores(grid.replace_layer(red, blue))
+        self.assertEqual(len(action.steps), 1)
+        self.assertEqual(grid.state_hash(), control_grid.state_hash())
+        self.assertGridEqual(grid, control_grid)
+        self.assertEqual(grid.cells_with(red), set())
+        self.assertEqual(grid.cells_with(blue), {(2, 2)})
+
+    @number("7.4")
+    def test_flood_fill(self):
+        grid = Grid(Grid.DRAW_STYLE_ADD, 8, 8)
+        # A wall of red down column 3, with a gap at the top
+        for y in range(7):
+            grid[3][y].add(red)
+        grid[0][0].add(blue)
+        grid[0][0].erase(blue) # Same stack as an untouched square again
+
+        region = grid.fill_region(1, 1)
+        cells = set(zip(region[::2], region[1::2]))
+        self.assertEqual(len(cells) * 2, len(region))
+        self.assertEqual(len(cells), 64 - 7)
+        grid[3][6].erase(red)
+        grid[3][7].add(red)
+        self.assertEqual(len(grid.fill_region(1, 1, match_layers=True)) // 2, 64 - 7)
+        grid[3][7].erase(red)
+        grid[3][6].add(red)
+        grid[3][7].add(green)
+        region = grid.fill_region(0, 0, match_layers=True)
+        self.assertEqual(set(zip(region[::2], region[1::2])), {(x, y) for x in range(3) for y in range(8)})
+
+        # Colours match whatever the background is passed as, so a square painted the background colour joins the region
+        fill = Grid(Grid.DRAW_STYLE_SET, 4, 4)
+        fill[2][2].add(red)
+        self.assertEqual(len(fill.fill_region(0, 0, bg=[255, 0, 0])) // 2, 16)
+
+        # One action fills the region, undoes exactly and survives encoding
+        action = grid.apply_many(zip(region[::2], region[1::2]), blue)
+        self.assertEqual(len(action.steps[0]), 24)
+        self.assertEqual(grid.count_cells(blue), 24)
+        data = bytearray()
+        encode_action(action, data)
+        decoded = decode_action(ByteReader(io.BytesIO(bytes(data))))
+        decoded.undo_apply(grid)
+        self.assertEqual(grid.count_cells(blue), 0)
+        self.assertEqual(len(grid.fill_region(1, 1)) // 2, 24)
+
+    @number("7.5")
+    def test_apply_many(self):
+        for style in Grid.DRAW_STYLE_OPTIONS:
+            grid = Grid(style, 8, 6)
+            control_grid = Grid(style, 8, 6)
+            # Overlapping brushes, one partly off the grid, paint each square once
+            action = grid.stroke([(1, 1), (2, 1), (7, 5)], [1, 1, 2], red)
+            self.assertEqual(len(action.steps), 1)
+            self.assertIsInstance(action.steps[0], BulkPaintStep)
+            cells = {(1, 1), (0, 1), (2, 1), (1, 0), (1, 2), (3, 1), (2, 0), (2, 2),
+                     (7, 5), (6, 5), (5, 5), (7, 4), (7, 3), (6, 4)}
+            self.assertEqual(grid.cells_with(red), cells)
+            self.assertEqual(len(action.steps[0]), len(cells))
+            for x, y in cells:
+                control_grid[x][y].add(red)
+            self.assertGridEqual(grid, control_grid)
+
+            # Squares already showing the layer only change on additive stores
+            again = grid.apply_many([(1, 1), (1, 1), (9, 9)], red)
+            self.assertEqual(len(again.steps), 1 if style == Grid.DRAW_STYLE_ADD else 0)
+            again.undo_apply(grid)
+
+            erase = grid.apply_many(cells, red, Grid.OP_ERASE)
+            self.assertTrue(all(isinstance(step, RestoreStep) for step in erase.steps))
+            self.assertEqual(grid.state_hash(), 0)
+            erase.undo_apply(grid)
+            action.undo_apply(grid)
+            self.assertEqual(grid.state_hash(), 0)
+
+    @number("7.6")
+    def test_copy_paste(self):
+        for style in Grid.DRAW_STYLE_OPTIONS:
+            grid = Grid(style, 8, 8)
+            for layer in [red, invert, blue]:
+                grid.apply_many([(0, 0), (1, 0), (1, 1)], layer)
+            grid[5][5].add(green)
+
+            region = grid.copy_region(0, 0, 2, 2)
+            action = PaintAction([PasteStep.from_changes(grid.paste_region(region, 5, 5))])
+            self.assertEqual(len(action.steps[0]), 3) # (0, 1) and (5, 6) are both empty
+            if style == Grid.DRAW_STYLE_ADD:
+                self.assertIs(grid[6][6].layers, grid[1][1].layers) # Shared, not copied
+            for x, y in [(0, 0), (1, 0), (1, 1), (0, 1)]:
+                self.assertEqual(grid[x + 5][y + 5].snapshot(), grid[x][y].snapshot())
+
+            # Changing the source or the paste doesn't affect the other
+            expected = grid[1][1].snapshot()
+            grid[1][1].add(green)
+            self.assertEqual(grid[6][6].snapshot(), expected)
+            grid[1][1].restore(expected)
+            grid[6][6].add(green)
+            self.assertEqual(grid[1][1].snapshot(), expected)
+            self.assertEqual(region[1][1].snapshot(), expected)
+            grid[6][6].restore(expected)
+
+            state = grid.snapshot()
+            action.undo_apply(grid)
+            self.assertEqual(grid.cells_with(green), {(5, 5)})
+            action.redo_apply(grid)
+            self.assertEqual(grid.snapshot(), state)
+
+            # Pastes are logged as restore steps
+            data = bytearray()
+            encode_action(action, data)
+            decode_action(ByteReader(io.BytesIO(bytes(data)))).undo_apply(grid)
+            self.assertEqual(grid.cells_with(green), {(5, 5)})
+            self.assertEqual(grid.count_cells(blue), 3)
+
+    @number("7.7")
+    def test_tiled_grid(self):
+        grid = Grid(Grid.DRAW_STYLE_SEQUENCE, 1024, 1024)
+        self.assertEqual(grid.tiles, {})
+        grid[40][1000].add(red)
+        grid.apply_many([(41, 1000), (1023, 0)], blue)
+        self.assertEqual(set(grid.tiles), {(1, 31), (31, 0)})
+        self.assertEqual(grid.take_dirty_tiles(), {(1, 31), (31, 0)})
+        self.assertIs(grid.peek(500, 500), grid.blank)
+        self.assertEqual(len(grid.tiles), 2)
+        self.assertEqual(len(grid.fill_region(500, 500, match_layers=True)) // 2, 1024 * 1024 - 3)
+        self.assertEqual(len(grid.tiles), 2)
+        grid[1023][0].erase(blue)
+        self.assertEqual(grid.take_dirty_tiles(), {(31, 0)})
+
+        # Tiled and untiled grids given the same actions end up the same
+        for style in Grid.DRAW_STYLE_OPTIONS:
+            grid = Grid(style, 70, 40, tiled=True)
+            control_grid = Grid(style, 70, 40, tiled=False)
+            for g in (grid, control_grid):
+                g.stroke([(3, 3), (68, 38), (35, 20)], 2, red)
+                g[35][20].add(invert)
+                g.special()
+            self.assertEqual(grid.state_hash(), control_grid.state_hash())
+            self.assertEqual(grid.cells_with(red), control_grid.cells_with(red))
+            self.assertGridEqual(grid, control_grid)
+
+            # Restoring an older snapshot frees tiles it doesn't use
+            empty = Grid(style, 70, 40, tiled=True).snapshot()
+            state = grid.snapshot()
+            grid.restore(empty)
+            self.assertEqual((grid.tiles, grid.state_hash()), ({}, 0))
+            grid.restore(state)
+            self.assertEqual(grid.state_hash(), control_grid.state_hash())
+
+    @number("7.8")
+    def test_save_load(self):
+        for style in Grid.DRAW_STYLE_OPTIONS:
+            for tiled in (False, True):
+                grid = Grid(style, 70, 40, tiled=tiled)
+                grid.stroke([(3, 3), (68, 38)], 2, red)
+                grid.apply_many([(3, 3), (4, 3)], invert)
+                grid[3][3].add(blue)
+                grid.special()
+                with tempfile.TemporaryDirectory() as folder:
+                    path = os.path.join(folder, "canvas.spgf")
+                    grid.save(path)
+                    loaded = Grid.load(path)
+                    self.assertEqual((loaded.x, loaded.y, loaded.draw_style), (70, 40, style))
+                    self.assertEqual(loaded.state_hash(), grid.state_hash())
+                    self.assertEqual(loaded.cells_with(red), grid.cells_with(red))
+                    self.assertGridEqual(loaded, grid)
+
+                    # Tiles can be read one at a time, and empty ones aren't saved
+                    with GridFile(path) as f:
+                        if style == Grid.DRAW_STYLE_ADD: # Special empties or fills squares of the others
+                            self.assertEqual(set(f.tiles), {(0, 0), (2, 1)})
+                            self.assertIsNone(f.tile_states((1, 0)))
+                        partial = f.make_grid(tiled=True)
+                        f.load_into(partial, [(0, 0)])
+                    self.assertEqual(partial.peek(3, 3).snapshot(), grid.peek(3, 3).snapshot())
+                    self.assertIs(partial.peek(68, 38), partial.blank)
+
+                    with open(path, "wb") as f:
+                        f.write(b"not a canvas")
+                    self.assertRaises(ValueError, Grid.load, path)
+
+    @number("7.9")
+    def test_disk_grid(self):
+        for style in Grid.DRAW_STYLE_OPTIONS:
+            with tempfile.TemporaryDirectory() as folder:
+                path = os.path.join(folder, "canvas.spdg")
+                # A tiny arena, so stacks outgrow their room and the arena file has to grow
+                grid = DiskGrid(style, 70, 40, path, arena_capacity=16)
+                control_grid = Grid(style, 70, 40)
+                for g in (grid, control_grid):
+                    g.stroke([(3, 3), (68, 38), (35, 20)], 2, red)
+                    for _ in range(10):
+                        g[35][20].add(invert)
+                    g.special()
+                    g.apply_many([(3, 3)], red, Grid.OP_ERASE)
+                self.assertEqual(grid.state_hash(), control_grid.state_hash())
+                self.assertEqual(grid.cells_with(red), control_grid.cells_with(red))
+                self.assertGridEqual(grid, control_grid)
+                state = grid.snapshot()
+                grid.close()
+
+                # Reopening maps the same squares back, and snapshots move between disk and memory grids
+                with DiskGrid.open(path) as grid:
+                    self.assertEqual(grid.state_hash(), control_grid.state_hash())
+                    self.assertEqual(grid.cells_with(red), control_grid.cells_with(red))
+                    self.assertEqual(grid.count_cells(invert), control_grid.count_cells(invert))
+                    self.assertEqual(grid.layer_cells, {}) # The layer index stays on disk
+                    grid.restore(Grid(style, 70, 40, tiled=True).snapshot())
+                    self.assertEqual((grid.tiles, grid.state_hash()), ({}, 0))
+                    grid.restore(state)
+                    self.assertEqual(grid.state_hash(), control_grid.state_hash())
+                    self.assertEqual(grid.peek(35, 20).clone().snapshot(), control_grid[35][20].snapshot())
+
+    @number("7.10")
+    def test_load_lazily(self):
+        for style in Grid.DRAW_STYLE_OPTIONS:
+            grid = Grid(style, 100, 70, tiled=True)
+            grid.special()
+            grid.stroke([(3, 3), (98, 68)], 2, red)
+            grid.apply_many([(40, 40), (41, 40)], blue)
+            with tempfile.TemporaryDirectory() as folder:
+                path = os.path.join(folder, "canvas.spgf")
+                grid.save(path)
+                loaded = Grid.load(path, tiled=True)
+                # Opening reads no squares, but the hash is already right
+                self.assertEqual(set(loaded.unloaded), set(loaded.tiles))
+                self.assertEqual((loaded.layer_cells, loaded.state_hash()), ({}, grid.state_hash()))
+
+                # Using a square reads its tile only, without counting as a change
+                changes = loaded.watch()
+                self.assertEqual(loaded.peek(3, 3).snapshot(), grid.peek(3, 3).snapshot())
+                self.assertNotIn((0, 0), loaded.unloaded)
+                self.assertIn((3, 2), loaded.unloaded)
+                self.assertEqual((changes, loaded.state_hash()), (set(), grid.state_hash()))
+                loaded.unwatch(changes)
+
+                # Layer queries read the tiles using the layer
+                self.assertEqual(loaded.cells_with(blue), grid.cells_with(blue))
+                self.assertEqual(loaded.count_cells(red), grid.count_cells(red))
+                self.assertGridEqual(loaded, grid)
+                self.assertEqual(loaded.unloaded, {})
+
+                # Once every tile is read the file is let go, so it can be saved over
+                loaded[50][50].add(green)
+                loaded.save(path)
+                self.assertEqual(Grid.load(path, tiled=True).state_hash(), loaded.state_hash())
+
+    @number("7.11")
+    def test_apply_many_batched(self):
+        cells = [(x, y) for x in range(5, 70) for y in range(3, 40, 2)] + [(5, 3), (500, 3)]
+        for style in Grid.DRAW_STYLE_OPTIONS:
+            for tiled in (False, True):
+                grid = Grid(style, 80, 45, tiled=tiled)
+                control_grid = Grid(style, 80, 45, tiled=tiled)
+                for g in (grid, control_grid):
+                    g.stroke([(10, 10)], 3, blue)
+                    if tiled:
+                        g.take_dirty_tiles()
+                changes, control_changes = grid.watch(), control_grid.watch()
+
+                # One notification per square, as if each had been painted on its own
+                action = grid.apply_many(cells, red)
+                for x, y in dict.fromkeys(cells[:-1]):
+                    if style == Grid.DRAW_STYLE_ADD or (x, y) not in control_grid.cells_with(red):
+                        control_grid[x][y].add(red)
+                self.assertEqual(grid.state_hash(), control_grid.state_hash())
+                self.assertEqual((grid.cells_with(red), grid.cells_with(blue)), (control_grid.cells_with(red), control_grid.cells_with(blue)))
+                self.assertEqual(changes, control_changes)
+                if tiled:
+                    self.assertEqual(grid.take_dirty_tiles(), control_grid.take_dirty_tiles())
+                self.assertGridEqual(grid, control_grid)
+
+                # Undoing and redoing the bulk step batches too, and match erasing and adding square by square
+                step = action.steps[0]
+                squares = step.affected_grid_squares
+                for undo in (True, False):
+                    getattr(step, "undo_apply" if undo else "redo_apply")(grid)
+                    for i in range(0, len(squares), 2):
+                        sq = control_grid[squares[i]][squares[i + 1]]
+                        sq.erase(red) if undo else sq.add(red)
+                    self.assertEqual(grid.state_hash(), control_grid.state_hash())
+                    self.assertEqual(grid.cells_with(red), control_grid.cells_with(red))
+                    self.assertEqual(changes, control_changes)
+                    if tiled:
+                        self.assertEqual(grid.take_dirty_tiles(), control_grid.take_dirty_tiles())
+                    self.assertGridEqual(grid, control_grid)
+
+    @number("7.12")
+    def test_special_unallocated(self):
+        grid = Grid(Grid.DRAW_STYLE_SET, 300, 200, tiled=True)
+        control_grid = Grid(Grid.DRAW_STYLE_SET, 300, 200, tiled=False)
+        special = PaintAction(is_special=True)
+        for g in (grid, control_grid):
+            g.stroke([(5, 5)], 1, red)
+        special.redo_apply(grid)
+        control_grid.special()
+        # Only the painted tile is allocated, the rest are specialled through the blank store
+        self.assertEqual(set(grid.tiles), {(0, 0)})
+        self.assertEqual(grid.state_hash(), control_grid.state_hash())
+        self.assertEqual(grid.peek(250, 150).snapshot(), control_grid[250][150].snapshot())
+
+        # Tiles allocated after the special start specialled, and undoing it reaches them too
+        for g in (grid, control_grid):
+            g.stroke([(200, 100)], 0, blue)
+        self.assertEqual(grid.state_hash(), control_grid.state_hash())
+        data = bytearray()
+        encode_action(special, data)
+        decoded = decode_action(ByteReader(io.BytesIO(bytes(data))))
+        self.assertEqual(decoded.special_steps, special.special_steps)
+        decoded.undo_apply(grid)
+        control_grid.special()
+        self.assertEqual(grid.state_hash(), control_grid.state_hash())
+        self.assertEqual(set(grid.tiles), {(0, 0), (6, 3)})
+        special.redo_apply(grid)
+        control_grid.special()
+        self.assertEqual(grid.state_hash(), control_grid.state_hash())
+
+        # Snapshots and saved canvases keep the unallocated squares' state
+        state = grid.snapshot()
+        grid.clear()
+        self.assertEqual(grid.state_hash(), 0)
+        grid.restore(state)
+        self.assertEqual(grid.state_hash(), control_grid.state_hash())
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "canvas.spgf")
+            grid.save(path)
+            loaded = Grid.load(path, tiled=True)
+            self.assertEqual(loaded.state_hash(), control_grid.state_hash())
+            self.assertEqual(loaded.peek(250, 150).snapshot(), control_grid[250][150].snapshot())
+            self.assertGridEqual(loaded, control_grid)
+        self.assertGridEqual(grid, control_grid)
+
+    def assertGridEqual(self, grid1: Grid, grid2: Grid):
+        for x in range(len(grid1.grid)):
+            for y in range(len(grid1[x])):
+                sq1 = grid1[x][y]
+                sq2 = grid2[x][y]
+                self.assertEqual(
+                    sq1.get_color((0, 0, 0), 0, x, y),
+                    sq2.get_color((0, 0, 0), 0, x, y),
+                    "Grid not the same after apply has been made."
+                )
@@ -0,0 +1,49 @@
+import unittest
+from ed_utils.decorators import number
+
+from layers import red
+from grid import Grid
+from memory_report import CATEGORIES, deep_sizeof, project, sample_session, session_report
+
+class TestMemoryReport(unittest.TestCase):
+
+    @number("11.1")
+    def test_memory_report(self):
+        # ArrayR's references are counted, and shared objects only once
+        shared = [0] * 100
+        self.assertGreater(deep_sizeof([shared, shared]), deep_sizeof(shared))
+        self.assertLess(deep_sizeof([shared, shared]), 2 * deep_sizeof(shared))
+
+        reports = {}
+        for style in Grid.DRAW_STYLE_OPTIONS:
+            grid, undo, replay = sample_session(style, 16, 150)
+            report = session_report(grid, undo, replay)
+            held = report["bytes"]
+            self.assertEqual(held["total"], sum(held[name] for name in CATEGORIES))
+            self.assertTrue(all(held[name] > 0 for name in CATEGORIES))
+            # Undo and replay share every action
+            self.assertEqual((report["actions"], report["undo_nodes"], report["keyframes"]), (150, 151, 1))
+            reports[style] = report
+        # Additive stores preallocate their queues
+        self.assertGreater(reports[Grid.DRAW_STYLE_ADD]["bytes"]["grid.stores"], 10 * reports[Grid.DRAW_STYLE_SET]["bytes"]["grid.stores"])
+
+        # Tiled grids only hold the tiles painted
+        grid = Grid(Grid.DRAW_STYLE_SET, 320, 320, tiled=True)
+        empty = session_report(grid)
+        grid.stroke([(5, 5)], 2, red)
+        one_tile = session_report(grid)
+        grid.stroke([(60, 60)], 2, red) # Still small ints, which are shared
+        two_tiles = session_report(grid)
+        self.assertEqual((empty["squares"], one_tile["squares"], two_tiles["squares"]), (0, 1024, 2048))
+        grown = one_tile["bytes"]["grid.stores"] - empty["bytes"]["grid.stores"]
+        self.assertAlmostEqual(two_tiles["bytes"]["grid.stores"] - one_tile["bytes"]["grid.stores"], grown, delta=grown * 0.05)
+
+        # Projections go through the sample grids, and grow with the grid and history
+        painted = session_report(Grid(Grid.DRAW_STYLE_SET, 64, 64))["bytes"]["grid.stores"]
+        small = project(Grid.DRAW_STYLE_SET, 64, 64, depth=0)
+        self.assertAlmostEqual(small["grid.stores"], painted, delta=painted * 0.01)
+        large = project(Grid.DRAW_STYLE_SET, 128, 128, actions=1000, depth=0)
+        self.assertAlmostEqual(large["grid.stores"], 4 * small["grid.stores"], delta=small["grid.stores"] * 0.1)
+        self.assertGreater(large["replay.keyframes"], 0)
+        self.assertEqual(large["total"], sum(large[name] for name in CATEGORIES))
+        self.assertGreater(large["grid.traced"], 0)
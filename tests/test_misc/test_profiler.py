@@ -0,0 +1,65 @@
+import json
+import os
+import tempfile
+import unittest
+from ed_utils.decorators import number
+
+from replay import ReplayTracker
+from layers import red
+from grid import Grid
+from profiler import Profiler, percentile, profiler
+
+class TestProfiler(unittest.TestCase):
+
+    @number("10.1")
+    def test_profiler(self):
+        self.assertEqual(percentile(range(1, 101), 0.5), 50)
+        self.assertEqual(percentile(range(1, 101), 0.99), 99)
+        self.assertEqual(percentile([], 0.5), 0)
+
+        # Disabled, nothing is recorded
+        p = Profiler()
+        with p.span("a"):
+            p.count("cells", 5)
+        p.end_frame()
+        p.end_frame()
+        self.assertEqual((len(p.events), len(p.frame_ms)), (0, 0))
+
+        p.enabled = True
+        p.end_frame()
+        for frame in range(3):
+            with p.span("outer"):
+                with p.span("inner"):
+                    p.count("cells", 10 * frame)
+            p.end_frame()
+        stats = p.stats()
+        self.assertEqual(stats["frames"], 3)
+        self.assertEqual(stats["counts"], {"cells": 20})
+        self.assertEqual(set(stats["spans"]), {"outer", "inner"})
+        self.assertGreaterEqual(stats["spans"]["outer"], stats["spans"]["inner"])
+        self.assertLessEqual(stats["p50"], stats["p99"])
+
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "trace.json")
+            p.export_chrome_trace(path)
+            with open(path) as f:
+                events = json.load(f)["traceEvents"]
+        spans = [event for event in events if event["ph"] == "X"]
+        self.assertEqual(sorted(event["name"] for event in spans), ["frame"] * 3 + ["inner"] * 3 + ["outer"] * 3)
+        self.assertTrue(all(event["dur"] >= 0 for event in spans))
+        self.assertEqual([event["args"] for event in events if event["ph"] == "C"], [{"cells": 0}, {"cells": 10}, {"cells": 20}])
+
+        # The trackers and grid report to the application's profiler
+        profiler.enabled = True
+        try:
+            grid = Grid(Grid.DRAW_STYLE_SET, 4, 4)
+            replay = ReplayTracker()
+            replay.add_action(grid.stroke([(1, 1)], 1, red), grid=grid)
+            replay.start_replay()
+            replay.play_next_action(Grid(Grid.DRAW_STYLE_SET, 4, 4))
+            grid.special()
+            names = {event[0] for event in profiler.events}
+        finally:
+            profiler.enabled = False
+            profiler.clear()
+        self.assertTrue({"ReplayTracker.add_action", "ReplayTracker.play_next_action", "Grid.special"} <= names)
@@ -0,0 +1,272 @@
+import unittest
+import json
+import os
+import struct
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from ed_utils.decorators import number
+
+from animation import export_animation, frame_count, grid_period
+from benchmarks.suite import generate_log
+from grid import Grid
+from replay import ReplayTracker
+from layers import rainbow, red, sparkle, invert, lighten
+from render import BG, _render_parallel, _render_serial, render_log, replay_frames
+from shared_grid import SharedGridReader, SharedGridWriter
+from thumbnails import build_thumbnails, mip_levels
+from tile_render import TileRenderPipeline
+
+def read_shared(name):
+    reader = SharedGridReader(name)
+    try:
+        return reader.read(lambda r: [
+            (r.snapshot(x, y), r.mask(x, y)) for x in range(r.x) for y in range(r.y)
+        ])
+    finally:
+        reader.close()
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+class TestRender(unittest.TestCase):
+
+    @number("8.1")
+    def test_parallel_tiles(self):
+        bg = (10, 20, 30)
+        for style in Grid.DRAW_STYLE_OPTIONS:
+            grid = Grid(style, 70, 40, tiled=True)
+            grid.stroke([(5, 5), (40, 20), (69, 39)], 4, sparkle)
+            grid.stroke([(6, 5), (66, 39)], 3, rainbow)
+            grid.apply_many([(40, 20), (41, 20)], invert)
+            tiles = sorted(grid.tiles)
+            before = Grid(style, 70, 40, tiled=True)
+            before.restore(grid.snapshot())
+
+            pipeline = TileRenderPipeline(2)
+            try:
+                self.assertEqual(pipeline.next_frame(grid, tiles, 1.5, 1, bg), {})
+                grid[69][39].add(red) # Only seen by the next frame
+                pipeline.invalidate(grid.take_dirty_tiles())
+                first = pipeline.next_frame(grid, tiles, 2.0, 2, bg)
+                second = pipeline.collect()
+            finally:
+                pipeline.close()
+
+            for frame, source, timestamp, step in [(first, before, 1.5, 1), (second, grid, 2.0, 2)]:
+                self.assertEqual(set(frame), set(tiles))
+                for key, (frame_step, mask, colors, generation) in frame.items():
+                    self.assertEqual(frame_step, step)
+                    self.assertEqual(generation, int(frame is second)) # Every tile was dirty before the second submit
+                    self.assertEqual((colors, mask), self.evaluate(source.tiles[key], timestamp, step, bg))
+
+    def evaluate(self, tile, timestamp, step, bg):
+        colors = bytearray()
+        mask = 0
+        for i in range(tile.width):
+            for j in range(tile.height):
+                store = tile.stores[i * tile.height + j]
+                mask |= store.mask
+                if i % step == 0 and j % step == 0:
+                    colors += bytes(store.get_color(bg, timestamp, tile.x0 + i, tile.y0 + j))
+        return bytes(colors), mask
+
+    @number("8.2")
+    def test_shared_grid(self):
+        for style in Grid.DRAW_STYLE_OPTIONS:
+            for tiled in (False, True):
+                grid = Grid(style, 40, 36, tiled=tiled)
+                grid.stroke([(3, 3), (30, 30)], 2, rainbow)
+                writer = SharedGridWriter(grid, arena_capacity=64)
+                reader = SharedGridReader(writer.name)
+                try:
+                    self.assertEqual(reader.version, 2)
+                    self.assertEqual(self.shared_states(reader), self.states(grid))
+
+                    # Enough changes to fill the arena, so the writer compacts it or moves to a bigger block
+                    name = writer.name
+                    grid.apply_many([(x, y) for x in range(40) for y in range(0, 36, 2)], sparkle)
+                    grid.special()
+                    grid.apply_many([(1, 1)], red, Grid.OP_ERASE)
+                    version = writer.publish()
+                    self.assertEqual(reader.refresh(), writer.name != name)
+                    self.assertEqual(reader.version, version)
+                    self.assertEqual(self.shared_states(reader), self.states(grid))
+                    self.assertEqual(reader.get_color(3, 3, (0, 0, 0), 1.5), grid.peek(3, 3).get_color((0, 0, 0), 1.5, 3, 3))
+
+                    grid.apply_many([(5, 6)], red)
+                    writer.publish()
+                    with ProcessPoolExecutor(1) as pool:
+                        self.assertEqual(pool.submit(read_shared, writer.name).result(), self.states(grid))
+                    self.assertEqual(list(reader.stack(5, 6))[-1:], [red.index])
+                finally:
+                    reader.close()
+                    writer.close()
+                self.assertEqual(grid.watchers, [])
+
+    @number("8.3")
+    @unittest.skipIf(numpy is None, "needs NumPy")
+    def test_to_array(self):
+        bg = (10, 20, 30)
+        for style in Grid.DRAW_STYLE_OPTIONS:
+            for tiled in (False, True):
+                grid = Grid(style, 45, 35, tiled=tiled)
+                grid.stroke([(i * 7 % 45, i * 11 % 35) for i in range(20)], 3, rainbow)
+                grid.stroke([(i * 13 % 45, i * 5 % 35) for i in range(20)], 4, sparkle)
+                grid.stroke([(i * 3 % 45, i * 17 % 35) for i in range(20)], 2, invert)
+                grid.stroke([(i * 9 % 45, i * 2 % 35) for i in range(10)], 2, lighten)
+                grid.special()
+                for timestamp in (0, 1.3, 77.7):
+                    pixels = grid.to_array(timestamp, bg)
+                    self.assertEqual((pixels.shape, pixels.dtype), ((35, 45, 3), numpy.uint8))
+                    expected = bytearray()
+                    for y in range(grid.y - 1, -1, -1):
+                        for x in range(grid.x):
+                            expected += bytes(grid.peek(x, y).get_color(bg, timestamp, x, y))
+                    self.assertEqual(pixels.tobytes(), bytes(expected))
+                region = grid.to_array(1.3, bg, (5, 6, 20, 50)) # Clipped to the top of the grid
+                self.assertTrue((region == grid.to_array(1.3, bg)[:35 - 6, 5:25]).all())
+
+    @number("8.4")
+    @unittest.skipIf(numpy is None, "needs NumPy")
+    def test_export_animation(self):
+        grid = Grid(Grid.DRAW_STYLE_ADD, 12, 10)
+        grid.apply_many([(1, 1), (2, 2)], red)
+        self.assertEqual(grid_period(grid), 0)
+        self.assertEqual(frame_count(0, 100, 0.5, grid_period(grid)), 1)
+        grid.apply_many([(3, 3)], rainbow)
+        self.assertEqual(grid_period(grid), 20)
+        self.assertEqual(frame_count(0, 100, 0.5, 20), 40)
+        self.assertEqual(frame_count(0, 100, 0.3, 20), 334) # Steps don't line up with the period
+        grid.apply_many([(4, 4)], sparkle)
+        self.assertEqual(grid_period(grid), 340)
+
+        with tempfile.TemporaryDirectory() as folder:
+            # Raw streams can't loop, so every frame is written
+            path = os.path.join(folder, "frames.rgb")
+            self.assertEqual(export_animation(grid, path, 0, 5, 0.5, scale=2), 10)
+            with open(path, "rb") as f:
+                data = f.read()
+            self.assertEqual(len(data), 10 * 24 * 20 * 3)
+            self.assertEqual(data[:24 * 20 * 3], bytes(grid.to_array(0).repeat(2, axis=0).repeat(2, axis=1).tobytes()))
+
+            grid.apply_many([(4, 4)], sparkle, Grid.OP_ERASE)
+            path = os.path.join(folder, "canvas.png")
+            self.assertEqual(export_animation(grid, path, 0, 100, 0.5), 40)
+            with open(path, "rb") as f:
+                data = f.read()
+            actl = data.index(b"acTL")
+            self.assertEqual(struct.unpack(">II", data[actl + 4:actl + 12]), (40, 0))
+            self.assertEqual(data.count(b"fcTL"), 40)
+
+            path = os.path.join(folder, "canvas.gif")
+            self.assertEqual(export_animation(grid, path, 0, 2, 0.5, region=(0, 0, 5, 4)), 4)
+            with open(path, "rb") as f:
+                data = f.read()
+            self.assertEqual(data[:10], b"GIF89a" + struct.pack("<HH", 5, 4))
+            self.assertEqual(data[-1:], b"\x3B")
+
+    @number("8.5")
+    @unittest.skipIf(numpy is None, "needs NumPy")
+    def test_thumbnails(self):
+        pixels = numpy.zeros((5, 4, 3), numpy.uint8)
+        pixels[0, 0] = (255, 255, 255)
+        levels = mip_levels(pixels)
+        self.assertEqual([level.shape[:2] for level in levels], [(5, 4), (3, 2), (2, 1), (1, 1)])
+        self.assertEqual(tuple(levels[1][0, 0]), (64, 64, 64))
+
+        with tempfile.TemporaryDirectory() as folder:
+            cache = os.path.join(folder, "cache")
+            paths = [os.path.join(folder, f"{i}.spgf") for i in range(3)]
+            grid = Grid(Grid.DRAW_STYLE_ADD, 20, 12)
+            grid.stroke([(5, 5)], 3, rainbow)
+            grid.save(paths[0])
+            grid.save(paths[1]) # Same content, so it shares the cached thumbnails
+            grid.apply_many([(0, 0)], red)
+            grid.save(paths[2])
+
+            levels = build_thumbnails(paths, cache, timestamp=2, workers=2)
+            self.assertEqual(levels[paths[0]], levels[paths[1]])
+            self.assertNotEqual(levels[paths[0]], levels[paths[2]])
+            self.assertEqual(len(levels[paths[2]]), 6) # 20x12, 10x6, 5x3, 3x2, 2x1, 1x1
+            self.assertEqual(len([name for name in os.listdir(cache) if name != "index.json"]), 2)
+            with open(levels[paths[2]][0], "rb") as f:
+                self.assertEqual(f.read()[16:24], struct.pack(">II", 20, 12))
+
+            # Unchanged files are served from the index, and edited ones only render new content
+            written = {path: os.stat(path).st_mtime_ns for path in levels[paths[2]]}
+            grid.apply_many([(0, 0)], red, Grid.OP_ERASE)
+            grid.save(paths[2])
+            again = build_thumbnails(paths, cache, timestamp=2)
+            self.assertEqual(again[paths[2]], levels[paths[0]])
+            self.assertEqual({path: os.stat(path).st_mtime_ns for path in levels[paths[2]]}, written)
+
+            # A corrupt canvas fails on its own, and the rest are still made and indexed
+            bad = os.path.join(folder, "bad.spgf")
+            with open(bad, "wb") as f:
+                f.write(b"not a canvas")
+            errors = {}
+            mixed = build_thumbnails([bad, paths[0]], cache, timestamp=3, errors=errors)
+            self.assertEqual((mixed[bad], len(mixed[paths[0]])), ([], 6))
+            self.assertIn("ValueError", errors[bad])
+            with open(os.path.join(cache, "index.json")) as f:
+                index = json.load(f)
+            self.assertNotIn(os.path.abspath(bad), index)
+            self.assertEqual(index[os.path.abspath(paths[0])]["settings"][0], 3)
+
+    @number("8.7")
+    def test_render_log(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "session.sprl")
+            generate_log(path, Grid.DRAW_STYLE_SEQUENCE, 10, 45)
+            frames = os.path.join(folder, "frame_{:03d}.ppm")
+            self.assertEqual(render_log(path, frames, every=20, scale=3, bg=(1, 2, 3)), 45)
+            self.assertEqual(sorted(os.listdir(folder)), ["frame_020.ppm", "frame_040.ppm", "frame_045.ppm", "session.sprl"])
+
+            # Each frame is the grid after that many actions, at its virtual timestamp, each square 3x3 pixels
+            for played, grid in replay_frames(path, 20):
+                with open(frames.format(played), "rb") as f:
+                    data = f.read()
+                header = b"P6\n30 30\n255\n"
+                self.assertEqual(data[:len(header)], header)
+                pixels = data[len(header):]
+                self.assertEqual(len(pixels), 30 * 30 * 3)
+                timestamp = played * ReplayTracker.REPLAY_TIMER_DELTA
+                for x, y in ((0, 0), (9, 9), (4, 7)):
+                    color = bytes(grid.peek(x, y).get_color((1, 2, 3), timestamp, x, y))
+                    for px, py in ((3 * x, 3 * (9 - y)), (3 * x + 2, 3 * (9 - y) + 2)): # Square (0, 0) is at the bottom
+                        offset = (py * 30 + px) * 3
+                        self.assertEqual(pixels[offset:offset + 3], color)
+
+            final = os.path.join(folder, "final.png")
+            self.assertEqual(render_log(path, final), 45)
+            with open(final, "rb") as f:
+                self.assertEqual(f.read()[16:24], struct.pack(">II", 10, 10))
+            # Without a placeholder, every frame would go to the same file
+            with self.assertRaises(ValueError):
+                render_log(path, os.path.join(folder, "out.png"), every=10)
+
+    @number("8.6")
+    def test_render_parallel(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "session.sprl")
+            generate_log(path, Grid.DRAW_STYLE_ADD, 12, 120)
+            serial = list(_render_serial(replay_frames(path, 25), 2, BG))
+            parallel = list(_render_parallel(replay_frames(path, 25), 2, BG, 2))
+            self.assertEqual([played for played, _ in serial], [25, 50, 75, 100, 120])
+            self.assertEqual(parallel, serial)
+
+            # GIFs are written frame by frame with the standard library writer
+            gif = os.path.join(folder, "replay.gif")
+            self.assertEqual(render_log(path, gif, every=25, scale=2, workers=2), 120)
+            with open(gif, "rb") as f:
+                data = f.read()
+            self.assertEqual(data[:10], b"GIF89a" + struct.pack("<HH", 24, 24))
+            self.assertEqual(data[-1:], b"\x3B")
+
+    def states(self, grid):
+        return [(grid.peek(x, y).snapshot(), grid.peek(x, y).mask) for x in range(grid.x) for y in range(grid.y)]
+
+    def shared_states(self, reader):
+        return [(reader.snapshot(x, y), reader.mask(x, y)) for x in range(reader.x) for y in range(reader.y)]
@@ -1,10 +1,14 @@
+import os
+import tempfile
 import unittest
 from ed_utils.decorators import number
 
 from action import PaintAction, PaintStep
 from replay import ReplayTracker
+from replay_log import ReplayLogReader, ReplayLogWriter, PAINT, UNDO, SPECIAL
 from layers import blue, green, red, invert
 from grid import Grid
+from benchmarks.suite import generate_log
 
 class TestReplay(unittest.TestCase):
 
@@ -102,6 +106,201 @@ class TestReplay(unittest.TestCase):
         self.assertGridEqual(grid, control_grid)
         self.assertEqual(replay.play_next_action(grid), True) # Finished.
 
+    @number("5.4")
+    def test_seek(self):
+        grid = Grid(Grid.DRAW_STYLE_ADD, 10, 10)
+        control_grid = Grid(Grid.DRAW_STYLE_ADD, 10, 10)
+        layers = [green, red, blue, invert]
+
+        replay = ReplayTracker()
+        actions = []
+        for i in range(2 * ReplayTracker.KEYFRAME_INTERVAL + 7):
+            action = PaintAction([PaintStep((i % 10, (i // 10) % 10), layers[i % 4])])
+            if i % 50 == 49:
+                action = PaintAction([], is_special=True)
+            action.redo_apply(grid)
+            replay.add_action(action, grid=grid)
+            actions.append(action)
+        self.assertEqual(len(replay.keyframes), 3)
+
+        for index in [150, 3, len(actions), 0, 120]:
+            replay.seek(grid, index)
+            control_grid.clear()
+            for action in actions[:index]:
+                action.redo_apply(control_grid)
+            self.assertGridEqual(grid, control_grid)
+            self.assertEqual(replay.position, index)
+
+        # Playing continues from the seek position.
+        replay.play_next_action(grid)
+        actions[120].redo_apply(control_grid)
+        self.assertGridEqual(grid, control_grid)
+
+    @number("5.5")
+    def test_play_next_actions(self):
+        grid = Grid(Grid.DRAW_STYLE_SEQUENCE, 10, 10)
+        control_grid = Grid(Grid.DRAW_STYLE_SEQUENCE, 10, 10)
+
+        replay = ReplayTracker()
+        actions = [PaintAction([PaintStep((i, i), layer)]) for i, layer in enumerate([green, red, blue, invert, red])]
+        for action in actions:
+            replay.add_action(action)
+        replay.start_replay()
+
+        self.assertEqual(replay.play_next_actions(grid, 3), False)
+        for action in actions[:3]:
+            action.redo_apply(control_grid)
+        self.assertGridEqual(grid, control_grid)
+
+        self.assertEqual(replay.play_next_actions(grid, 10), True)
+        for action in actions[3:]:
+            action.redo_apply(control_grid)
+        self.assertGridEqual(grid, control_grid)
+
+    @number("5.6")
+    def test_log_round_trip(self):
+        control_grid = Grid(Grid.DRAW_STYLE_SEQUENCE, 300, 10)
+        actions = [
+            (PAINT, PaintAction([PaintStep((4, 4), green), PaintStep((299, 5), red), PaintStep((200, 9), blue)])),
+            (PAINT, PaintAction([PaintStep((5, 5), red), PaintStep((4, 4), invert)])),
+            (SPECIAL, PaintAction([], is_special=True)),
+            (UNDO, PaintAction([], is_special=True)),
+            (UNDO, PaintAction([PaintStep((5, 5), red), PaintStep((4, 4), invert)])),
+        ]
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            log = ReplayLogWriter(path, Grid.DRAW_STYLE_SEQUENCE, 300, 10)
+            for kind, action in actions:
+                log.write(kind, action)
+                if kind == UNDO:
+                    action.undo_apply(control_grid)
+                else:
+                    action.redo_apply(control_grid)
+            log.close()
+
+            reader = ReplayLogReader(path)
+            self.assertEqual((reader.x, reader.y, reader.draw_style), (300, 10, Grid.DRAW_STYLE_SEQUENCE))
+            decoded = list(reader)
+            self.assertEqual([is_undo for _, is_undo in decoded], [False, False, False, True, True])
+            self.assertEqual(decoded[0][0].steps, actions[0][1].steps)
+
+            grid = reader.make_grid()
+            replay = ReplayTracker()
+            replay.add_source(reader)
+            self.assertEqual(replay.play_next_actions(grid, 10), True)
+            self.assertGridEqual(grid, control_grid)
+        finally:
+            os.remove(path)
+
+    @number("5.7")
+    def test_state_hash(self):
+        for style in Grid.DRAW_STYLE_OPTIONS:
+            grid = Grid(style, 10, 10)
+            recorded = Grid(style, 10, 10)
+            self.assertEqual(grid.state_hash(), recorded.state_hash())
+
+            replay = ReplayTracker()
+            actions = [
+                PaintAction([PaintStep((4, 4), green), PaintStep((4, 5), green)]),
+                PaintAction([PaintStep((4, 4), red), PaintStep((5, 5), blue)]),
+                PaintAction([], is_special=True),
+                PaintAction([PaintStep((4, 4), invert)]),
+            ]
+            for action in actions:
+                action.redo_apply(recorded)
+                replay.add_action(action, grid=recorded)
+            replay.add_action(actions[-1], True, None)
+            actions[-1].undo_apply(recorded)
+
+            replay.start_replay()
+            while not replay.play_next_action(grid):
+                self.assertTrue(replay.matches_recording(grid))
+            self.assertEqual(grid.state_hash(), recorded.state_hash())
+            self.assertGridEqual(grid, recorded)
+
+            grid[0][0].add(blue)
+            self.assertNotEqual(grid.state_hash(), recorded.state_hash())
+            grid[0][0].erase(blue)
+            self.assertEqual(grid.state_hash(), recorded.state_hash())
+
+    @number("5.8")
+    def test_state_hash_order(self):
+        # Additive squares depend on the order of their layers, sequence squares don't.
+        add1, add2 = Grid(Grid.DRAW_STYLE_ADD, 3, 3), Grid(Grid.DRAW_STYLE_ADD, 3, 3)
+        seq1, seq2 = Grid(Grid.DRAW_STYLE_SEQUENCE, 3, 3), Grid(Grid.DRAW_STYLE_SEQUENCE, 3, 3)
+        for grid, layers in [(add1, [red, blue, green]), (add2, [green, blue, red]), (seq1, [red, blue]), (seq2, [blue, red])]:
+            for layer in layers:
+                grid[1][1].add(layer)
+        self.assertNotEqual(add1.state_hash(), add2.state_hash())
+        self.assertEqual(seq1.state_hash(), seq2.state_hash())
+        add2.special()
+        self.assertEqual(add1.state_hash(), add2.state_hash())
+        add1.restore(add1.snapshot())
+        self.assertEqual(add1.state_hash(), add2.state_hash())
+
+    @number("5.9")
+    def test_seek_streamed(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "session.sprl")
+            generate_log(path, Grid.DRAW_STYLE_SET, 16, 100)
+            control_grid = ReplayLogReader(path).make_grid()
+            control = ReplayTracker()
+            control.add_source(ReplayLogReader(path))
+            self.assertTrue(control.play_next_actions(control_grid, 200))
+
+            grid = ReplayLogReader(path).make_grid()
+            replay = ReplayTracker()
+            replay.add_source(ReplayLogReader(path))
+            self.assertFalse(replay.seekable)
+            replay.play_next_actions(grid, 40)
+            before = grid.state_hash()
+            # Seeking a streamed replay leaves it alone, rather than playing the rest of the log over a blank grid
+            replay.seek(grid, 0)
+            self.assertEqual(grid.state_hash(), before)
+            self.assertTrue(replay.play_next_actions(grid, 200))
+            self.assertTrue(replay.seekable)
+            self.assertEqual(grid.state_hash(), control_grid.state_hash())
+
+    @number("5.10")
+    def test_play_all_streamed(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "session.sprl")
+            generate_log(path, Grid.DRAW_STYLE_ADD, 16, 150)
+            control_grid = ReplayLogReader(path).make_grid()
+            control = ReplayTracker()
+            control.add_source(ReplayLogReader(path))
+            while not control.play_next_action(control_grid):
+                pass
+
+            # Playing everything left at once reads the whole stream, not just the actions in memory
+            grid = ReplayLogReader(path).make_grid()
+            replay = ReplayTracker()
+            replay.add_source(ReplayLogReader(path))
+            self.assertTrue(replay.play_next_actions(grid, None))
+            self.assertEqual(grid.state_hash(), control_grid.state_hash())
+            self.assertNotEqual(grid.state_hash(), 0)
+            self.assertIsNone(replay.source)
+
+    @number("5.11")
+    def test_incremental_keyframes(self):
+        grid = Grid(Grid.DRAW_STYLE_SET, 100, 100, tiled=True)
+        replay = ReplayTracker()
+        replay.add_action(grid.stroke([(10, 10), (70, 70), (99, 40)], 3, blue), grid=grid)
+        layers = [green, red, invert]
+        for i in range(2 * ReplayTracker.KEYFRAME_INTERVAL - 1): # All in tile (0, 0)
+            replay.add_action(grid.stroke([(i % 20, i // 20)], 1, layers[i % 3]), grid=grid)
+        first, second = dict(replay.keyframes[1]), dict(replay.keyframes[2])
+        self.assertEqual(set(first), set(grid.tiles))
+        # Only the changed tile is copied again; the others share their states with the keyframe before
+        self.assertIsNot(first[(0, 0)], second[(0, 0)])
+        for key in set(first) - {(0, 0)}:
+            self.assertIs(first[key], second[key])
+
+        for index in [150, 100, 200, 37]:
+            replay.seek(grid, index)
+            self.assertEqual(grid.state_hash(), replay.hashes[index - 1])
+
     def assertGridEqual(self, grid1: Grid, grid2: Grid):
         for x in range(len(grid1.grid)):
             for y in range(len(grid1[x])):
@@ -112,4 +311,3 @@ class TestReplay(unittest.TestCase):
                     sq2.get_color((0, 0, 0), 0, x, y),
                     "Grid not the same after apply has been made."
                 )
-
@@ -3,7 +3,7 @@ from ed_utils.decorators import number
 
 from action import PaintAction, PaintStep
 from undo import UndoTracker
-from layers import green, red, blue
+from layers import green, red, blue, invert
 from grid import Grid
 
 class TestUndo(unittest.TestCase):
@@ -65,6 +65,155 @@ class TestUndo(unittest.TestCase):
         action = undo.undo(grid)
         self.assertEqual(action, None)
 
+    @number("4.2")
+    def test_undo_special(self):
+        for style in Grid.DRAW_STYLE_OPTIONS:
+            grid = Grid(style, 6, 6)
+            control_grid = Grid(style, 6, 6)
+            steps = [PaintStep((x, y), layer) for x, y, layer in [
+                (1, 1, green), (1, 1, red), (1, 1, blue), (2, 3, invert), (2, 3, red), (5, 5, blue),
+            ]]
+            for step in steps:
+                step.redo_apply(grid)
+                step.redo_apply(control_grid)
+
+            undo = UndoTracker()
+            for _ in range(2):
+                action = PaintAction([], is_special=True)
+                action.redo_apply(grid)
+                undo.add_action(action)
+            undo.undo(grid)
+            undo.undo(grid)
+            self.assertGridEqual(grid, control_grid)
+
+            # Redo replays exactly what the specials did the first time.
+            undo.redo(grid)
+            undo.redo(grid)
+            control_grid.special()
+            control_grid.special()
+            self.assertGridEqual(grid, control_grid)
+
+    @number("4.3")
+    def test_long_history(self):
+        grid = Grid(Grid.DRAW_STYLE_ADD, 10, 10)
+        control_grid = Grid(Grid.DRAW_STYLE_ADD, 10, 10)
+        layers = [green, red, blue, invert]
+
+        undo = UndoTracker()
+        n = UndoTracker.HOT_ACTIONS + 200
+        for i in range(n):
+            action = PaintAction([PaintStep((i % 10, (i // 10) % 10), layers[i % 4])])
+            if i % 37 == 0:
+                action = PaintAction([], is_special=True)
+            action.redo_apply(grid)
+            undo.add_action(action)
+        self.assertEqual(len(undo), n)
+        self.assertNotEqual(undo.root.children[0].packed, None, "Old actions should be packed")
+
+        # Undo everything, including the compressed actions.
+        for _ in range(n):
+            self.assertNotEqual(undo.undo(grid), None)
+        self.assertEqual(undo.undo(grid), None)
+        self.assertGridEqual(grid, control_grid)
+
+    @number("4.4")
+    def test_byte_budget(self):
+        grid = Grid(Grid.DRAW_STYLE_SET, 10, 10)
+        undo = UndoTracker()
+        undo.MAX_BYTES = 20 * undo.action_size(PaintAction([PaintStep((0, 0), green)]))
+        for i in range(100):
+            action = PaintAction([PaintStep((i % 10, i // 10), green)])
+            action.redo_apply(grid)
+            undo.add_action(action)
+        self.assertLessEqual(undo.size, undo.MAX_BYTES)
+        # The newest actions are kept, not dropped.
+        self.assertEqual(undo.undo(grid).steps, [PaintStep((9, 9), green)])
+
+    @number("4.5")
+    def test_branches(self):
+        grid = Grid(Grid.DRAW_STYLE_SEQUENCE, 5, 5)
+        undo = UndoTracker()
+
+        def paint(*steps):
+            action = PaintAction(list(steps))
+            action.redo_apply(grid)
+            undo.add_action(action)
+
+        paint(PaintStep((0, 0), green))
+        paint(PaintStep((1, 1), red))
+        first_tip = undo.current
+        undo.undo(grid)
+        # Painting after an undo starts a new branch rather than discarding (1, 1).
+        paint(PaintStep((2, 2), blue))
+        paint(PaintStep((3, 3), invert))
+        second_tip = undo.current
+        self.assertEqual(len(undo.leaves()), 2)
+
+        applied = undo.jump_to(grid, first_tip)
+        self.assertEqual([is_undo for _, is_undo in applied], [True, True, False])
+        control_grid = Grid(Grid.DRAW_STYLE_SEQUENCE, 5, 5)
+        control_grid[0][0].add(green)
+        control_grid[1][1].add(red)
+        self.assertGridEqual(grid, control_grid)
+
+        undo.switch_branch(grid)
+        self.assertIs(undo.current, second_tip)
+        control_grid[1][1].erase(red)
+        control_grid[2][2].add(blue)
+        control_grid[3][3].add(invert)
+        self.assertGridEqual(grid, control_grid)
+
+        # Redo follows the branch we came down.
+        undo.undo(grid)
+        undo.undo(grid)
+        undo.redo(grid)
+        self.assertIs(undo.current, second_tip.parent)
+
+    @number("4.6")
+    def test_unpack(self):
+        grid = Grid(Grid.DRAW_STYLE_ADD, 10, 10)
+        undo = UndoTracker()
+        undo.HOT_ACTIONS = 4
+        for i in range(10):
+            action = PaintAction([PaintStep((i, i), green), PaintStep((i, 0), red)])
+            action.redo_apply(grid)
+            undo.add_action(action)
+        nodes = [undo.root.children[0]]
+        while nodes[-1].children:
+            nodes.append(nodes[-1].children[0])
+        self.assertEqual([node.packed is not None for node in nodes], [True] * 6 + [False] * 4)
+
+        # Undoing reaches packed nodes, which are unpacked and stay decoded while they are among the newest used
+        undone = [undo.undo(grid) for _ in range(7)]
+        self.assertEqual([node.packed is not None for node in nodes], [True] * 3 + [False] * 3 + [True] * 3 + [False])
+        self.assertIs(undo.undo(grid), nodes[2].action)
+        self.assertIs(undo.redo(grid), nodes[2].action)
+        redone = [undo.redo(grid) for _ in range(2)]
+        self.assertIs(redone[0], undone[-1])
+        self.assertIs(redone[1], undone[-2])
+        self.assertEqual(undo.size, sum(node.size for node in nodes))
+
+    @number("4.7")
+    def test_jump_to_evicted(self):
+        grid = Grid(Grid.DRAW_STYLE_SET, 10, 10)
+        undo = UndoTracker()
+        undo.MAX_BYTES = 10 * undo.action_size(PaintAction([PaintStep((0, 0), green)]))
+        action = PaintAction([PaintStep((0, 0), green)])
+        action.redo_apply(grid)
+        undo.add_action(action)
+        first = undo.current
+        for i in range(1, 50):
+            action = PaintAction([PaintStep((i % 10, i // 10), red)])
+            action.redo_apply(grid)
+            undo.add_action(action)
+        self.assertTrue(first.evicted)
+
+        # Jumping to a dropped node is refused before anything is undone
+        current, state = undo.current, grid.state_hash()
+        self.assertRaises(ValueError, undo.jump_to, grid, first)
+        self.assertEqual((undo.current, grid.state_hash()), (current, state))
+        self.assertEqual(undo.jump_to(grid, undo.current), [])
+
     def assertGridEqual(self, grid1: Grid, grid2: Grid):
         for x in range(len(grid1.grid)):
             for y in range(len(grid1[x])):
@@ -1,9 +1,15 @@
+import os
+import tempfile
 import unittest
 from ed_utils.decorators import number
 
 from layers import green, red, blue
 from grid import Grid
 from main import MyWindow
+from benchmarks.suite import generate_log
+from replay import ReplayTracker
+from replay_log import ReplayLogReader
+from tile_render import TileRenderPipeline
 
 class FakeWindow:
     def __init__(self, grid: Grid):
@@ -14,6 +20,12 @@ FakeWindow.on_reset = MyWindow.on_reset
 FakeWindow.on_paint = MyWindow.on_paint
 FakeWindow.on_increase_brush_size = MyWindow.on_increase_brush_size
 FakeWindow.on_decrease_brush_size = MyWindow.on_decrease_brush_size
+FakeWindow.on_update = MyWindow.on_update
+FakeWindow.update_tile_shapes = MyWindow.update_tile_shapes
+FakeWindow.on_replay_next_step = MyWindow.on_replay_next_step
+FakeWindow.on_replay_next_steps = MyWindow.on_replay_next_steps
+for name in ["BG", "REPLAY_SPEEDS", "REPLAY_TIMER_DELTA", "MAX_REPLAY_STEPS_PER_UPDATE", "square_width", "square_height", "to_square", "visible_rect", "lod_step", "set_view", "MAX_SQUARE_PIXELS", "MIN_SQUARE_PIXELS"]:
+    setattr(FakeWindow, name, getattr(MyWindow, name))
 
 class TestGrid(unittest.TestCase):
 
@@ -83,6 +95,77 @@ class TestGrid(unittest.TestCase):
 
         self.assertGridEqual(grid, control_grid)
 
+    @number("6.3")
+    def test_view_transform(self):
+        fw = FakeWindow(Grid(Grid.DRAW_STYLE_SET, 1024, 1024))
+        fw.GRID_SIZE_X = fw.GRID_SIZE_Y = 1024
+        fw.DRAW_PANEL = fw.SCREEN_HEIGHT = 512
+        fw.GRID_SQ_WIDTH = fw.GRID_SQ_HEIGHT = 0.5
+        fw.set_view(1, 0, 0)
+        # The whole grid fits: every square is visible, merged into 8x8 blocks of 4 pixels
+        self.assertEqual(fw.visible_rect(), (0, 0, 1024, 1024))
+        self.assertEqual(fw.lod_step(), 8)
+        self.assertEqual(fw.to_square(511, 1), (1022, 2))
+
+        fw.set_view(16, 100, 200)
+        self.assertEqual(fw.visible_rect(), (100, 200, 164, 264))
+        self.assertEqual(fw.lod_step(), 1)
+        self.assertEqual(fw.to_square(9, 12), (101, 201))
+
+        # The view stays on the grid and the zoom within limits
+        fw.set_view(1000, 5000, -10)
+        self.assertEqual(fw.zoom, 128)
+        self.assertEqual((fw.view_x, fw.view_y), (1016, 0))
+
+    @number("6.4")
+    def test_replay_end_speed(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "session.sprl")
+            generate_log(path, Grid.DRAW_STYLE_SET, 16, 120)
+            control = ReplayTracker()
+            control.add_source(ReplayLogReader(path))
+            control_grid = ReplayLogReader(path).make_grid()
+            control.play_next_actions(control_grid, None)
+
+            # At the "end" speed, one update plays the whole log, though none of it is in memory yet
+            fw = FakeWindow(ReplayLogReader(path).make_grid())
+            fw.timestamp = 0
+            fw.z_pressed = fw.y_pressed = fw.enable_ui = False
+            fw.replay_speed_index = fw.REPLAY_SPEEDS.index(None)
+            fw.replay_tracker = ReplayTracker()
+            fw.replay_tracker.add_source(ReplayLogReader(path))
+            fw.on_update(1 / 60)
+            self.assertTrue(fw.enable_ui)
+            self.assertEqual(fw.grid.state_hash(), control_grid.state_hash())
+
+    @number("6.5")
+    def test_pipeline_dirty_tiles(self):
+        fw = FakeWindow(Grid(Grid.DRAW_STYLE_SET, 256, 256))
+        fw.on_init()
+        fw.timestamp = 0
+        fw.tile_grid = None
+        built = {}
+        def build_tile_shape(tile, step, colors=None): # Stands in for the arcade shapes
+            built[(tile.x0 // Grid.TILE_SIZE, tile.y0 // Grid.TILE_SIZE)] = colors
+            return "shapes", 0
+        fw.build_tile_shape = build_tile_shape
+        fw.render_pipeline = TileRenderPipeline(2)
+        try:
+            # Painting the same tile every frame: once its first colours arrive, it is drawn every frame
+            for frame in range(6):
+                fw.on_paint((red, blue)[frame % 2], 1, 1)
+                visible = fw.update_tile_shapes(0, 0, 64, 64, 1)
+                self.assertEqual(visible, [(0, 0)])
+                self.assertEqual((0, 0) in fw.tile_shapes, frame > 0)
+            self.assertNotEqual(fw.tile_shapes[(0, 0)][2], fw.render_pipeline.generations[(0, 0)])
+            # Once painting stops, the colours catch up with the last change
+            for _ in range(2):
+                fw.update_tile_shapes(0, 0, 64, 64, 1)
+        finally:
+            fw.render_pipeline.close()
+        self.assertEqual(fw.tile_shapes[(0, 0)][2], fw.render_pipeline.generations[(0, 0)])
+        self.assertEqual(built[(0, 0)][0], fw.grid.peek(0, 0).get_color(fw.BG, 0, 0, 0))
+
     def assertGridEqual(self, grid1: Grid, grid2: Grid):
         for x in range(len(grid1.grid)):
             for y in range(len(grid1[x])):
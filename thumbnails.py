@@ -0,0 +1,165 @@
+"""
+Gallery thumbnails for many saved canvases.
+
+Each canvas saved with Grid.save is rendered once at a fixed timestamp, one pixel per square,
+and box filtered down by halves into mip levels, each written as a PNG.
+Canvases are processed on a process pool.
+
+Results are cached in a directory, one folder per key. The key is the grid's content hash
+(Grid.state_hash) with its size, draw style and the render settings, so a canvas that hasn't changed
+is never rendered again, even if it was copied or saved again. The cache index also remembers
+each file's size and modification time, so unchanged files aren't even loaded.
+
+Usage:
+    python thumbnails.py gallery/*.spgf --cache thumbs
+    python thumbnails.py gallery/*.spgf --cache thumbs --timestamp 5 --min-size 4 -j 0
+"""
+from __future__ import annotations
+import argparse
+import hashlib
+import json
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from grid import Grid
+from image_io import write_png
+
+BG = (255, 255, 255)
+INDEX = "index.json"
+
+def mip_levels(pixels, min_size: int=1) -> list:
+    """
+    Returns [pixels, half size, quarter size, ...] for an (H, W, 3) uint8 array, each level averaging
+    2x2 blocks of the one before, down to 1x1 or until either side would go below `min_size`.
+    Odd sides repeat their last row or column, so every square still counts.
+
+    Complexity: O(HW)
+    """
+    import numpy as np
+
+    levels = [pixels]
+    while max(pixels.shape[:2]) > 1 and min(-(-pixels.shape[0] // 2), -(-pixels.shape[1] // 2)) >= min_size:
+        if pixels.shape[0] % 2 or pixels.shape[1] % 2:
+            pixels = np.pad(pixels, ((0, pixels.shape[0] % 2), (0, pixels.shape[1] % 2), (0, 0)), mode="edge")
+        height, width = pixels.shape[0] // 2, pixels.shape[1] // 2
+        blocks = pixels.reshape(height, 2, width, 2, 3).astype(np.uint16).sum(axis=(1, 3))
+        pixels = ((blocks + 2) // 4).astype(np.uint8) # Rounded mean
+        levels.append(pixels)
+    return levels
+
+def cache_key(grid: Grid, timestamp: float, bg: tuple[int, int, int], min_size: int) -> str:
+    """
+    Returns the cache key of a grid's thumbnails: its content hash, size and draw style, and the render settings.
+
+    Complexity: O(1)
+    """
+    settings = (grid.state_hash(), grid.x, grid.y, grid.draw_style, float(timestamp), tuple(bg), min_size)
+    return hashlib.sha1(repr(settings).encode()).hexdigest()
+
+def level_paths(cache: str, key: str) -> list[str]:
+    """
+    Returns the paths of the mip levels cached under `key`, largest first, or [] if there are none.
+
+    Complexity: O(levels)
+    """
+    folder = os.path.join(cache, key)
+    if not os.path.isdir(folder):
+        return []
+    return [os.path.join(folder, name) for name in sorted(os.listdir(folder)) if name.endswith(".png")]
+
+def thumbnail(path: str, cache: str, timestamp: float=0, bg: tuple[int, int, int]=BG, min_size: int=1) -> tuple[str, bool]:
+    """
+    Makes sure the mip levels of the canvas at `path` are cached. Returns (key, whether it was rendered).
+    Worker task: several processes can fill the same cache at once.
+
+    Complexity: O(Grid.load), plus O(Grid.to_array) if rendered
+    """
+    grid = Grid.load(path)
+    key = cache_key(grid, timestamp, bg, min_size)
+    if level_paths(cache, key):
+        return key, False
+    folder = os.path.join(cache, key)
+    partial = f"{folder}.{os.getpid()}.tmp"
+    os.makedirs(partial, exist_ok=True)
+    for i, pixels in enumerate(mip_levels(grid.to_array(timestamp, bg), min_size)):
+        write_png(os.path.join(partial, f"mip_{i:02d}.png"), pixels.shape[1], pixels.shape[0], pixels.tobytes())
+    try:
+        os.rename(partial, folder) # Only complete folders appear in the cache
+    except OSError: # Another worker got there first
+        shutil.rmtree(partial)
+    return key, True
+
+def _file_stamp(path: str) -> list[int]:
+    """ What the index compares to tell a file hasn't changed: its size and modification time. """
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+def build_thumbnails(
+    paths: list[str], cache: str, timestamp: float=0, bg: tuple[int, int, int]=BG,
+    min_size: int=1, workers: int=1, errors: dict[str, str]|None=None,
+) -> dict[str, list[str]]:
+    """
+    Caches the mip levels of every canvas in `paths`, rendering only canvases whose content isn't cached yet,
+    and returns the paths of each canvas's levels, largest first.
+    A canvas which can't be read or rendered gets no levels and isn't indexed, and the rest are still made.
+    Its error is put in `errors`, if given, by path.
+
+    Complexity: O(c * Grid.load + r * Grid.to_array) / workers
+    c: The number of canvases whose file changed since the last run
+    r: The number of those whose content isn't cached
+    """
+    os.makedirs(cache, exist_ok=True)
+    index_path = os.path.join(cache, INDEX)
+    index = {}
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            index = json.load(f)
+    settings = [float(timestamp), list(bg), min_size]
+
+    keys = {}
+    stale = []
+    for path in paths:
+        entry = index.get(os.path.abspath(path))
+        if entry and entry["stamp"] == _file_stamp(path) and entry["settings"] == settings and level_paths(cache, entry["key"]):
+            keys[path] = entry["key"]
+        else:
+            stale.append(path)
+    if stale:
+        with ProcessPoolExecutor(workers) as pool:
+            futures = [(path, pool.submit(thumbnail, path, cache, timestamp, bg, min_size)) for path in stale]
+            for path, future in futures:
+                try:
+                    keys[path] = future.result()[0]
+                    stamp = _file_stamp(path)
+                except Exception as e: # A missing, unreadable or corrupt canvas
+                    index.pop(os.path.abspath(path), None)
+                    if errors is not None:
+                        errors[path] = f"{type(e).__name__}: {e}"
+                    continue
+                index[os.path.abspath(path)] = {"stamp": stamp, "settings": settings, "key": keys[path]}
+        with open(index_path, "w") as f:
+            json.dump(index, f)
+    return {path: level_paths(cache, keys[path]) if path in keys else [] for path in paths}
+
+def main() -> None:
+    p = argparse.ArgumentParser(description="Make mipmapped thumbnails of saved canvases.")
+    p.add_argument("canvases", nargs="+", help="Canvases saved with Grid.save.")
+    p.add_argument("--cache", default="thumbnails", help="Folder the thumbnails are cached in.")
+    p.add_argument("--timestamp", type=float, default=0, help="Timestamp animated layers are drawn at.")
+    p.add_argument("--bg", type=int, nargs=3, default=BG, metavar=("R", "G", "B"), help="Background colour.")
+    p.add_argument("--min-size", type=int, default=1, help="Smallest side of the last mip level.")
+    p.add_argument("-j", "--workers", type=int, default=1, help="Processes to render on (0 for one per core).")
+    args = p.parse_args()
+
+    errors = {}
+    levels = build_thumbnails(
+        args.canvases, args.cache, args.timestamp, tuple(args.bg), args.min_size, args.workers or os.cpu_count(), errors,
+    )
+    for path, files in levels.items():
+        if files:
+            print(f"{path}: {files[0]} (+{len(files) - 1} smaller)")
+        else:
+            print(f"{path}: failed ({errors.get(path, 'no levels')})")
+
+if __name__ == "__main__":
+    main()
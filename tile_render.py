@@ -0,0 +1,215 @@
+"""
+Parallel colour evaluation for tiled grids.
+
+Evaluating get_color for a large canvas is CPU-bound Python, and animated layers
+have to be evaluated again every frame. TileRenderPipeline moves that work to a process pool:
+
+- The states of the tiles to draw are encoded (with replay_log.encode_state) into a
+  shared memory block. Encodings are cached per tile and only redone for tiles which changed.
+- Workers attach to the block, restore each square's state into a scratch store,
+  evaluate its colour and write RGB bytes into a shared output block.
+- There are two output blocks. While workers fill one with frame N+1,
+  the results of frame N are read from the other, so the window never waits on
+  a frame it hasn't drawn yet.
+"""
+from __future__ import annotations
+import io
+import os
+from concurrent.futures import Future, ProcessPoolExecutor
+from multiprocessing import shared_memory
+from grid import Grid, Tile
+from replay_log import ByteReader, decode_state, encode_state
+
+BG = (255, 255, 255)
+
+def encode_tile(tile: Tile) -> bytes:
+    """
+    Returns the states of every square of a tile, column by column, encoded one after another.
+
+    Complexity: O(t^2 * snapshot)
+    t: Grid.TILE_SIZE
+    """
+    data = bytearray()
+    for i in range(len(tile.stores)):
+        encode_state(tile.stores[i].snapshot(), data)
+    return bytes(data)
+
+def _evaluate_tiles(
+    input_name: str, output_name: str, draw_style: str,
+    jobs: list[tuple], timestamp: float, bg: tuple[int, int, int],
+) -> list[tuple[tuple[int, int], int]]:
+    """
+    Worker task. Each job is (tile key, offset, length, slot, x0, y0, width, height, step):
+    the tile's encoded states are at input[offset:offset + length], and the colours of
+    every step-th square along each axis are written as RGB to output[slot:].
+
+    Returns (tile key, mask of the layers used in the tile) for each job.
+    """
+    source = shared_memory.SharedMemory(name=input_name)
+    target = shared_memory.SharedMemory(name=output_name)
+    try:
+        store = Grid(draw_style, 1, 1, tiled=False).layer_store_type() # Scratch store, not part of any grid
+        masks = []
+        for key, offset, length, slot, x0, y0, width, height, step in jobs:
+            reader = ByteReader(io.BytesIO(source.buf[offset:offset + length]))
+            mask = 0
+            pos = slot
+            for i in range(width):
+                for j in range(height):
+                    store.restore(decode_state(reader))
+                    mask |= store.mask
+                    if i % step or j % step:
+                        continue
+                    target.buf[pos:pos + 3] = bytes(store.get_color(bg, timestamp, x0 + i, y0 + j))
+                    pos += 3
+            masks.append((key, mask))
+        return masks
+    finally:
+        source.close()
+        target.close()
+
+
+class TileRenderPipeline:
+    """
+    Evaluates tile colours on a process pool, one frame ahead of the caller.
+
+    Each call to `next_frame` starts evaluating a set of tiles and returns the
+    results of the previous call, so the pool works on frame N+1 while frame N is drawn.
+    Each result is tagged with the tile's generation when it was submitted, which `invalidate` moves on,
+    so the caller can tell results older than the tile from fresh ones.
+    """
+
+    def __init__(self, workers: int=0) -> None:
+        """
+        Starts a pool of `workers` processes (0 for one per core).
+
+        Complexity: O(workers)
+        """
+        self.workers = workers or os.cpu_count()
+        self.pool = ProcessPoolExecutor(self.workers)
+        self.outputs: list[shared_memory.SharedMemory|None] = [None, None]
+        self.current = 0 # The output block the next frame is written to
+        self.grid: Grid|None = None
+        self.encoded: dict[tuple[int, int], bytes] = {} # Tile key -> encode_tile, for self.grid
+        self.generations: dict[tuple[int, int], int] = {} # Tile key -> times invalidated, for self.grid
+        # The frame being evaluated: (futures, input block, output block index, layout, tile generations), or None
+        self.pending: tuple[list[Future], shared_memory.SharedMemory, int, list[tuple], dict]|None = None
+
+    def invalidate(self, tiles) -> None:
+        """
+        Forgets the cached encodings of tiles which changed, e.g. from Grid.take_dirty_tiles,
+        and moves on their generations.
+
+        Complexity: O(len(tiles))
+        """
+        for key in tiles:
+            self.encoded.pop(key, None)
+            self.generations[key] = self.generations.get(key, 0) + 1
+
+    def _output(self, index: int, size: int) -> shared_memory.SharedMemory:
+        """ Returns output block `index`, replacing it first if it's smaller than `size` bytes. """
+        block = self.outputs[index]
+        if block is None or block.size < size:
+            if block is not None:
+                block.close()
+                block.unlink()
+            block = self.outputs[index] = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        return block
+
+    def submit(self, grid: Grid, tiles, timestamp: float, step: int=1, bg: tuple[int, int, int]=BG) -> None:
+        """
+        Starts evaluating the colours of the given tiles of a tiled grid at `timestamp`,
+        for every step-th square along each axis. Tiles which aren't allocated are skipped.
+
+        Complexity: O(k) plus O(t^2 * snapshot) for each tile not encoded yet
+        k: the encoded size of the tiles
+        """
+        if grid is not self.grid:
+            self.grid = grid
+            self.encoded = {}
+            self.generations = {}
+        layout = []
+        data = []
+        offset = slot = 0
+        for key in tiles:
+            tile = grid.tiles.get(key)
+            if tile is None:
+                continue
+            encoded = self.encoded.get(key)
+            if encoded is None:
+                encoded = self.encoded[key] = encode_tile(tile)
+            squares = -(-tile.width // step) * -(-tile.height // step)
+            layout.append((key, offset, len(encoded), slot, tile.x0, tile.y0, tile.width, tile.height, step))
+            data.append(encoded)
+            offset += len(encoded)
+            slot += squares * 3
+
+        source = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+        source.buf[:offset] = b"".join(data)
+        target = self._output(self.current, slot)
+        chunk = -(-len(layout) // self.workers) if layout else 1
+        futures = [
+            self.pool.submit(_evaluate_tiles, source.name, target.name, grid.draw_style, layout[i:i + chunk], timestamp, bg)
+            for i in range(0, len(layout), chunk)
+        ]
+        generations = {key: self.generations.get(key, 0) for key, *_ in layout}
+        self.pending = (futures, source, self.current, layout, generations)
+        self.current ^= 1
+
+    def collect(self) -> dict[tuple[int, int], tuple[int, int, bytes]]:
+        """
+        Waits for the frame started by the last `submit`, and returns
+        tile key -> (step, mask of layers used, RGB bytes column by column, generation when submitted) for each of its tiles.
+        Returns an empty dict if no frame is pending.
+
+        Complexity: O(evaluation time of the frame)
+        """
+        pending, self.pending = self.pending, None
+        return self._read(pending) if pending is not None else {}
+
+    def _read(self, pending: tuple) -> dict[tuple[int, int], tuple[int, int, bytes]]:
+        """ Waits for a submitted frame, frees its input block and returns its results as in `collect`. """
+        futures, source, index, layout, generations = pending
+        masks = {}
+        try:
+            for future in futures:
+                masks.update(future.result())
+        finally:
+            source.close()
+            source.unlink()
+        target = self.outputs[index]
+        frame = {}
+        for key, _, _, slot, _, _, width, height, step in layout:
+            size = -(-width // step) * -(-height // step) * 3
+            frame[key] = (step, masks[key], bytes(target.buf[slot:slot + size]), generations[key])
+        return frame
+
+    def next_frame(self, grid: Grid, tiles, timestamp: float, step: int=1, bg: tuple[int, int, int]=BG):
+        """
+        Starts evaluating the given tiles and returns the results of the previous call, as from `collect`.
+        The new frame is written to the other output block, so the workers evaluate it
+        while the previous one is read and drawn.
+
+        Complexity: O(submit + collect)
+        """
+        previous, self.pending = self.pending, None
+        if previous is not None:
+            for future in previous[0]: # Its output block must be complete before being read
+                future.result()
+        self.submit(grid, tiles, timestamp, step, bg)
+        return self._read(previous) if previous is not None else {}
+
+    def close(self) -> None:
+        """
+        Stops the pool and frees the shared memory.
+
+        Complexity: O(workers)
+        """
+        if self.pending is not None:
+            self.collect()
+        self.pool.shutdown()
+        for block in self.outputs:
+            if block is not None:
+                block.close()
+                block.unlink()
+        self.outputs = [None, None]
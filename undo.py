@@ -1,40 +1,256 @@
 from __future__ import annotations
-from action import PaintAction
+import io
+import zlib
+from collections import deque
+from action import BulkPaintStep, PaintAction, PasteStep
 from grid import Grid
-from data_structures.stack_adt import ArrayStack
+from profiler import profiler
+from replay_log import ByteReader, decode_action, encode_action
+
+class UndoNode:
+    """
+    A node of the undo tree. Each node holds the action which leads to it from its parent.
+    Nodes share actions by reference, so branching never copies them.
+
+    Old nodes are packed: their action is encoded (and zlib-compressed if that helps)
+    and only decoded again when undo or redo reaches them, which unpacks them until they are old again.
+    """
+
+    # Packed actions shorter than this aren't worth compressing.
+    COMPRESS_MIN_BYTES = 64
+
+    def __init__(self, action: PaintAction|None, parent: UndoNode|None, seq: int) -> None:
+        """
+        Complexity: O(1)
+        """
+        self.action = action
+        self.packed: bytes|None = None
+        self.compressed = False
+        self.parent = parent
+        self.children: list[UndoNode] = []
+        self.redo_child: UndoNode|None = None # The branch redo follows
+        self.depth = 0 if parent is None else parent.depth + 1
+        self.seq = seq
+        self.size = 0
+        self.evicted = False
+
+    def get_action(self) -> PaintAction:
+        """
+        Returns the node's action, decoding it if the node is packed. The node stays packed; see UndoTracker.action_of.
+
+        Complexity: O(s) if packed, O(1) otherwise
+        s: The number of steps in the action
+        """
+        if self.action is not None:
+            return self.action
+        data = zlib.decompress(self.packed) if self.compressed else self.packed
+        return decode_action(ByteReader(io.BytesIO(data)))
+
+    def pack(self) -> None:
+        """
+        Replaces the action with its encoding.
+
+        Complexity: O(s)
+        s: The number of steps in the action
+        """
+        data = bytearray()
+        encode_action(self.action, data)
+        data = bytes(data)
+        if len(data) >= self.COMPRESS_MIN_BYTES:
+            compressed = zlib.compress(data)
+            if len(compressed) < len(data):
+                data = compressed
+                self.compressed = True
+        self.packed = data
+        self.action = None
+
 
 class UndoTracker:
+    """
+    Branching undo history bounded by memory rather than by the number of actions.
+
+    Actions form a tree: adding an action after some undos starts a new branch
+    instead of discarding the undone ones, and `jump_to` / `switch_branch`
+    move between branches by undoing up to the common ancestor and redoing down the other side.
+
+    The HOT_ACTIONS nodes most recently added or unpacked keep their actions as objects, older ones are packed.
+    A packed node reached by undo or redo is unpacked back into them, so going back and forth decodes it once.
+    When the tree's estimated size goes over MAX_BYTES, the oldest history is dropped first:
+    branches off the root which don't lead to the current state, then the root itself.
+    """
+
+    MAX_BYTES = 64 * 1024 * 1024
+    HOT_ACTIONS = 256
 
-    MAX_ACTIONS = 10000
+    # Rough in-memory size of a node, of a PaintAction and of each of its steps, used for the budget.
+    NODE_BYTES = 250
+    ACTION_BYTES = 200
+    STEP_BYTES = 120
+    # Bulk steps store each square as two 4-byte coordinates.
+    BULK_SQUARE_BYTES = 8
 
     def __init__(self) -> None:
         """
         Instantiates instance variables:
 
-        self.tracker: an Array Stack with the size of MAX_ACTIONS
-        self.undone: an Array Stack with the size of MAX_ACTIONS
+        self.root: the node for the oldest state still reachable, which has no action
+        self.current: the node for the grid's current state
+        self.hot: nodes whose actions aren't packed, in the order they were added or unpacked
+        self.size: estimated bytes held by the whole tree
 
-        Complexity: O(n)
-        n: MAX_ACTIONS
+        Complexity: O(1)
         """
+        self.root = UndoNode(None, None, 0)
+        self.current = self.root
+        self.hot: deque[UndoNode] = deque()
+        self.next_seq = 1
+        self.size = 0
 
-        self.tracker = ArrayStack(self.MAX_ACTIONS)
-        self.undone = ArrayStack(self.MAX_ACTIONS)
+    def __len__(self) -> int:
+        """
+        The number of actions which can be undone from the current state.
 
-    def add_action(self, action: PaintAction) -> None:
+        Complexity: O(1)
         """
-        Adds an action to the undo tracker.
+        return self.current.depth - self.root.depth
 
-        If your collection is already full,
-        feel free to exit early and not add the action.
+    def clear(self) -> None:
+        """
+        Forgets every action.
 
         Complexity: O(1)
         """
-        if not self.tracker.is_full(): # If it's not full add a new action to the tracker
-            self.tracker.push(action)
-            self.undone.clear() # Clear undone so we can't redo actions after we undo then paint 
+        self.__init__()
+
+    def action_size(self, action: PaintAction) -> int:
+        """
+        Estimated bytes held by an action kept as an object.
+
+        Complexity: O(s)
+        s: The number of steps in the action
+        """
+        steps = len(action.steps) if action.steps else 0
+        squares = 0
+        for step in action.steps or ():
+            if isinstance(step, BulkPaintStep):
+                squares += len(step)
+            elif isinstance(step, PasteStep): # Two shared stores per square
+                steps += len(step) - 1
+        if action.special_steps is not None:
+            steps += len(action.special_steps)
+        return self.ACTION_BYTES + self.STEP_BYTES * steps + self.BULK_SQUARE_BYTES * squares
+
+    @profiler.timed("UndoTracker.add_action")
+    def add_action(self, action: PaintAction) -> None:
+        """
+        Adds an action to the undo tracker, as a new child of the current state.
+        Actions which were undone stay in the tree on their own branch.
+
+        If the history is over budget, the oldest actions are forgotten to make room.
+
+        Complexity: O(1) amortised, O(s) when a node is packed
+        s: The number of steps in the action being packed
+        """
+        node = UndoNode(action, self.current, self.next_seq)
+        self.next_seq += 1
+        node.size = self.NODE_BYTES + self.action_size(action)
+        self.size += node.size
+        self.current.children.append(node)
+        self.current.redo_child = node
+        self.current = node
+        self.hot.append(node)
+        self._compact()
         return None
 
+    def action_of(self, node: UndoNode) -> PaintAction:
+        """
+        Returns a node's action. A packed node is decoded and unpacked as the newest of the hot nodes,
+        so its action is the same object until it is packed again.
+
+        Complexity: O(1), O(s) to unpack the node and pack the oldest hot one
+        s: The number of steps in those actions
+        """
+        if node.action is not None:
+            return node.action
+        action = node.get_action()
+        node.action, node.packed, node.compressed = action, None, False
+        self.size -= node.size
+        node.size = self.NODE_BYTES + self.action_size(action)
+        self.size += node.size
+        self.hot.append(node)
+        self._pack_cold() # Not _compact: evicting could drop the node being undone
+        return action
+
+    def _compact(self) -> None:
+        """
+        Packs nodes beyond the newest HOT_ACTIONS, then drops the oldest history until the tree fits in MAX_BYTES.
+
+        Complexity: O(s) to pack a node, plus O(k) for k evicted nodes
+        """
+        self._pack_cold()
+        while self.size > self.MAX_BYTES and self.current is not self.root:
+            self._evict_oldest()
+
+    def _pack_cold(self) -> None:
+        """
+        Packs hot nodes beyond the newest HOT_ACTIONS.
+
+        Complexity: O(s) per node packed
+        s: The number of steps in its action
+        """
+        while len(self.hot) > self.HOT_ACTIONS:
+            node = self.hot.popleft()
+            if node.evicted or node.action is None: # Dropped, or promoted to root
+                continue
+            node.pack()
+            self.size -= node.size
+            node.size = self.NODE_BYTES + len(node.packed)
+            self.size += node.size
+
+    def _evict_oldest(self) -> None:
+        """
+        Drops the oldest branch off the root which doesn't lead to the current state.
+        If every other branch is gone, the root's child on the way to the current state becomes the new root.
+
+        Complexity: O(k)
+        k: The number of nodes dropped
+        """
+        keep = self.current
+        while keep.parent is not self.root:
+            keep = keep.parent
+        others = [child for child in self.root.children if child is not keep]
+        if others:
+            oldest = min(others, key=lambda child: child.seq)
+            self.root.children.remove(oldest)
+            if self.root.redo_child is oldest:
+                self.root.redo_child = keep
+            self._drop(oldest)
+            return
+        # Promote: the state before keep's action is no longer reachable.
+        self.size -= self.root.size + keep.size
+        self.root.evicted = True
+        keep.parent = None
+        keep.action = None
+        keep.packed = None
+        keep.size = self.NODE_BYTES
+        self.size += keep.size
+        self.root = keep
+
+    def _drop(self, node: UndoNode) -> None:
+        """
+        Removes a whole subtree from the size budget.
+
+        Complexity: O(k)
+        k: The number of nodes in the subtree
+        """
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            node.evicted = True
+            self.size -= node.size
+            stack.extend(node.children)
+
+    @profiler.timed("UndoTracker.undo")
     def undo(self, grid: Grid) -> PaintAction|None:
         """
         Undo an operation, and apply the relevant action to the grid.
@@ -42,37 +258,107 @@ class UndoTracker:
 
         :return: The action that was undone, or None.
 
-        Complexity: O(nm . special) 
+        Complexity: O(nm . special)
         Case when action done is special
         n: The horizontal length of the grid
         m: The vertical length of the grid
         Special because the time complexity may differ depending on the type of layer store
         """
-        if not self.tracker.is_empty(): # Check whether there's any actions to undo
-            action = self.tracker.pop()
-            action.undo_apply(grid) # Undo the action
-            self.undone.push(action) # Add the action to self.undone so we can redo it later on
-            return action
-        return None
+        if self.current is self.root: # Check whether there's any actions to undo
+            return None
+        action = self.action_of(self.current)
+        action.undo_apply(grid) # Undo the action
+        self.current.parent.redo_child = self.current # So redo comes back down this branch
+        self.current = self.current.parent
+        return action
+
+    @profiler.timed("UndoTracker.redo")
     def redo(self, grid: Grid) -> PaintAction|None:
         """
-        Redo an operation that was previously undone.
+        Redo an operation that was previously undone, following the current branch.
         If there are no actions to redo, simply do nothing.
 
         :return: The action that was redone, or None.
 
-        Complexity: O(nm . special) 
+        Complexity: O(nm . special)
         Case when action done is special
         n: The horizontal length of the grid
         m: The vertical length of the grid
         Special because the time complexity may differ depending on the type of layer store
 
         """
-        if not self.undone.is_empty(): # Check whether there are any actions to redo
-            action = self.undone.pop() 
-            action.redo_apply(grid) # Redo the action
-            self.tracker.push(action) # Add the action to the tracker
-            return action
-        return None
+        child = self.current.redo_child
+        if child is None: # Check whether there are any actions to redo
+            return None
+        action = self.action_of(child)
+        action.redo_apply(grid) # Redo the action
+        self.current = child
+        return action
+
+    def jump_to(self, grid: Grid, node: UndoNode) -> list[tuple[PaintAction, bool]]:
+        """
+        Moves the grid to the state of any node in the tree.
+        Only the actions on the path through the common ancestor are applied.
+
+        :return: The (action, is_undo) pairs applied, in order.
+        :raises ValueError: if the node was evicted from the tree
+
+        Complexity: O(d . nm . special)
+        d: The length of the path between the two nodes
+        """
+        if node.evicted:
+            raise ValueError("Can't jump to a node evicted from the undo tree")
+        ancestors = set()
+        walk = self.current
+        while walk is not None:
+            ancestors.add(walk)
+            walk = walk.parent
+        down = []
+        while node not in ancestors:
+            down.append(node)
+            node = node.parent
+        common = node
+
+        applied = []
+        while self.current is not common:
+            applied.append((self.undo(grid), True))
+        for node in reversed(down):
+            self.current.redo_child = node
+            applied.append((self.redo(grid), False))
+        return applied
+
+    def leaves(self) -> list[UndoNode]:
+        """
+        The tip of every branch, oldest first.
+
+        Complexity: O(k)
+        k: The number of nodes in the tree
+        """
+        leaves = []
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if node.children:
+                stack.extend(node.children)
+            else:
+                leaves.append(node)
+        return sorted(leaves, key=lambda leaf: leaf.seq)
+
+    def switch_branch(self, grid: Grid) -> list[tuple[PaintAction, bool]]:
+        """
+        Jumps to the tip of the next branch, cycling through branches from oldest to newest.
+
+        :return: The (action, is_undo) pairs applied, in order.
+
+        Complexity: O(k + d . nm . special)
+        k: The number of nodes in the tree
+        d: The length of the path between the two branch tips
+        """
+        tip = self.current
+        while tip.redo_child is not None:
+            tip = tip.redo_child
+        leaves = self.leaves()
+        return self.jump_to(grid, leaves[(leaves.index(tip) + 1) % len(leaves)])
+
 if __name__ == "__main__":
-    x = PaintAction()
\ No newline at end of file
+    x = PaintAction()
@@ -0,0 +1,57 @@
+"""
+Keys and mixing functions for incremental (Zobrist-style) hashing of grid state.
+
+Every layer store keeps a 64-bit hash of its own contents, updated in O(1) as it changes.
+The grid hash is the XOR of `cell_hash(key, store hash)` over every square,
+so a change to one square updates it in O(1) too.
+Keys are derived deterministically, so equal grids hash equally in every process.
+"""
+from __future__ import annotations
+
+MASK64 = (1 << 64) - 1
+
+# Additive stores hash their ordered layers as a polynomial modulo this prime.
+MOD = (1 << 61) - 1
+BASE = 0x1F3D5B79A2C4E6F1 % MOD
+BASE_INVERSE = pow(BASE, MOD - 2, MOD)
+
+def splitmix64(x: int) -> int:
+    """
+    Scrambles a 64-bit integer, so that nearby inputs give unrelated outputs.
+
+    Complexity: O(1)
+    """
+    x = (x + 0x9E3779B97F4A7C15) & MASK64
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & MASK64
+    return x ^ (x >> 31)
+
+LAYER_KEYS = tuple(splitmix64(0x4C41594552 + i) % MOD or 1 for i in range(64))
+SPECIAL_KEY = splitmix64(0x5350454349414C)
+
+def layer_key(index: int) -> int:
+    """
+    The key of the layer with this index, a non-zero integer below MOD.
+
+    Complexity: O(1)
+    """
+    return LAYER_KEYS[index]
+
+def cell_key(x: int, y: int) -> int:
+    """
+    The key of grid square (x, y).
+
+    Complexity: O(1)
+    """
+    return splitmix64((x << 32) | y)
+
+def cell_hash(key: int, store_hash: int) -> int:
+    """
+    The contribution of a square with this key and store hash to the grid hash.
+    Empty stores contribute 0, so an empty grid always hashes to 0.
+
+    Complexity: O(1)
+    """
+    if store_hash == 0:
+        return 0
+    return splitmix64(store_hash ^ key)